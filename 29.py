@@ -1,4 +1,4 @@
-# try:
-#     raise ValueError("ouch")
-# except ValueError as e:
-#     print("Caught %s" % e)
+try:
+    raise ValueError("ouch")
+except ValueError as e:
+    print("Caught %s" % e)
@@ -0,0 +1,46 @@
+def f(a, b=2, *args, c, d=4, **kwargs):
+    return a, b, args, c, d, sorted(kwargs.items())
+
+print(f(1, c=3))
+print(f(1, 5, 6, 7, c=3, e=8, d=9))
+
+
+def counter(start):
+    count = start
+    def step(delta=1):
+        return count + delta
+    return step
+
+print(counter(10)())
+print(counter(10)(5))
+
+
+def squares(n):
+    k = 2
+    return [x ** k for x in range(n)], {x: x * k for x in range(3)}
+
+print(squares(4))
+
+
+def fact(n):
+    if n <= 1:
+        return 1
+    return n * fact(n - 1)
+
+print(fact(10))
+
+
+class Base:
+    def __init__(self, name):
+        self.name = name
+
+    def hello(self):
+        return "hello " + self.name
+
+
+class Child(Base):
+    def hello(self):
+        return super().hello() + "!"
+
+print(Child("vm").hello())
+print(list(map(lambda x: x + 1, [1, 2, 3])))
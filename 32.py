@@ -0,0 +1,25 @@
+a, *b = [1, 2, 3]
+print(a, b)
+*a, b = [1, 2, 3]
+print(a, b)
+a, *b, c = [1, 2]
+print(a, b, c)
+a, *b, c, d = range(6)
+print(a, b, c, d)
+
+x = {**{1: 2}, 3: 4}
+print(x, [*b, *b], (1, *b), {*b})
+
+
+def f(*args, **kw):
+    return args, sorted(kw.items())
+
+print(f(1, *[2, 3], k=1, **{'z': 2}))
+
+l = [0, 1, 2]
+l[1], l[2] = l[2], l[1]
+print(l)
+x, y, z = 1, 2, 3
+x, y, z = z, x, y
+print(x, y, z)
+print(f"{x} {y!r:>4} {z:03d}")
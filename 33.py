@@ -0,0 +1,69 @@
+def count_up(n):
+    i = 0
+    while i < n:
+        yield i
+        i += 1
+    return 'done'
+
+print(list(count_up(5)))
+print(sum(x * x for x in range(10)))
+g = count_up(2)
+print(next(g), next(g))
+print(next(g, 'exhausted'))
+
+def echo():
+    total = 0
+    while True:
+        value = yield total
+        if value is None:
+            break
+        total += value
+
+e = echo()
+print(next(e), e.send(3), e.send(4))
+
+def outer():
+    result = yield from count_up(3)
+    print('inner returned', result)
+    yield from [10, 20]
+    yield from (c for c in 'ab')
+
+print(list(outer()))
+
+def pipeline(n):
+    numbers = (i for i in range(n))
+    squares = (x * x for x in numbers)
+    evens = (s for s in squares if s % 2 == 0)
+    return sum(evens)
+
+print(pipeline(1000))
+
+def closure_gen(k):
+    def inner():
+        for i in range(3):
+            yield i * k
+    return inner()
+
+print(list(closure_gen(7)))
+class C:
+    def items(self):
+        yield self
+        yield 1
+c = C()
+print([x is c for x in c.items()])
+gen = count_up(10)
+for v in gen:
+    if v == 3:
+        break
+print(next(gen), list(gen))
+gen = count_up(3)
+gen.close()
+print(list(gen))
+print(dict((k, v) for k, v in zip('abc', count_up(3))))
+def deleg():
+    x = yield from echo()
+    yield x
+d = deleg()
+print(next(d), d.send(5), d.send(6))
+print(type(iter(count_up(1))).__name__ in ('generator', 'Generator'))
+print(sorted(count_up(4), reverse=True), max(count_up(4)), any(x > 2 for x in count_up(4)))
@@ -0,0 +1,140 @@
+def safe_div(a, b):
+    try:
+        return a // b
+    except ZeroDivisionError:
+        return None
+    finally:
+        print('divided', a, b)
+
+print(safe_div(7, 2), safe_div(1, 0))
+
+def classify(value):
+    try:
+        if value == 0:
+            raise KeyError(value)
+        if value == 1:
+            raise TypeError('one')
+        int('x' * value)
+    except (KeyError, TypeError) as exc:
+        return type(exc).__name__
+    except ValueError:
+        return 'value'
+    else:
+        return 'none'
+
+print([classify(v) for v in range(3)])
+
+def nested(n):
+    log = []
+    for i in range(n):
+        try:
+            try:
+                if i % 3 == 0:
+                    continue
+                if i == 4:
+                    break
+                log.append(i)
+            finally:
+                log.append('f%d' % i)
+        except Exception:
+            log.append('never')
+    else:
+        log.append('else')
+    return log
+
+print(nested(3), nested(6))
+
+def override():
+    try:
+        return 'try'
+    finally:
+        return 'finally'
+
+print(override())
+
+def reraise():
+    try:
+        try:
+            {}['missing']
+        except KeyError:
+            raise
+    except LookupError as exc:
+        return repr(exc)
+
+print(reraise())
+
+def chained():
+    try:
+        try:
+            1 / 0
+        except ZeroDivisionError as exc:
+            raise ValueError('wrapped') from exc
+    except ValueError as exc:
+        return type(exc.__cause__).__name__, type(exc.__context__).__name__
+
+print(chained())
+
+def inner():
+    raise IndexError('deep')
+
+def middle():
+    try:
+        inner()
+    finally:
+        print('middle cleanup')
+
+try:
+    middle()
+except IndexError as exc:
+    print('caught across frames', exc)
+
+class Resource:
+    def __init__(self, name, suppress=False):
+        self.name = name
+        self.suppress = suppress
+
+    def __enter__(self):
+        print('enter', self.name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        print('exit', self.name, exc_type.__name__ if exc_type else None)
+        return self.suppress
+
+with Resource('a') as resource:
+    print('inside', resource.name)
+
+with Resource('b', suppress=True):
+    raise RuntimeError('suppressed')
+
+def with_return():
+    with Resource('c'):
+        return 'returned from with'
+
+print(with_return())
+
+def gen():
+    try:
+        yield 1
+        yield 2
+    except KeyError:
+        yield 'handled'
+    finally:
+        print('gen cleanup')
+
+g = gen()
+print(next(g), g.throw(KeyError))
+g.close()
+g = gen()
+next(g)
+g.close()
+
+total = 0
+for i in range(5):
+    try:
+        if i == 3:
+            raise StopIteration
+        total += i
+    except StopIteration:
+        total += 100
+print(total)
@@ -0,0 +1,96 @@
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+print([fib(n) for n in range(15)])
+
+def depth(n):
+    if n == 0:
+        return 0
+    return depth(n - 1) + 1
+
+print(depth(500))
+
+def depth_kw(n):
+    if n == 0:
+        return 0
+    return depth_kw(n=n - 1) + 1
+
+def depth_star(n, step=1):
+    if n <= 0:
+        return 0
+    return depth_star(*(n - step,), **{'step': step}) + 1
+
+class Counter:
+    def down(self, n):
+        return 0 if n == 0 else self.down(*[n - 1]) + 1
+
+print(depth_kw(300), depth_star(300), Counter().down(300))
+
+def is_even(n):
+    return True if n == 0 else is_odd(n - 1)
+
+def is_odd(n):
+    return False if n == 0 else is_even(n - 1)
+
+print(is_even(300), is_odd(301), is_even(7))
+
+def dig(n, log):
+    try:
+        if n == 0:
+            raise ValueError('bottom')
+        return dig(n - 1, log)
+    finally:
+        log.append(n)
+
+log = []
+try:
+    dig(5, log)
+except ValueError as exc:
+    print('caught', exc, log)
+
+def handled(n):
+    try:
+        raise KeyError(n)
+    except KeyError:
+        if n:
+            return handled(n - 1)
+        return 'done'
+
+def reraise():
+    try:
+        raise IndexError('outer')
+    except IndexError:
+        handled(3)
+        try:
+            raise
+        except IndexError as exc:
+            return exc
+
+print(reraise())
+
+class Tree:
+    def __init__(self, value, children=()):
+        self.value = value
+        self.children = list(children)
+
+    def total(self):
+        return self.value + sum(child.total() for child in self.children)
+
+    def height(self):
+        heights = [child.height() for child in self.children]
+        return 1 + max(heights) if heights else 1
+
+tree = Tree(1, [Tree(2, [Tree(4)]), Tree(3, [Tree(5, [Tree(6)])])])
+print(tree.total(), tree.height())
+
+def forever(n):
+    return forever(n + 1)
+
+try:
+    forever(0)
+except RecursionError as exc:
+    print(type(exc).__name__)
+
+print(depth(100))
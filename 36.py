@@ -0,0 +1,23 @@
+def f(a, b, c, *, d, e):
+    pass
+
+def g(a, b=1, *, k):
+    pass
+
+def h(a):
+    pass
+
+def v(a, *rest, k=2):
+    return a, rest, k
+
+calls = [lambda: f(), lambda: f(1, 2), lambda: f(1, 2, 3, d=1),
+         lambda: f(1, 2, 3), lambda: g(1, 2, 3, k=1), lambda: g(1, 2, 3),
+         lambda: g(), lambda: f(1, 2, 3, 4, d=1), lambda: h(),
+         lambda: h(1, 2), lambda: h(a=1, b=2), lambda: h(1, a=2),
+         lambda: g(1, 2, 3, k=1, z=2), lambda: v(1, 2, 3), lambda: v(),
+         lambda: (lambda: 0)(1)]
+for call in calls:
+    try:
+        print(call())
+    except TypeError as exc:
+        print(exc)
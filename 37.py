@@ -0,0 +1,23 @@
+def length(s):
+    return len(s)
+
+def greet():
+    return message
+
+print(length('abc'))
+len = lambda s: 42
+print(length('abc'))
+del len
+print(length('abc'))
+
+message = 'hello'
+print(greet())
+message = 'bye'
+print(greet())
+globals()['message'] = 'external'
+print(greet())
+
+for i in range(3):
+    print(length('ab'), greet())
+    len = lambda s, i=i: i
+    message = i
@@ -0,0 +1,29 @@
+class A:
+    def m(self):
+        return 1
+
+class B(A):
+    pass
+
+def m2(self):
+    return 2
+
+def m3(self):
+    return 3
+
+def call(obj):
+    return obj.m()
+
+a = A()
+b = B()
+print(call(a), call(b))
+setattr(A, 'm', m2)
+print(call(a), call(b))
+type.__setattr__(B, 'm', m3)
+print(call(a), call(b))
+del B.m
+print(call(a), call(b))
+a.m = lambda: 'own'
+print(call(a), call(b))
+A.m = m3
+print(call(A()), call(b))
@@ -0,0 +1,79 @@
+
+class Resource:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        print('open', self.name)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        print('close', self.name, exc_type.__name__ if exc_type else None)
+
+
+def counter(limit):
+    try:
+        for i in range(limit):
+            yield i
+    finally:
+        print('closing', limit)
+
+
+def reader(name):
+    with Resource(name):
+        yield 1
+        yield 2
+
+
+def catcher():
+    try:
+        yield 1
+    except GeneratorExit:
+        print('caught GeneratorExit')
+        raise
+
+
+g = counter(3)
+print(next(g))
+del g
+print('after del')
+
+g = reader('a')
+print(next(g))
+g = reader('b')
+print('rebound')
+print(next(g))
+g = None
+print('after rebind')
+
+g = catcher()
+next(g)
+g = None
+
+
+def partial():
+    local = counter(5)
+    print(next(local), next(local))
+    return 'returned'
+
+
+print(partial())
+
+for value in counter(10):
+    if value == 2:
+        break
+print('after break')
+
+g = counter(4)
+del g
+print('not started')
+
+g = counter(1)
+print(list(g))
+del g
+print('finished')
+
+for resource in [reader('c')]:
+    print(next(resource))
+del resource
+print('done')
@@ -0,0 +1,1048 @@
+"""
+микробенчмарки виртуальной машины и набор нагрузок для сравнения
+с exec
+
+запуск: python bench.py
+        python bench.py --suite [--output results.json]
+                        [--baseline baseline.json] [--threshold 0.1]
+"""
+import argparse
+import asyncio
+import builtins
+import dis
+import glob
+import inspect
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from io import StringIO
+
+from vm import (ClosureCompiler, CodeCache, Commands, DiskCodeCache,
+                Function, Profiler, SamplingProfiler, Scheduler,
+                VirtualMachine, code_objects, run_many)
+
+
+def print_delimeter():
+    print("_" * 80)
+
+
+def measure(source, repeat=3):
+    """
+    скомпилировать source и вернуть лучшее время его выполнения на vm
+    """
+    code = compile(source, '<bench>', 'exec')
+    best = None
+    for _ in range(repeat):
+        virtual_machine = VirtualMachine()
+        start = time.perf_counter()
+        virtual_machine.run_code(code)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def skipped_body_loop(body_length, iterations):
+    """
+    цикл, тело которого из body_length присваиваний перепрыгивается
+    на каждой итерации: выполняемая работа не зависит от body_length,
+    от него зависит только расстояние jump-ов
+    """
+    lines = [
+        "flag = False",
+        "for i in range({}):".format(iterations),
+        "    if flag:",
+    ]
+    lines.extend(["        x = i"] * body_length)
+    lines.append("    y = i")
+    return "\n".join(lines) + "\n"
+
+
+def bench_jumps(iterations=20000):
+    print("loop with skipped body: time per iteration")
+    for body_length in (1, 10, 100, 1000):
+        elapsed = measure(skipped_body_loop(body_length, iterations))
+        print("body {:>5}: {:8.3f} us/iter".format(
+            body_length, elapsed / iterations * 1e6))
+
+
+def bench_code_cache(runs=2000):
+    """
+    многократный запуск одного объекта кода с кэшем и без него
+    (max_size=0 вытесняет запись сразу же)
+    """
+    code = compile(skipped_body_loop(100, 1), '<bench>', 'exec')
+    print("repeated run_code of a 100-line module")
+    for title, cache in (("no cache", CodeCache(max_size=0)),
+                         ("lru cache", CodeCache())):
+        virtual_machine = VirtualMachine(code_cache=cache)
+        start = time.perf_counter()
+        for _ in range(runs):
+            virtual_machine.run_code(code)
+        elapsed = time.perf_counter() - start
+        print("{:>9}: {:8.3f} us/run  hits={} misses={}".format(
+            title, elapsed / runs * 1e6, cache.hits, cache.misses))
+
+
+def bench_decode(repeat=20):
+    """
+    разбор объектов кода тестовых программ в список dis.Instruction
+    и в Commands: время и память, которую занимает результат
+    """
+    codes = []
+    for test_file in test_files():
+        with open(test_file) as source:
+            codes.extend(code_objects(compile(source.read(), test_file,
+                                              'exec')))
+    instructions = sum(len(Commands.decode(code)) for code in codes)
+    print("{} code objects, {} instructions".format(len(codes),
+                                                   instructions))
+    for title, decode in (
+            ("dis.get_instructions",
+             lambda code: list(dis.get_instructions(code))),
+            ("Commands.decode", Commands.decode)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for code in codes:
+                decode(code)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        tracemalloc.start()
+        try:
+            decoded = [decode(code) for code in codes]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del decoded
+        print("{:>20}: {:7.1f} us/code object, {:6.0f} bytes/code object"
+              .format(title, best / len(codes) * 1e6, size / len(codes)))
+
+
+def call_overhead(calls):
+    """
+    время одного вызова функции из кода vm, без учета самого цикла
+    """
+    loop = "for i in range({}):\n    g(i)\n".format(calls)
+    with_call = "def g(a, b=1):\n    return a\n" + loop
+    without_call = "g = abs\n" + loop
+    return (measure(with_call) - measure(without_call)) / calls
+
+
+def bench_calls(calls=20000, binds=20000):
+    print("call of a script-defined function from the vm")
+    print("per call: {:8.3f} us".format(call_overhead(calls) * 1e6))
+    module = compile("def g(a, b=1, *args, c=2, **kwargs):\n    pass\n",
+                     '<bench>', 'exec')
+    code = [const for const in module.co_consts
+            if isinstance(const, type(module))][0]
+    native = eval("lambda a, b=1, *args, c=2, **kwargs: None")
+    function = Function('g', code, {}, (1,), {'c': 2}, None,
+                        VirtualMachine())
+    binder = CodeCache().get(code).binder
+    start = time.perf_counter()
+    for _ in range(binds):
+        inspect.getcallargs(native, 1, 2, 3, c=4, d=5)
+    inspect_time = (time.perf_counter() - start) / binds
+    start = time.perf_counter()
+    for _ in range(binds):
+        binder.bind(function, (1, 2, 3), {'c': 4, 'd': 5})
+    binder_time = (time.perf_counter() - start) / binds
+    print("bind g(1, 2, 3, c=4, d=5): inspect.getcallargs {:.3f} us, "
+          "binder {:.3f} us".format(inspect_time * 1e6, binder_time * 1e6))
+
+
+def bench_fib(n=20, depth=20000):
+    """
+    рекурсивный fib: время вызова функции виртуальной машины и глубина
+    рекурсии, до которой не дойдет код в CPython с пределом по умолчанию
+    """
+    # fib(n) вызывает себя 2 * F(n + 1) - 1 раз
+    previous, current = 1, 1
+    for _ in range(n - 1):
+        previous, current = current, previous + current
+    calls = 2 * current - 1
+    source = ("def fib(n):\n"
+              "    if n < 2:\n"
+              "        return n\n"
+              "    return fib(n - 1) + fib(n - 2)\n"
+              "fib({})\n".format(n))
+    elapsed = measure(source)
+    print("recursive fib({}): {:.1f} ms, {:.3f} us/call".format(
+        n, elapsed * 1e3, elapsed / calls * 1e6))
+    deep = compile("def down(n):\n"
+                   "    return 0 if n == 0 else down(n - 1) + 1\n"
+                   "down({})\n".format(depth), '<bench>', 'exec')
+    virtual_machine = VirtualMachine(recursion_limit=depth + 10)
+    start = time.perf_counter()
+    virtual_machine.run_code(deep)
+    print("recursion depth {}: {:.1f} ms, sys.getrecursionlimit() {}".format(
+        depth, (time.perf_counter() - start) * 1e3, sys.getrecursionlimit()))
+
+
+def bench_frames(frames=10000, iterations=100000):
+    """
+    память на фрейм функции с пятью локальными переменными
+    и скорость доступа к локальным переменным в горячем цикле
+    """
+    module = compile("def g(a, b, c):\n    d = a\n    e = b\n",
+                     '<bench>', 'exec')
+    code = [const for const in module.co_consts
+            if isinstance(const, type(module))][0]
+    virtual_machine = VirtualMachine()
+    function = Function('g', code, {}, None, None, None, virtual_machine)
+    code_info = virtual_machine.code_cache.get(code)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [virtual_machine._make_frame(
+        function, code_info, code_info.binder.bind(function, (1, 2, 3), {}))
+        for _ in range(frames)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    print("memory per frame: {:.0f} bytes".format(allocated / frames))
+    hot_loop = (
+        "def f(n):\n"
+        "    total = 0\n"
+        "    for i in range(n):\n"
+        "        total = total + i\n"
+        "    return total\n"
+        "f({})\n".format(iterations))
+    print("local variable loop: {:.3f} us/iter".format(
+        measure(hot_loop) / iterations * 1e6))
+
+
+def bench_builders(iterations=50000):
+    """
+    сборка контейнеров и вызовы с несколькими аргументами
+    """
+    program = (
+        "for i in range({}):\n"
+        "    l = [i, i, i, i, i, i]\n"
+        "    t = (i, i, i, i, i, i)\n"
+        "    d = {{'a': i, 'b': i, i: i}}\n"
+        "    x, y, z = i, i, i\n"
+        "    max(i, i, i, i, i)\n".format(iterations))
+    print("container building loop: {:.3f} us/iter".format(
+        measure(program) / iterations * 1e6))
+
+
+def scaled_program(test_file, loops):
+    """
+    обернуть тестовую программу N.py в цикл из loops итераций
+    """
+    with open(test_file) as file_with_test:
+        body = file_with_test.read().splitlines()
+    lines = ["for _bench_loop in range({}):".format(loops), "    pass"]
+    lines.extend("    " + line for line in body)
+    return "\n".join(lines) + "\n"
+
+
+def test_files():
+    return sorted(glob.glob("[0-9]*.py"), key=lambda name: int(name[:-3]))
+
+
+class DispatchCounter(CodeCache):
+    """
+    кэш кода, обработчики которого считают свои вызовы, то есть
+    число итераций цикла выполнения
+    """
+    def __init__(self, superinstructions=None):
+        super().__init__(superinstructions=superinstructions)
+        self.dispatches = 0
+
+    def get(self, bytecode):
+        known = id(bytecode) in self.entries
+        code_info = super().get(bytecode)
+        if not known:
+            code_info.ops = [(self._counted(handler), arg)
+                             for handler, arg in code_info.ops]
+        return code_info
+
+    def _counted(self, handler):
+        def counted(vm, arg):
+            self.dispatches += 1
+            return handler(vm, arg)
+        return counted
+
+
+def count_dispatches(source, superinstructions=None):
+    code = compile(source, '<bench>', 'exec')
+    counter = DispatchCounter(superinstructions)
+    with redirect_stdout(StringIO()):
+        VirtualMachine(code_cache=counter).run_code(code)
+    return counter.dispatches
+
+
+def bench_superinstructions(loops=20):
+    """
+    число диспетчеризаций в тестовых программах без суперинструкций
+    и с ними, и время горячего цикла с локальными переменными
+    """
+    print("dispatches in test programs scaled to {} loops".format(loops))
+    plain_total = fused_total = 0
+    for test_file in test_files():
+        source = scaled_program(test_file, loops)
+        plain = count_dispatches(source, {})
+        fused = count_dispatches(source)
+        plain_total += plain
+        fused_total += fused
+        print("{:>6}: {:8} -> {:8}  (-{:.1f}%)".format(
+            test_file, plain, fused, 100.0 * (plain - fused) / plain))
+    print(" total: {:8} -> {:8}  (-{:.1f}%)".format(
+        plain_total, fused_total,
+        100.0 * (plain_total - fused_total) / plain_total))
+    hot_loop = compile(
+        "def f(n):\n"
+        "    total = 0\n"
+        "    i = 0\n"
+        "    while i < n:\n"
+        "        total = total + i * 2\n"
+        "        i = i + 1\n"
+        "    return total\n"
+        "f(100000)\n", '<bench>', 'exec')
+    for title, cache in (("plain", CodeCache(superinstructions={})),
+                         ("fused", CodeCache())):
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            VirtualMachine(code_cache=cache).run_code(hot_loop)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print("while loop, {}: {:.3f} us/iter".format(title, best * 10))
+
+
+def bench_name_caches(iterations=20000, loops=20):
+    """
+    поиск имен без встроенных кэшей и с ними, и счетчики кэшей
+    на тестовых программах
+    """
+    programs = (
+        ("module builtins",
+         "for i in range({}):\n"
+         "    abs; abs; len; len; min; min\n".format(iterations)),
+        ("function globals",
+         "K = 3\n"
+         "def f(n):\n"
+         "    for i in range(n):\n"
+         "        K; K; abs; abs; len; len\n"
+         "f({})\n".format(iterations)),
+    )
+    for title, source in programs:
+        code = compile(source, '<bench>', 'exec')
+        timings = []
+        for name_caches in (False, True):
+            cache = CodeCache(name_caches=name_caches)
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                VirtualMachine(code_cache=cache).run_code(code)
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings.append(best / iterations * 1e6)
+        print("{}: {:.3f} us/iter, with name caches {:.3f} us/iter".format(
+            title, *timings))
+    cache = CodeCache(name_caches=True)
+    for test_file in test_files():
+        with redirect_stdout(StringIO()):
+            VirtualMachine(code_cache=cache).run_code(
+                scaled_program(test_file, loops))
+    print("name caches on test programs scaled to {} loops: "
+          "hits={hits} misses={misses} invalidations={invalidations}"
+          .format(loops, **cache.name_cache_stats()))
+
+
+def bench_call_caches(calls=20000, loops=20, repeat=10):
+    """
+    время вызова из кода vm без кэшей вызовов и с ними, за вычетом
+    пустого цикла, и счетчики кэшей на тестовых программах
+    """
+    header = ("def g(a, b=1):\n"
+              "    return a\n"
+              "class C:\n"
+              "    def __init__(self, a):\n"
+              "        self.a = a\n"
+              "    def m(self, a):\n"
+              "        return a\n"
+              "c = C(1)\n"
+              "def f(n):\n"
+              "    for i in range(n):\n")
+    sites = (("builtin abs(i)", "abs(i)"),
+             ("function g(i)", "g(i)"),
+             ("function g(i, b=2)", "g(i, b=2)"),
+             ("method c.m(i)", "c.m(i)"),
+             ("class C(i)", "C(i)"))
+    codes = [(title, compile(header + "        {}\nf({})\n".format(
+        body, calls), '<bench>', 'exec'))
+        for title, body in (("empty", "i"),) + sites]
+    caches = {call_caches: CodeCache(call_caches=call_caches)
+              for call_caches in (False, True)}
+    # варианты чередуются, чтобы дрейф машины делился между ними поровну
+    timings = {}
+    for _ in range(repeat):
+        for title, code in codes:
+            for call_caches, cache in caches.items():
+                start = time.perf_counter()
+                VirtualMachine(code_cache=cache).run_code(code)
+                elapsed = (time.perf_counter() - start) / calls
+                key = (title, call_caches)
+                timings[key] = min(timings.get(key, elapsed), elapsed)
+    for title, _ in sites:
+        print("{:>18}: {:6.3f} us/call, with call caches {:6.3f} us/call"
+              .format(title, *((timings[title, call_caches] -
+                                timings["empty", call_caches]) * 1e6
+                               for call_caches in (False, True))))
+    cache = CodeCache(call_caches=True)
+    for test_file in test_files():
+        with redirect_stdout(StringIO()):
+            VirtualMachine(code_cache=cache).run_code(
+                scaled_program(test_file, loops))
+    print("call caches on test programs scaled to {} loops: "
+          "hits={hits} misses={misses} invalidations={invalidations}"
+          .format(loops, **cache.call_cache_stats()))
+
+
+def bench_closures(iterations=20000, loops=20, repeat=5):
+    """
+    время выполнения обычным циклом и замыканиями участков
+    (VirtualMachine(closures=True)) и время компиляции в замыкания
+    """
+    programs = (
+        ("while arithmetic",
+         "def f(n):\n"
+         "    t = 0\n"
+         "    i = 0\n"
+         "    while i < n:\n"
+         "        t = t + i * 2 % 7\n"
+         "        i += 1\n"
+         "f({})\n".format(iterations)),
+        ("for with if",
+         "def f(n):\n"
+         "    t = 0\n"
+         "    for i in range(n):\n"
+         "        if i % 3 == 0:\n"
+         "            t += i\n"
+         "f({})\n".format(iterations)),
+        ("attribute",
+         "class P:\n"
+         "    x = 1\n"
+         "p = P()\n"
+         "def f(n):\n"
+         "    t = 0\n"
+         "    for i in range(n):\n"
+         "        t = t + p.x * i\n"
+         "f({})\n".format(iterations)),
+    )
+    codes = [(title, compile(source, '<bench>', 'exec'))
+             for title, source in programs]
+    codes.append(("test programs", [
+        compile(scaled_program(test_file, loops), test_file, 'exec')
+        for test_file in test_files()]))
+    caches = {closures: CodeCache() for closures in (False, True)}
+    # варианты чередуются, чтобы дрейф машины делился между ними поровну
+    timings = {}
+    for _ in range(repeat):
+        for title, code in codes:
+            for closures, cache in caches.items():
+                start = time.perf_counter()
+                with redirect_stdout(StringIO()):
+                    for program in code if type(code) is list else [code]:
+                        VirtualMachine(code_cache=cache,
+                                       closures=closures).run_code(program)
+                elapsed = time.perf_counter() - start
+                key = (title, closures)
+                timings[key] = min(timings.get(key, elapsed), elapsed)
+    for title, _ in codes:
+        interpreted, compiled = (timings[title, closures]
+                                 for closures in (False, True))
+        print("{:>16}: {:.3f} s, closures {:.3f} s ({:.2f}x)".format(
+            title, interpreted, compiled, interpreted / compiled))
+    infos = [code_info
+             for _, code_info in caches[True].entries.values()]
+    start = time.perf_counter()
+    for info in infos:
+        ClosureCompiler(info).compile()
+    elapsed = time.perf_counter() - start
+    print("compile to closures: {:.1f} us per code object".format(
+        elapsed / len(infos) * 1e6))
+
+
+def bench_optimizer(iterations=20000):
+    """
+    сколько инструкций убрал оптимизатор из кода тестовых программ
+    и время цикла со сравнениями констант без оптимизатора и с ним
+    """
+    print("instructions removed by the optimizer")
+    total = 0
+    for test_file in test_files():
+        cache = CodeCache()
+        with open(test_file) as file_with_test:
+            code = compile(file_with_test.read(), test_file, 'exec')
+        with redirect_stdout(StringIO()):
+            VirtualMachine(code_cache=cache).run_code(code)
+        removed = cache.removed_instructions()
+        total += sum(removed.values())
+        if removed:
+            print("{:>6}: {}".format(test_file, ", ".join(
+                "{} -{}".format(bytecode.co_name, count)
+                for bytecode, count in removed.items())))
+    print(" total: -{}".format(total))
+    source = compile(
+        "def f(n):\n"
+        "    total = 0\n"
+        "    for i in range(n):\n"
+        "        if 1 > 2:\n"
+        "            print(i)\n"
+        "        elif 2 ** 3 == 8 and 'a' in 'abc':\n"
+        "            total = total + i\n"
+        "    return total\n"
+        "f({})\n".format(iterations), '<bench>', 'exec')
+    timings = []
+    for optimizations in ((), None):
+        cache = CodeCache(optimizations=optimizations)
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            VirtualMachine(code_cache=cache).run_code(source)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append(best / iterations * 1e6)
+    print("constant conditions loop: {:.3f} us/iter, optimized {:.3f} us/iter"
+          .format(*timings))
+
+
+def bench_profiler(iterations=20000):
+    """
+    цикл выполнения без профилировщика тот же _run_frame, что и до
+    появления профилирования; здесь - во сколько раз его замедляет
+    включенный профилировщик
+    """
+    code = compile(
+        "def f(n):\n"
+        "    total = 0\n"
+        "    for i in range(n):\n"
+        "        total = total + i\n"
+        "    return total\n"
+        "f({})\n".format(iterations), '<bench>', 'exec')
+    timings = []
+    for profiler in (None, Profiler()):
+        best = None
+        for _ in range(3):
+            virtual_machine = VirtualMachine(profiler=profiler)
+            start = time.perf_counter()
+            virtual_machine.run_code(code)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append(best / iterations * 1e6)
+    print("local variable loop: {:.3f} us/iter, profiled {:.3f} us/iter "
+          "(x{:.1f})".format(timings[0], timings[1], timings[1] / timings[0]))
+
+
+def bench_sampling_profiler(depth=20, repeat=15):
+    """
+    замедление рекурсивной программы выборочным профилировщиком;
+    запуски с ним и без него чередуются, берется лучший
+    """
+    code = compile(
+        "def fib(n):\n"
+        "    if n < 2:\n"
+        "        return n\n"
+        "    return fib(n - 1) + fib(n - 2)\n"
+        "fib({})\n".format(depth), '<bench>', 'exec')
+    best = {None: None, 0.005: None, 0.001: None}
+    samples = {}
+    for _ in range(repeat):
+        for interval in best:
+            virtual_machine = VirtualMachine()
+            start = time.perf_counter()
+            if interval is None:
+                virtual_machine.run_code(code)
+            else:
+                with SamplingProfiler(interval) as sampler:
+                    virtual_machine.run_code(code)
+                samples[interval] = sum(sampler.samples.values())
+            elapsed = time.perf_counter() - start
+            if best[interval] is None or elapsed < best[interval]:
+                best[interval] = elapsed
+    print("fib({}): {:.1f} ms".format(depth, best[None] * 1e3))
+    for interval in (0.005, 0.001):
+        print("sampled every {:.0f} ms: {:.1f} ms ({:+.1f}%), {} samples"
+              .format(interval * 1e3, best[interval] * 1e3,
+                      100.0 * (best[interval] / best[None] - 1),
+                      samples[interval]))
+    # __init__ из type.__call__ выполняет вложенный цикл машины: его
+    # фреймы не должны попасть в стек дважды
+    nested = compile(
+        "def work():\n"
+        "    total = 0\n"
+        "    for i in range(300000):\n"
+        "        total += i\n"
+        "    return total\n"
+        "class Outer:\n"
+        "    def __init__(self):\n"
+        "        self.total = work()\n"
+        "def outer():\n"
+        "    return Outer()\n"
+        "outer()\n", '<bench>', 'exec')
+    with SamplingProfiler(0.001) as sampler:
+        VirtualMachine().run_code(nested)
+    stack = max(sampler.samples, key=sampler.samples.get)
+    print("nested constructor: {}".format(
+        ";".join(location.split()[0] for location in stack)))
+
+
+def bench_disk_cache(repeat=5):
+    """
+    подготовка к запуску тестовых программ и нагрузок набора: compile
+    и разбор всего их кода без дискового кэша, холодный DiskCodeCache
+    (разбор и запись) и теплый (чтение и связывание)
+    """
+    sources = [open(test_file).read() for test_file in test_files()]
+    sources.extend(WORKLOADS.values())
+
+    def without_disk():
+        cache = CodeCache()
+        for source in sources:
+            for code in code_objects(compile(source, '<test>', 'exec')):
+                cache.get(code)
+
+    def with_disk(directory):
+        disk_cache = DiskCodeCache(directory)
+        cache = CodeCache()
+        for source in sources:
+            disk_cache.compile(source, '<test>', cache)
+
+    timings = OrderedDict([("no disk cache", None), ("cold", None),
+                           ("warm", None)])
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            for title, run in (("no disk cache", without_disk),
+                               ("cold", lambda: with_disk(directory)),
+                               ("warm", lambda: with_disk(directory))):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                if timings[title] is None or elapsed < timings[title]:
+                    timings[title] = elapsed
+    print("startup of {} programs:".format(len(sources)), ", ".join(
+        "{} {:.2f} ms".format(title, elapsed * 1e3)
+        for title, elapsed in timings.items()))
+
+
+def bench_run_many(copies=20):
+    """
+    пропускная способность на множестве маленьких программ: новый
+    процесс на каждую программу, последовательный запуск в этом
+    процессе и run_many
+    """
+    sources = [open(test_file).read() for test_file in test_files()]
+    sources = sources * copies
+    start = time.perf_counter()
+    for source in sources[:len(sources) // copies]:
+        subprocess.run([sys.executable, "-c",
+                        "import sys; from vm import VirtualMachine; "
+                        "VirtualMachine().run_code(sys.stdin.read())"],
+                       input=source.encode(), stdout=subprocess.DEVNULL)
+    per_process = (time.perf_counter() - start) / (len(sources) // copies)
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        for source in sources:
+            VirtualMachine().run_code(source)
+    serial = (time.perf_counter() - start) / len(sources)
+    start = time.perf_counter()
+    for _ in run_many(sources):
+        pass
+    pooled = (time.perf_counter() - start) / len(sources)
+    print("{} programs: process per program {:.0f} programs/s, serial "
+          "{:.0f} programs/s, run_many {:.0f} programs/s".format(
+              len(sources), 1 / per_process, 1 / serial, 1 / pooled))
+    # программа, которая вызывает exit, не роняет процесс пула
+    exits = ["raise SystemExit(3)", "exit()", "print('after exits')"]
+    print("exiting programs: {}".format(
+        [result.error or result.stdout.strip()
+         for result in run_many(exits, workers=2)]))
+
+
+def bench_scheduler(copies=50, slice_sizes=(100, 1000), runaways=5):
+    """
+    Scheduler на множестве маленьких программ против их
+    последовательного запуска; runaways бесконечных циклов с квотой
+    показывают, что задержка остальных от них почти не зависит
+    """
+    codes = [compile(open(test_file).read(), test_file, 'exec')
+             for test_file in test_files()] * copies
+    runaway = compile("while True:\n    pass\n", '<runaway>', 'exec')
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        virtual_machine = VirtualMachine()
+        for code in codes:
+            virtual_machine.run_code(code)
+    serial = time.perf_counter() - start
+    print("{} programs: serial {:.0f} programs/s".format(
+        len(codes), len(codes) / serial))
+    for size in slice_sizes:
+        scheduler = Scheduler(slice_size=size)
+        for index in range(runaways):
+            scheduler.spawn(runaway, quota=20000)
+        for code in codes:
+            scheduler.spawn(code)
+        with redirect_stdout(StringIO()):
+            scheduler.run()
+        stats = scheduler.stats()
+        print("slice {}: {:.0f} programs/s, {:.0f} instructions/s, latency "
+              "p50 {:.1f} ms, p99 {:.1f} ms, failed {}".format(
+                  size, stats['tasks_per_second'],
+                  stats['instructions_per_second'],
+                  stats['latency_p50'] * 1e3, stats['latency_p99'] * 1e3,
+                  stats['failed']))
+
+
+def bench_generators(sizes=(10000, 50000)):
+    """
+    пик памяти и время конвейера из генераторов и того же конвейера
+    на списках: память генераторов не зависит от длины
+    """
+    pipelines = (
+        ("generators",
+         "def numbers(n):\n"
+         "    i = 0\n"
+         "    while i < n:\n"
+         "        yield i\n"
+         "        i += 1\n"
+         "squares = (x * x for x in numbers({}))\n"
+         "evens = (s for s in squares if s % 2 == 0)\n"
+         "total = sum(evens)\n"),
+        ("lists",
+         "numbers = list(range({}))\n"
+         "squares = [x * x for x in numbers]\n"
+         "evens = [s for s in squares if s % 2 == 0]\n"
+         "total = sum(evens)\n"),
+    )
+    for title, template in pipelines:
+        for size in sizes:
+            code = compile(template.format(size), '<bench>', 'exec')
+            start = time.perf_counter()
+            VirtualMachine().run_code(code)
+            elapsed = time.perf_counter() - start
+            peak = peak_memory(lambda: VirtualMachine().run_code(code))
+            print("{:>10} pipeline of {:>6}: peak {:8.1f} KB, {:.3f} us/item"
+                  .format(title, size, peak / 1024, elapsed / size * 1e6))
+
+
+def bench_async(slice_sizes=(100, 1000, 10000), programs=200):
+    """
+    run_code_async против run_code на нагрузках набора и задержка
+    цикла событий, пока в нем идут programs программ сразу
+    """
+    loop = asyncio.new_event_loop()
+    for name in ("arithmetic", "calls"):
+        code = compile(WORKLOADS[name], '<bench>', 'exec')
+        timings = ["sync {:.1f} ms".format(best_time(
+            lambda: VirtualMachine().run_code(code), 3) * 1e3)]
+        for size in slice_sizes:
+            elapsed = best_time(lambda: loop.run_until_complete(
+                VirtualMachine().run_code_async(code, size)), 3)
+            timings.append("slice {} {:.1f} ms".format(size, elapsed * 1e3))
+        print("{}: {}".format(name, ", ".join(timings)))
+    # задержка цикла событий - примерно время одного круга по всем
+    # программам, то есть programs кусков по slice_size инструкций
+    code = compile(WORKLOADS["calls"].replace("20000", "1000"), '<bench>',
+                   'exec')
+    for size in slice_sizes[:2]:
+        delays = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                delays.append(time.perf_counter() - start - 0.001)
+
+        async def run_all():
+            tick = loop.create_task(ticker())
+            virtual_machine = VirtualMachine()
+            await asyncio.gather(*(virtual_machine.run_code_async(code, size)
+                                   for _ in range(programs)))
+            tick.cancel()
+
+        start = time.perf_counter()
+        loop.run_until_complete(run_all())
+        elapsed = time.perf_counter() - start
+        delays.sort()
+        print("{} programs at once, slice {}: {:.0f} ms, event loop delay "
+              "median {:.2f} ms, max {:.2f} ms".format(
+                  programs, size, elapsed * 1e3,
+                  delays[len(delays) // 2] * 1e3, delays[-1] * 1e3))
+    loop.close()
+
+
+def bench_programs(loops=200):
+    """
+    время выполнения тестовых программ 0.py-30.py, повторенных loops раз
+    """
+    print("test programs scaled to {} loops".format(loops))
+    total = 0.0
+    for test_file in test_files():
+        with redirect_stdout(StringIO()):
+            elapsed = measure(scaled_program(test_file, loops))
+        total += elapsed
+        print("{:>6}: {:8.2f} ms".format(test_file, elapsed * 1e3))
+    print(" total: {:8.2f} ms".format(total * 1e3))
+
+
+# нагрузки набора: имя -> исходник программы без вывода
+WORKLOADS = OrderedDict([
+    ("arithmetic", (
+        "total = 0\n"
+        "i = 0\n"
+        "while i < 30000:\n"
+        "    total = (total + i * 3 - i // 2) % 1000003\n"
+        "    i += 1\n")),
+    ("calls", (
+        "def add(a, b):\n"
+        "    return a + b\n"
+        "def run(n):\n"
+        "    total = 0\n"
+        "    for i in range(n):\n"
+        "        total = add(total, i)\n"
+        "    return total\n"
+        "run(20000)\n")),
+    ("recursion", (
+        "def fib(n):\n"
+        "    if n < 2:\n"
+        "        return n\n"
+        "    return fib(n - 1) + fib(n - 2)\n"
+        "fib(18)\n")),
+    ("attributes", (
+        "class Point:\n"
+        "    def __init__(self, x, y):\n"
+        "        self.x = x\n"
+        "        self.y = y\n"
+        "    def norm(self):\n"
+        "        return self.x * self.x + self.y * self.y\n"
+        "p = Point(1, 2)\n"
+        "total = 0\n"
+        "for i in range(10000):\n"
+        "    p.x = i\n"
+        "    total += p.norm() + p.y\n")),
+    ("containers", (
+        "for i in range(10000):\n"
+        "    l = [i, i + 1, i + 2]\n"
+        "    t = (i, l)\n"
+        "    d = {'a': i, 'b': t}\n"
+        "    s = {i, i + 1}\n"
+        "    l.append(len(d) + len(s))\n")),
+    ("comprehensions", (
+        "for i in range(500):\n"
+        "    squares = [x * x for x in range(20)]\n"
+        "    index = {x: x % 7 for x in squares}\n"
+        "    odd = {x for x in squares if x % 2}\n")),
+    ("strings", (
+        "for i in range(5000):\n"
+        "    name = 'item'\n"
+        "    a = f'{name}-{i}'\n"
+        "    b = '%s=%d' % (name, i)\n"
+        "    c = '{}:{}'.format(name, i)\n"
+        "    d = ','.join([a, b, c])\n")),
+    ("try_no_raise", (
+        "total = 0\n"
+        "for i in range(20000):\n"
+        "    try:\n"
+        "        total += i\n"
+        "    except ValueError:\n"
+        "        total -= 1\n"
+        "    finally:\n"
+        "        total += 1\n")),
+    ("try_raise", (
+        "def check(i):\n"
+        "    if i % 2:\n"
+        "        raise KeyError(i)\n"
+        "    return i\n"
+        "total = 0\n"
+        "for i in range(10000):\n"
+        "    try:\n"
+        "        total += check(i)\n"
+        "    except KeyError as exc:\n"
+        "        total -= 1\n")),
+])
+
+
+def best_time(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(run):
+    """
+    пик памяти, выделенной за время run, в байтах
+    """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_workload(source, repeat=5):
+    """
+    замеры одной нагрузки на vm и на exec; instructions - выполненные
+    инструкции байткода без слияния в суперинструкции
+    """
+    code = compile(source, '<bench>', 'exec')
+
+    def on_vm():
+        VirtualMachine().run_code(code)
+
+    def on_exec():
+        exec(code, {'__builtins__': builtins})
+
+    vm_time = best_time(on_vm, repeat)
+    exec_time = best_time(on_exec, repeat)
+    instructions = count_dispatches(source, {})
+    return OrderedDict([
+        ("instructions", instructions),
+        ("vm_time", vm_time),
+        ("exec_time", exec_time),
+        ("slowdown", vm_time / exec_time),
+        ("vm_instructions_per_second", instructions / vm_time),
+        ("exec_instructions_per_second", instructions / exec_time),
+        ("vm_peak_memory", peak_memory(on_vm)),
+        ("exec_peak_memory", peak_memory(on_exec)),
+    ])
+
+
+def run_suite(repeat=5):
+    """
+    прогнать все WORKLOADS; результат готов для json.dump
+    """
+    results = OrderedDict()
+    results["python"] = platform.python_version()
+    results["workloads"] = OrderedDict(
+        (name, run_workload(source, repeat))
+        for name, source in WORKLOADS.items())
+    return results
+
+
+def print_suite(results):
+    print("{:>15} {:>9} {:>10} {:>10} {:>8} {:>11} {:>11}".format(
+        "workload", "instr", "vm ms", "exec ms", "slowdown",
+        "vm Minstr/s", "vm peak KB"))
+    for name, result in results["workloads"].items():
+        print("{:>15} {:>9} {:>10.2f} {:>10.2f} {:>8.1f} {:>11.2f} {:>11.1f}"
+              .format(name, result["instructions"], result["vm_time"] * 1e3,
+                      result["exec_time"] * 1e3, result["slowdown"],
+                      result["vm_instructions_per_second"] / 1e6,
+                      result["vm_peak_memory"] / 1024))
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    нагрузки, время которых на vm выросло больше, чем в 1 + threshold
+    раз относительно baseline: список (имя, было, стало)
+    """
+    regressions = []
+    for name, result in results["workloads"].items():
+        old = baseline["workloads"].get(name)
+        if old is None:
+            continue
+        ratio = result["vm_time"] / old["vm_time"]
+        print("{:>15}: {:8.2f} ms -> {:8.2f} ms  x{:.3f}{}".format(
+            name, old["vm_time"] * 1e3, result["vm_time"] * 1e3, ratio,
+            "  REGRESSION" if ratio > 1 + threshold else ""))
+        if ratio > 1 + threshold:
+            regressions.append((name, old["vm_time"], result["vm_time"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--suite", action="store_true",
+                        help="run WORKLOADS on the vm and on exec")
+    parser.add_argument("--output", help="save suite results as JSON")
+    parser.add_argument("--baseline",
+                        help="suite results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed vm_time growth, 0.1 = 10%%")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    if not args.suite:
+        run_microbenchmarks()
+        return 0
+    results = run_suite(args.repeat)
+    print_suite(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print_delimeter()
+        print("compared with {} (threshold {:.0%})".format(
+            args.baseline, args.threshold))
+        if compare_with_baseline(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+def run_microbenchmarks():
+    bench_jumps()
+    print_delimeter()
+    bench_code_cache()
+    print_delimeter()
+    bench_decode()
+    print_delimeter()
+    bench_calls()
+    print_delimeter()
+    bench_fib()
+    print_delimeter()
+    bench_frames()
+    print_delimeter()
+    bench_builders()
+    print_delimeter()
+    bench_superinstructions()
+    print_delimeter()
+    bench_name_caches()
+    print_delimeter()
+    bench_call_caches()
+    print_delimeter()
+    bench_closures()
+    print_delimeter()
+    bench_optimizer()
+    print_delimeter()
+    bench_profiler()
+    print_delimeter()
+    bench_sampling_profiler()
+    print_delimeter()
+    bench_disk_cache()
+    print_delimeter()
+    bench_run_many()
+    print_delimeter()
+    bench_generators()
+    print_delimeter()
+    bench_async()
+    print_delimeter()
+    bench_scheduler()
+    print_delimeter()
+    bench_programs()
+    print_delimeter()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
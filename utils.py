@@ -1,45 +1,214 @@
+import builtins
 import dis
-import subprocess
+import glob
+import hashlib
+import json
+import os
+import platform
+import signal
+import sys
+import time
 from contextlib import redirect_stdout
 from contextlib import redirect_stderr
-import sys
+from multiprocessing import Pool
+from multiprocessing import TimeoutError
 
 from io import StringIO
 
-# количество запускаемых тест кейсов
-num_cases = 50
-
-def print_delimeter():
-    print("_" * 80)
-
-
-def run_vm(virtual_machine):
-    print("test started...\n")
-    for i in range(num_cases):
-        test_file = str(i) + ".py"
-        print("Run test {}".format(test_file))
-        with open(test_file) as file_with_test:
-            code = file_with_test.readlines()
-            print(code)
-            compiled_code = compile(''.join(code), '<test>', 'exec')
-            dis.dis(compiled_code)
-            print_delimeter()
-            print("true res = ", end='')
-            trueErrors = StringIO()
-            trueResult = StringIO()
-            #sys.stderr = trueErrors
-                with redirect_stdout(trueResult):
-                code_t = ''.join(code)
-                exec(code_t)
-            print(trueResult.getvalue())
-            print("vm res = ", end='')
-            vmErrors = StringIO()
-            #sys.stderr = vmErrors
-            vmResult = StringIO()
-            with redirect_stdout(vmResult):
-                virtual_machine.run_code(compiled_code)
-            # virtual_machine.run_code(compiled_code)
-            print(vmResult.getvalue() + "\n")
-            print("errors" + vmErrors.getvalue())
-            assert(vmResult.getvalue() == trueResult.getvalue())
-            assert(vmErrors.getvalue() == trueErrors.getvalue())
\ No newline at end of file
+# файл с выводом эталонного exec по хэшу исходника теста
+REFERENCE_CACHE = '.conformance_cache.json'
+
+
+def print_delimeter(file=None):
+    print("_" * 80, file=file)
+
+
+class TestTimeout(BaseException):
+    """
+    тест не уложился во время; не Exception, чтобы его не поймал
+    except Exception в самой программе
+    """
+
+
+def discover_tests(directory='.', pattern='[0-9]*.py'):
+    """
+    тестовые программы directory: N.py по возрастанию N, остальные
+    подходящие под pattern - по имени
+    """
+    def order(path):
+        name = os.path.basename(path)[:-3]
+        return (0, int(name), '') if name.isdigit() else (1, 0, name)
+    return sorted(glob.glob(os.path.join(directory, pattern)), key=order)
+
+
+def source_hash(source):
+    """
+    ключ эталона: исходник и версия интерпретатора, который его выполнял
+    """
+    key = platform.python_version() + '\0' + source
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _on_timeout(signum, frame):
+    raise TestTimeout()
+
+
+def _execute(run, timeout):
+    """
+    выполнить run(), перехватив вывод; вернуть словарь с stdout, stderr
+    и именем типа исключения (None, если его не было) или 'timeout'
+    """
+    stdout = StringIO()
+    stderr = StringIO()
+    error = None
+    signal.signal(signal.SIGALRM, _on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                run()
+            except TestTimeout:
+                error = 'timeout'
+            except (Exception, SystemExit) as exc:
+                error = type(exc).__name__
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+            'error': error}
+
+
+def _check_test(task):
+    """
+    выполнить один тест в процессе пула: эталон через exec, если его
+    нет в кэше, и виртуальную машину. вывод программы в потоки пула
+    не попадает
+    """
+    path, source, reference, timeout, vm_factory = task
+    # vm импортирует этот модуль, поэтому импорт здесь, а не сверху
+    from vm import VirtualMachine
+    start = time.perf_counter()
+    try:
+        code = compile(source, path, 'exec')
+    except SyntaxError:
+        failed = {'stdout': '', 'stderr': '', 'error': 'SyntaxError'}
+        return {'path': path, 'status': 'error', 'reference': failed,
+                'result': failed, 'elapsed': 0.0}
+    if reference is None:
+        reference = _execute(
+            lambda: exec(code, {'__builtins__': builtins}), timeout)
+    factory = vm_factory or VirtualMachine
+    result = _execute(lambda: factory().run_code(code), timeout)
+    if result['error'] == 'timeout':
+        status = 'timeout'
+    elif result == reference:
+        status = 'pass'
+    else:
+        status = 'fail'
+    return {'path': path, 'status': status, 'reference': reference,
+            'result': result, 'elapsed': time.perf_counter() - start}
+
+
+def _hung_test(path, timeout):
+    """
+    итог теста, процесс которого не ответил за timeout секунд: сигнал
+    не прерывает код на C, который не возвращается в интерпретатор
+    """
+    hung = {'stdout': '', 'stderr': '', 'error': 'timeout'}
+    return {'path': path, 'status': 'timeout', 'reference': hung,
+            'result': hung, 'elapsed': timeout}
+
+
+def _load_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as cache:
+        try:
+            return json.load(cache)
+        except ValueError:
+            return {}
+
+
+def _save_cache(cache_file, references):
+    if cache_file is None:
+        return
+    with open(cache_file, 'w') as cache:
+        json.dump(references, cache)
+
+
+def report_failure(outcome, source, stream):
+    """
+    подробности упавшего теста: ожидаемый и полученный вывод и
+    дизассемблированный код
+    """
+    print_delimeter(stream)
+    print("{} {}".format(outcome['status'].upper(), outcome['path']),
+          file=stream)
+    for title, key in (("expected", 'reference'), ("vm", 'result')):
+        run = outcome[key]
+        print("{}: error={} stdout={!r} stderr={!r}".format(
+            title, run['error'], run['stdout'][-500:], run['stderr'][-500:]),
+            file=stream)
+    try:
+        dis.dis(compile(source, outcome['path'], 'exec'), file=stream)
+    except SyntaxError:
+        pass
+
+
+def run_tests(paths, workers=None, timeout=10.0, cache_file=REFERENCE_CACHE,
+              vm_factory=None, stream=None):
+    """
+    проверить, что виртуальная машина выполняет программы paths так же,
+    как exec: одинаковые stdout, stderr и тип исключения. тесты идут
+    параллельно в пуле из workers процессов (None - по числу
+    процессоров), каждый не дольше timeout секунд: сам тест прерывает
+    SIGALRM, а зависший в коде на C процесс - ожидание результата из
+    пула, после которого пул завершается. эталонный вывод
+    кэшируется в cache_file по хэшу исходника (None - без кэша).
+    vm_factory - функция уровня модуля, создающая машину, по умолчанию
+    VirtualMachine. по мере выполнения печатает по символу на тест
+    ('.' прошел, 'F' упал, 'T' время вышло, 'E' не компилируется),
+    в конце - подробности упавших. возвращает список упавших
+    """
+    stream = stream or sys.stdout
+    paths = list(paths)
+    references = _load_cache(cache_file)
+    sources = {}
+    tasks = []
+    for path in paths:
+        with open(path, encoding='utf-8') as test_file:
+            source = test_file.read()
+        sources[path] = source
+        tasks.append((path, source, references.get(source_hash(source)),
+                      timeout, vm_factory))
+    marks = {'pass': '.', 'fail': 'F', 'timeout': 'T', 'error': 'E'}
+    failures = []
+    start = time.perf_counter()
+    # в процессе пула по timeout на эталон и на машину, плюс запуск
+    wait = 2 * timeout + 1
+    with Pool(workers) as pool:
+        pending = [pool.apply_async(_check_test, (task,)) for task in tasks]
+        for done, (task, result) in enumerate(zip(tasks, pending), 1):
+            try:
+                outcome = result.get(wait)
+            except TimeoutError:
+                outcome = _hung_test(task[0], wait)
+            # эталон, не уложившийся во время, может уложиться в другой раз
+            if outcome['reference']['error'] != 'timeout':
+                references[source_hash(sources[outcome['path']])] = \
+                    outcome['reference']
+            if outcome['status'] != 'pass':
+                failures.append(outcome)
+            stream.write(marks[outcome['status']])
+            if done % 80 == 0:
+                stream.write("\n")
+            stream.flush()
+    stream.write("\n")
+    _save_cache(cache_file, references)
+    order = {path: index for index, path in enumerate(paths)}
+    failures.sort(key=lambda outcome: order[outcome['path']])
+    for outcome in failures:
+        report_failure(outcome, sources[outcome['path']], stream)
+    print("{} passed, {} failed of {} in {:.2f} s".format(
+        len(tasks) - len(failures), len(failures), len(tasks),
+        time.perf_counter() - start), file=stream)
+    return failures
@@ -1,355 +1,3320 @@
+import asyncio
+import builtins
 import dis
-import inspect
+import hashlib
+import json
+import marshal
+import mmap
 import opcode
+import os
 import sys
+import threading
 import operator
+import pickle
+import queue
 import types
-from functools import partial
-from time import sleep
+from array import array
+from collections import OrderedDict, deque
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from multiprocessing import Pool
+from itertools import chain, count
+from time import perf_counter
+from types import MethodType
 # import six
 
-from utils import run_vm
+from utils import discover_tests, run_tests
+
+
+# опкоды, аргумент которых - смещение инструкции для перехода
+JUMP_OPCODES = frozenset(dis.hasjrel + dis.hasjabs)
+RELATIVE_JUMP_OPCODES = frozenset(dis.hasjrel)
+
+# индекс, который обработчик возвращает, чтобы закончить выполнение фрейма
+RETURN_INDEX = sys.maxsize
+
+# бинарные операторы: аргумент их обработчиков - функция оператора
+BINARY_OPNAMES = tuple(name for name in opcode.opname
+                       if name.startswith(('BINARY_', 'INPLACE_')))
+
+
+# декодеры аргументов: по разобранному коду и индексу инструкции
+# возвращают аргумент, с которым будет вызываться обработчик
+def argval(code_info, index):
+    return code_info.commands.argval(index)
+
+
+def oparg(code_info, index):
+    return code_info.commands.args[index]
+
+
+def jump_target(code_info, index):
+    return code_info.jump_targets[index]
+
+
+def block_exit(code_info, index):
+    return code_info.exits.get(index)
+
+
+def compare_function(code_info, index):
+    return VirtualMachine.compare_functions[
+        code_info.commands.argval(index)]
+
+
+def name_cache(code_info, index):
+    return NameCache(code_info.commands.argval(index))
+
+
+def call_cache(code_info, index):
+    return CallCache(code_info.commands.args[index], index + 1)
+
+
+def following_index(code_info, index):
+    return index + 1
+
+
+def own_index(code_info, index):
+    return index
+
+
+def call_site(code_info, index):
+    # число аргументов и индекс, с которого вызвавший продолжит
+    return code_info.commands.args[index], index + 1
+
+
+def constant(value):
+    """
+    декодер, всегда возвращающий value
+    """
+    def decode(code_info, index):
+        return value
+    return decode
+
+
+class Commands(object):
+    """
+    инструкции объекта кода в компактном виде: параллельные массивы
+    опкодов array('B'), аргументов и смещений array('i'), прочитанные
+    прямо из co_code. EXTENDED_ARG сливается с инструкцией, к которой
+    относится; ее смещение - смещение первого префикса, туда ведут
+    переходы. аргумент перехода - смещение цели, как argval у dis.
+    значение аргумента считается по запросу (argval), константы,
+    которые добавил оптимизатор, дописываются в consts. номера строк
+    строятся по смещениям только при первом запросе (lines)
+    """
+    __slots__ = ('bytecode', 'opcodes', 'args', 'offsets', 'consts',
+                 'line_table')
+
+    def __init__(self, bytecode, opcodes, args, offsets, consts=()):
+        self.bytecode = bytecode
+        self.opcodes = opcodes
+        self.args = args
+        self.offsets = offsets
+        self.consts = bytecode.co_consts + tuple(consts)
+        self.line_table = None
+
+    @classmethod
+    def decode(cls, bytecode):
+        code = memoryview(bytecode.co_code)
+        # срез memoryview перебирается по байту; bytes array('i')
+        # прочитал бы как машинные целые
+        opcodes = array('B', code[::2])
+        args = array('i', code[1::2])
+        offsets = array('i', range(0, len(code), 2))
+        if opcode.EXTENDED_ARG in opcodes:
+            opcodes, args, offsets = cls._fold_extended_args(
+                opcodes, args, offsets)
+        end = len(code)
+        for index, op in enumerate(opcodes):
+            if op in RELATIVE_JUMP_OPCODES:
+                # смещение следующей инструкции
+                following = offsets[index + 1] if index + 1 < len(offsets) \
+                    else end
+                args[index] += following
+        return cls(bytecode, opcodes, args, offsets)
+
+    @staticmethod
+    def _fold_extended_args(opcodes, args, offsets):
+        folded_opcodes = array('B')
+        folded_args = array('i')
+        folded_offsets = array('i')
+        extended = 0
+        start = None
+        for op, arg, offset in zip(opcodes, args, offsets):
+            if start is None:
+                start = offset
+            arg |= extended
+            if op == opcode.EXTENDED_ARG:
+                extended = arg << 8
+                continue
+            folded_opcodes.append(op)
+            folded_args.append(arg)
+            folded_offsets.append(start)
+            extended = 0
+            start = None
+        return folded_opcodes, folded_args, folded_offsets
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def opname(self, index):
+        return opcode.opname[self.opcodes[index]]
+
+    def opnames(self):
+        opnames = opcode.opname
+        return [opnames[op] for op in self.opcodes]
+
+    def argval(self, index):
+        """
+        значение аргумента инструкции index, как argval у dis; у
+        FORMAT_VALUE - сам аргумент
+        """
+        op = self.opcodes[index]
+        if op < opcode.HAVE_ARGUMENT:
+            return None
+        arg = self.args[index]
+        if op in opcode.hasconst:
+            return self.consts[arg]
+        if op in opcode.hasname:
+            return self.bytecode.co_names[arg]
+        if op in opcode.haslocal:
+            return self.bytecode.co_varnames[arg]
+        if op in opcode.hasfree:
+            return (self.bytecode.co_cellvars +
+                    self.bytecode.co_freevars)[arg]
+        if op in opcode.hascompare:
+            return opcode.cmp_op[arg]
+        return arg
+
+    def replace(self, index, opname, argval=None):
+        """
+        заменить инструкцию index на opname с аргументом argval:
+        константой у LOAD_CONST, смещением цели у перехода
+        """
+        op = opcode.opmap[opname]
+        if op in opcode.hasconst:
+            self.consts += (argval,)
+            argval = len(self.consts) - 1
+        self.opcodes[index] = op
+        self.args[index] = argval or 0
+
+    def remove(self, removed):
+        """
+        вырезать инструкции с индексами из множества removed
+        """
+        kept = [index for index in range(len(self.opcodes))
+                if index not in removed]
+        self.opcodes = array('B', [self.opcodes[index] for index in kept])
+        self.args = array('i', [self.args[index] for index in kept])
+        self.offsets = array('i', [self.offsets[index] for index in kept])
+        self.line_table = None
+
+    def lines(self):
+        """
+        строка исходника каждой инструкции: последняя строка, которая
+        начинается не позже ее смещения. вырезанная инструкция отдает
+        свою строку следующей
+        """
+        if self.line_table is not None:
+            return self.line_table
+        starts = list(dis.findlinestarts(self.bytecode))
+        line = self.bytecode.co_firstlineno
+        position = 0
+        lines = array('i')
+        for offset in self.offsets:
+            while position < len(starts) and starts[position][0] <= offset:
+                line = starts[position][1]
+                position += 1
+            lines.append(line)
+        self.line_table = lines
+        return lines
+
+    def prepared(self):
+        """
+        массивы и добавленные константы в виде, который сохраняет
+        marshal, - для Commands.load
+        """
+        return (self.opcodes.tobytes(), self.args.tobytes(),
+                self.offsets.tobytes(),
+                self.consts[len(self.bytecode.co_consts):])
+
+    @classmethod
+    def load(cls, bytecode, prepared):
+        opcodes, args, offsets = array('B'), array('i'), array('i')
+        for values, data in zip((opcodes, args, offsets), prepared):
+            values.frombytes(data)
+        return cls(bytecode, opcodes, args, offsets, prepared[3])
+
+
+class CodeInfo(object):
+    """
+    разобранный объект кода: инструкции (см. Commands), таблицы переходов
+    и связанный код ops - пары (обработчик, декодированный аргумент).
+    строится один раз, чтобы выполнение не искало обработчик по имени
+    опкода и не разбирало аргументы.
+    prepared - результат prepared() другого CodeInfo того же кода
+    (например, из DiskCodeCache): тогда разбор, оптимизация и разбор
+    блоков пропускаются и остается только связывание.
+    handlers и exits - таблицы обработчиков исключений и выходов из
+    блоков (см. BlockResolver)
+    """
+    def __init__(self, bytecode, superinstructions=None, name_caches=False,
+                 optimizations=None, prepared=None, call_caches=False):
+        self.bytecode = bytecode
+        self.consts = bytecode.co_consts
+        self.names = bytecode.co_names
+        self.varnames = bytecode.co_varnames
+        if prepared is None:
+            self._prepare(optimizations)
+        else:
+            (commands, self.jump_targets, self.removed, self.handlers,
+             self.exits) = prepared
+            self.commands = Commands.load(bytecode, commands)
+        functions = VirtualMachine.functions
+        if name_caches or call_caches:
+            functions = dict(functions)
+        if name_caches:
+            functions.update(VirtualMachine.name_cache_functions)
+        if call_caches:
+            functions.update(VirtualMachine.call_cache_functions)
+        self.ops = self._link(functions)
+        # сколько последовательностей инструкций слито в суперинструкции;
+        # индекс суперинструкции -> индекс следующей за слитыми
+        self.fused = 0
+        self.fused_spans = {}
+        # индекс суперинструкции -> пара из ops, которую она заменила
+        self.unfused = {}
+        if superinstructions:
+            self._fuse(superinstructions)
+        self.binder = ArgumentBinder(bytecode)
+        # замыкания участков кода для VirtualMachine(closures=True)
+        self.closures = None
+
+    def _prepare(self, optimizations):
+        self.commands = commands = Commands.decode(self.bytecode)
+        # смещение инструкции -> ее индекс в commands
+        offset_to_index = {offset: index
+                           for index, offset in enumerate(commands.offsets)}
+        # индекс инструкции -> индекс цели перехода (None не для jump-ов)
+        self.jump_targets = [
+            offset_to_index[commands.args[index]]
+            if op in JUMP_OPCODES else None
+            for index, op in enumerate(commands.opcodes)]
+        # сколько инструкций удалили проходы оптимизатора
+        self.removed = 0
+        if optimizations:
+            self.removed = Optimizer(self, optimizations).run()
+        BlockResolver(self).run()
+
+    def prepared(self):
+        """
+        разобранные и оптимизированные инструкции в виде, который
+        сохраняет marshal, - для CodeInfo(..., prepared=...)
+        """
+        return (self.commands.prepared(), self.jump_targets, self.removed,
+                self.handlers, self.exits)
+
+    def instruction_lines(self):
+        """
+        строка исходника каждой инструкции (см. Commands.lines)
+        """
+        return self.commands.lines()
+
+    def _link(self, functions):
+        """
+        связать инструкции с обработчиками functions. выбор статический,
+        один раз при связывании: у частых операторов и сравнений свои
+        обработчики (см. VirtualMachine.compare_handlers), верные для
+        операндов любого типа. адаптивной специализации по типам
+        операндов во время выполнения и деоптимизации нет - защита типа
+        стоит дороже, чем экономит (см. _binary_add)
+        """
+        ops = []
+        opnames = self.commands.opnames()
+        for index, opname in enumerate(opnames):
+            entry = functions.get(opname)
+            if entry is None:
+                ops.append((VirtualMachine._unsupported, opname))
+            else:
+                handler, decode = entry
+                if opname == 'COMPARE_OP':
+                    # у частых сравнений свои обработчики
+                    handler = VirtualMachine.compare_handlers.get(
+                        self.commands.argval(index), handler)
+                elif opname == 'RETURN_VALUE' and \
+                        index in self.exits:
+                    # return внутри try с finally сначала выполняет finally
+                    handler, decode = VirtualMachine.finally_return
+                ops.append((handler, decode(self, index)))
+        return ops
+
+    def compiled(self):
+        """
+        замыкания участков кода (см. ClosureCompiler); компилируются при
+        первом обращении
+        """
+        if self.closures is None:
+            self.closures = ClosureCompiler(self).compile()
+        return self.closures
+
+    def _fuse(self, superinstructions):
+        """
+        заменить подряд идущие инструкции из таблицы superinstructions
+        (кортеж имен опкодов -> обработчик) одной суперинструкцией.
+        она встает на место первой инструкции и получает аргументы всех
+        слитых и индекс следующей за ними инструкции, который возвращает
+        как переход. остальные инструкции последовательности остаются
+        на месте, поэтому индексы не сдвигаются; внутрь
+        последовательности не должен вести ни один переход
+        """
+        targets = set(self.jump_targets)
+        # и внутрь диапазона, защищенного обработчиком, и из него
+        for start, end, target, level, kind in self.handlers:
+            targets.update((start, end, target))
+        lengths = sorted(set(map(len, superinstructions)), reverse=True)
+        opnames = self.commands.opnames()
+        index = 0
+        while index < len(opnames):
+            for length in lengths:
+                end = index + length
+                handler = superinstructions.get(tuple(opnames[index:end]))
+                if handler is None or not targets.isdisjoint(
+                        range(index + 1, end)):
+                    continue
+                args = tuple(arg for _, arg in self.ops[index:end])
+                self.unfused[index] = self.ops[index]
+                self.ops[index] = (handler, args + (end,))
+                self.fused += 1
+                self.fused_spans[index] = end
+                index = end
+                break
+            else:
+                index += 1
+
+
+class Optimizer(object):
+    """
+    конвейер проходов оптимизации над разобранными инструкциями
+    CodeInfo до связывания. проход - функция от оптимизатора, которая
+    заменяет инструкции на месте через replace и помечает лишние
+    в self.removed; после каждого прохода помеченные вырезаются, а цели
+    переходов пересчитываются. проходы повторяются, пока хоть один
+    что-то меняет: свертка сравнения делает условный переход
+    безусловным, а тот - код за собой мертвым
+    """
+    # наибольшие длина последовательности и число бит целого,
+    # которые свертка констант кладет в код
+    MAX_SIZE = 20
+    MAX_BITS = 128
+
+    # операции, которые сворачиваются над константами
+    FOLDABLE_OPNAMES = frozenset(
+        [name for name in BINARY_OPNAMES if name.startswith('BINARY_')] +
+        ['UNARY_POSITIVE', 'UNARY_NEGATIVE', 'UNARY_NOT', 'UNARY_INVERT',
+         'COMPARE_OP'])
+    FOLDABLE_COMPARES = frozenset(['<', '<=', '>', '>=', '==', '!=',
+                                   'in', 'not in'])
+    FOLDABLE_TYPES = (int, float, complex, str, bytes, tuple, frozenset,
+                      type(None))
+    UNCONDITIONAL_JUMPS = frozenset(['JUMP_ABSOLUTE', 'JUMP_FORWARD'])
+    # переходы, цель которых можно продвинуть по цепочке безусловных
+    THREADABLE_JUMPS = frozenset([
+        'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'POP_JUMP_IF_FALSE',
+        'POP_JUMP_IF_TRUE', 'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP'])
+    # после этих инструкций выполнение не идет к следующей
+    NO_FALLTHROUGH = frozenset(['RETURN_VALUE', 'JUMP_ABSOLUTE',
+                                'JUMP_FORWARD', 'CONTINUE_LOOP',
+                                'BREAK_LOOP', 'RAISE_VARARGS'])
+
+    def __init__(self, code_info, passes):
+        self.code_info = code_info
+        self.passes = [self.passes_by_name[name] for name in passes]
+        self.removed = set()
+
+    def run(self):
+        """
+        выполнить проходы и вернуть число удаленных инструкций
+        """
+        commands = self.code_info.commands
+        size = len(commands)
+        changed = True
+        while changed:
+            changed = False
+            for optimization in self.passes:
+                replaced = optimization(self)
+                changed = self._compact() or replaced or changed
+        return size - len(commands)
+
+    def targets(self):
+        """
+        индексы инструкций, на которые есть переходы
+        """
+        return set(target for target in self.code_info.jump_targets
+                   if target is not None)
+
+    def replace(self, index, opname, argval=None, target=None):
+        commands = self.code_info.commands
+        if target is not None:
+            argval = commands.offsets[target]
+        commands.replace(index, opname, argval)
+        self.code_info.jump_targets[index] = target
+
+    def _compact(self):
+        """
+        вырезать помеченные инструкции; переход на вырезанную ведет
+        к следующей оставшейся
+        """
+        removed = self.removed
+        if not removed:
+            return False
+        code_info = self.code_info
+        new_index = []
+        kept = 0
+        for index in range(len(code_info.commands) + 1):
+            new_index.append(kept)
+            if index not in removed:
+                kept += 1
+        code_info.commands.remove(removed)
+        code_info.jump_targets[:] = [
+            None if target is None else new_index[target]
+            for index, target in enumerate(code_info.jump_targets)
+            if index not in removed]
+        self.removed = set()
+        return True
+
+    def _is_const(self, index):
+        return (index >= 0 and index not in self.removed and
+                self.code_info.commands.opname(index) == 'LOAD_CONST')
+
+    def fold_constants(self):
+        """
+        заменить чистую операцию над константами ее результатом,
+        а условный переход по константе - безусловным или ничем
+        """
+        commands = self.code_info.commands
+        targets = self.targets()
+        replaced = False
+        for index, opname in enumerate(commands.opnames()):
+            if opname in self.FOLDABLE_OPNAMES:
+                arity = 1 if opname.startswith('UNARY_') else 2
+                first = index - arity
+                if not all(map(self._is_const, range(first, index))) or \
+                        not targets.isdisjoint(range(first + 1, index + 1)):
+                    continue
+                operands = [commands.argval(const)
+                            for const in range(first, index)]
+                folded = self._fold(index, operands)
+                if folded:
+                    self.replace(index, 'LOAD_CONST', folded[0])
+                    self.removed.update(range(first, index))
+            elif opname.startswith(('POP_JUMP_IF_', 'JUMP_IF_')) and \
+                    self._is_const(index - 1) and index not in targets:
+                value = commands.argval(index - 1)
+                if not isinstance(value, self.FOLDABLE_TYPES):
+                    continue
+                taken = bool(value) == opname.endswith(
+                    ('IF_TRUE', 'IF_TRUE_OR_POP'))
+                if not taken:
+                    self.removed.update((index - 1, index))
+                else:
+                    if opname.startswith('POP_'):
+                        self.removed.add(index - 1)
+                    self.replace(index, 'JUMP_ABSOLUTE',
+                                 target=self.code_info.jump_targets[index])
+                    replaced = True
+        return replaced
+
+    def _fold(self, index, operands):
+        """
+        вернуть (результат,), если операцию index над operands можно
+        выполнить заранее, иначе None
+        """
+        opname = self.code_info.commands.opname(index)
+        if not all(map(self._foldable_value, operands)) or (
+                opname == 'COMPARE_OP' and
+                self.code_info.commands.argval(index) not in
+                self.FOLDABLE_COMPARES):
+            return None
+        function = VirtualMachine.functions[opname][1](
+            self.code_info, index)
+        if len(operands) == 2 and not self._bounded(function, *operands):
+            return None
+        try:
+            result = function(*operands)
+        except Exception:
+            # ошибка должна случиться при выполнении, а не здесь
+            return None
+        if not self._foldable_value(result) or (
+                isinstance(result, (str, bytes, tuple, frozenset)) and
+                len(result) > self.MAX_SIZE) or (
+                isinstance(result, int) and
+                result.bit_length() > self.MAX_BITS):
+            return None
+        return (result,)
+
+    def _foldable_value(self, value):
+        if isinstance(value, (tuple, frozenset)):
+            return all(map(self._foldable_value, value))
+        return isinstance(value, self.FOLDABLE_TYPES)
+
+    def _bounded(self, function, left, right):
+        """
+        не построит ли операция огромное значение еще до проверки
+        результата
+        """
+        sequences = (str, bytes, tuple)
+        if function is operator.mul:
+            if isinstance(left, int) and isinstance(right, sequences):
+                left, right = right, left
+            if isinstance(left, sequences) and isinstance(right, int):
+                return len(left) * right <= self.MAX_SIZE
+        elif function is operator.pow:
+            if isinstance(left, int) and isinstance(right, int):
+                return right <= 0 or \
+                    left.bit_length() * right <= self.MAX_BITS
+        elif function is operator.lshift:
+            if isinstance(left, int) and isinstance(right, int):
+                return left.bit_length() + right <= self.MAX_BITS
+        elif function is operator.mod:
+            # форматирование может построить строку любой длины
+            return not isinstance(left, (str, bytes))
+        return True
+
+    def thread_jumps(self):
+        """
+        перенаправить переход на безусловный переход сразу к цели
+        последнего и убрать безусловные переходы на следующую инструкцию
+        """
+        opnames = self.code_info.commands.opnames()
+        jump_targets = self.code_info.jump_targets
+        replaced = False
+        for index, opname in enumerate(opnames):
+            if opname not in self.THREADABLE_JUMPS:
+                continue
+            target = jump_targets[index]
+            seen = set()
+            while opnames[target] in self.UNCONDITIONAL_JUMPS and \
+                    target not in seen:
+                seen.add(target)
+                target = jump_targets[target]
+            if target != jump_targets[index]:
+                self.replace(index, opname, target=target)
+                replaced = True
+            if opname in self.UNCONDITIONAL_JUMPS and \
+                    target == index + 1:
+                self.removed.add(index)
+        return replaced
+
+    def remove_dead_code(self):
+        """
+        убрать инструкции, недостижимые от начала кода
+        """
+        opnames = self.code_info.commands.opnames()
+        jump_targets = self.code_info.jump_targets
+        reachable = set()
+        pending = [0]
+        while pending:
+            index = pending.pop()
+            if index in reachable or index >= len(opnames):
+                continue
+            reachable.add(index)
+            if jump_targets[index] is not None:
+                pending.append(jump_targets[index])
+            if opnames[index] not in self.NO_FALLTHROUGH:
+                pending.append(index + 1)
+        self.removed.update(
+            set(range(len(opnames))) - reachable)
+        return False
+
+    def remove_push_pop(self):
+        """
+        убрать DUP_TOP или LOAD_CONST, значение которых тут же снимает
+        POP_TOP
+        """
+        opnames = self.code_info.commands.opnames()
+        targets = self.targets()
+        index = 1
+        while index < len(opnames):
+            if opnames[index] == 'POP_TOP' and \
+                    index not in targets and \
+                    index - 1 not in self.removed and \
+                    opnames[index - 1] in ('DUP_TOP', 'LOAD_CONST'):
+                self.removed.update((index - 1, index))
+                index += 1
+            index += 1
+        return False
+
+    # имя прохода -> проход, в порядке выполнения
+    passes_by_name = OrderedDict([
+        ('fold_constants', fold_constants),
+        ('thread_jumps', thread_jumps),
+        ('remove_dead_code', remove_dead_code),
+        ('remove_push_pop', remove_push_pop),
+    ])
+
+
+class BlockResolver(object):
+    """
+    разбор блоков SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY и SETUP_WITH
+    до связывания, чтобы при выполнении не было стека блоков. считает
+    высоту стека значений у каждой инструкции и строит:
+    code_info.handlers - таблицу обработчиков исключений: защищенный
+    диапазон индексов [start, end), индекс обработчика, высота стека,
+    до которой его срезать, и вид блока ('except' или 'finally'),
+    внутренние раньше внешних;
+    code_info.exits - для return, break, continue и END_FINALLY внутри
+    блоков: куда они выходят (см. обработчики этих инструкций).
+    потом SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY и POP_BLOCK
+    вырезаются: пока исключения нет, try ничего не стоит, а
+    исключение ищет обработчик по таблице
+    """
+    SETUP_KINDS = {
+        'SETUP_LOOP': 'loop',
+        'SETUP_EXCEPT': 'except',
+        'SETUP_FINALLY': 'finally',
+        # __exit__ вызывает обработчик, как finally
+        'SETUP_WITH': 'finally',
+    }
+    # SETUP_WITH остается: он вызывает __enter__
+    STRIPPED_OPNAMES = frozenset(['SETUP_LOOP', 'SETUP_EXCEPT',
+                                  'SETUP_FINALLY', 'POP_BLOCK'])
+    # сколько значений кладет на стек вход в обработчик: except
+    # получает прежнее и новое исключение по три значения, finally -
+    # одно значение Unwind или None
+    ENTRY_SIZES = {'loop': 0, 'except': 6, 'finally': 1}
+    # изменение высоты стека, если dis.stack_effect считает иначе;
+    # у переходов - когда перехода нет
+    STACK_EFFECTS = {
+        'SETUP_LOOP': 0,
+        'SETUP_EXCEPT': 0,
+        'SETUP_FINALLY': 0,
+        'SETUP_WITH': 1,
+        'WITH_CLEANUP_START': 0,
+        'POP_EXCEPT': -3,
+    }
+
+    def __init__(self, code_info):
+        self.code_info = code_info
+
+    def run(self):
+        code_info = self.code_info
+        depths = self.depths()
+        blocks = self.blocks(depths)
+        kept = self._strip()
+        code_info.handlers = sorted(
+            ((kept[start + 1], kept[end], kept[target], level, kind)
+             for kind, start, end, target, level in blocks
+             if kind != 'loop'),
+            key=lambda handler: (-handler[0], handler[1]))
+        code_info.exits = {}
+        for index, opname in enumerate(self.opnames):
+            if opname not in ('RETURN_VALUE', 'BREAK_LOOP', 'CONTINUE_LOOP',
+                              'END_FINALLY'):
+                continue
+            enclosing = [block for block in blocks
+                         if block[1] < index < block[2]]
+            enclosing.sort(key=lambda block: -block[1])
+            returns = loop = None
+            for kind, start, end, target, level in enclosing:
+                if kind == 'finally':
+                    returns = (kept[target], level)
+                    break
+            for kind, start, end, target, level in enclosing:
+                if kind != 'except':
+                    loop = (kind, kept[target], level)
+                    break
+            new_index = kept[index]
+            if opname == 'RETURN_VALUE':
+                if returns is not None:
+                    code_info.exits[new_index] = returns
+            elif opname == 'BREAK_LOOP':
+                code_info.exits[new_index] = loop
+                code_info.jump_targets[new_index] = loop[1]
+            elif opname == 'CONTINUE_LOOP':
+                start = self.jump_targets[index]
+                code_info.exits[new_index] = (loop, kept[start],
+                                              depths[start])
+            else:
+                code_info.exits[new_index] = (returns, loop)
+
+    def _stack_effect(self, index, opname):
+        effect = self.STACK_EFFECTS.get(opname)
+        if effect is not None:
+            return effect
+        op = self.code_info.commands.opcodes[index]
+        if op < opcode.HAVE_ARGUMENT:
+            return dis.stack_effect(op)
+        return dis.stack_effect(op, self.code_info.commands.args[index])
+
+    def depths(self):
+        """
+        высота стека значений перед каждой инструкцией (None у
+        недостижимых). обычные пути обходятся раньше входов в
+        обработчики и выхода из END_FINALLY: в конце цепочки except
+        END_FINALLY всегда бросает исключение, а код после нее
+        приходит с высотой обычного пути
+        """
+        opnames = self.code_info.commands.opnames()
+        jump_targets = self.code_info.jump_targets
+        depths = [None] * len(opnames)
+        pending = [(0, 0)]
+        deferred = deque()
+        while pending or deferred:
+            index, depth = pending.pop() if pending else deferred.popleft()
+            if index >= len(opnames) or depths[index] is not None:
+                continue
+            depths[index] = depth
+            opname = opnames[index]
+            target = jump_targets[index]
+            if opname in self.SETUP_KINDS:
+                kind = self.SETUP_KINDS[opname]
+                deferred.append((target, depth + self.ENTRY_SIZES[kind]))
+                pending.append((index + 1, depth + self.STACK_EFFECTS[opname]))
+            elif opname == 'FOR_ITER':
+                pending.append((target, depth - 1))
+                pending.append((index + 1, depth + 1))
+            elif opname in ('JUMP_IF_TRUE_OR_POP', 'JUMP_IF_FALSE_OR_POP'):
+                pending.append((target, depth))
+                pending.append((index + 1, depth - 1))
+            elif opname == 'END_FINALLY':
+                deferred.append((index + 1, depth - 1))
+            elif opname in Optimizer.NO_FALLTHROUGH:
+                if target is not None:
+                    pending.append((target, depth))
+            else:
+                depth += self._stack_effect(index, opname)
+                if target is not None:
+                    pending.append((target, depth))
+                pending.append((index + 1, depth))
+        return depths
+
+    def blocks(self, depths):
+        """
+        блоки кода: [вид, индекс SETUP, конец, цель, высота стека].
+        except и finally защищают инструкции между SETUP и своим
+        обработчиком, цикл - до своего POP_BLOCK: после него идет else
+        цикла, и break в нем относится уже к внешнему циклу. POP_BLOCK
+        цикла - первый после SETUP, который не лежит внутри вложенного
+        блока; если оптимизатор убрал его как мертвый, цикл защищает
+        все до своей цели
+        """
+        opnames = self.code_info.commands.opnames()
+        jump_targets = self.code_info.jump_targets
+        blocks = [[self.SETUP_KINDS[opname], index,
+                   jump_targets[index], jump_targets[index],
+                   depths[index] or 0]
+                  for index, opname in enumerate(opnames)
+                  if opname in self.SETUP_KINDS]
+        pop_blocks = [index for index, opname in enumerate(opnames)
+                      if opname == 'POP_BLOCK']
+        # вложенные циклы раньше внешних
+        for block in reversed(blocks):
+            kind, start, end, target, level = block
+            if kind != 'loop':
+                continue
+            for pop_index in pop_blocks:
+                if start < pop_index < target and not any(
+                        start < other[1] < pop_index <= other[2]
+                        for other in blocks):
+                    block[2] = pop_index
+                    break
+        return blocks
+
+    def _strip(self):
+        """
+        вырезать инструкции блоков и вернуть новый индекс каждой
+        старой; вырезанная отображается в следующую оставшуюся, ее
+        номер строки переходит к ней же (см. Commands.lines)
+        """
+        code_info = self.code_info
+        self.opnames = opnames = code_info.commands.opnames()
+        self.jump_targets = jump_targets = code_info.jump_targets
+        kept = []
+        stripped = set()
+        count = 0
+        for index, opname in enumerate(opnames):
+            kept.append(count)
+            if opname in self.STRIPPED_OPNAMES:
+                stripped.add(index)
+            else:
+                count += 1
+        kept.append(count)
+        code_info.commands.remove(stripped)
+        code_info.jump_targets = [
+            None if target is None else kept[target]
+            for index, target in enumerate(jump_targets)
+            if index not in stripped]
+        return kept
+
+
+# флаги co_flags объекта кода
+CO_OPTIMIZED = 0x01
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
+CO_GENERATOR = 0x20
+# корутины и асинхронные генераторы виртуальная машина пока не выполняет
+CO_COROUTINES = 0x80 | 0x100 | 0x200
+
+# значение еще не присвоенной локальной переменной или пустой ячейки
+UNBOUND = object()
+
+
+class ArgumentBinder(object):
+    """
+    раскладка аргументов вызова по слотам локальных переменных
+    (индексам co_varnames), посчитанная один раз по объекту кода
+    """
+    def __init__(self, bytecode):
+        self.name = bytecode.co_name
+        self.varnames = bytecode.co_varnames
+        self.argcount = bytecode.co_argcount
+        kwonly_end = bytecode.co_argcount + bytecode.co_kwonlyargcount
+        self.kwonly_range = range(self.argcount, kwonly_end)
+        # имя аргумента -> индекс его слота
+        self.keyword_index = {}
+        for index, name in enumerate(bytecode.co_varnames[:kwonly_end]):
+            self.keyword_index[name] = index
+        extra = kwonly_end
+        self.varargs_index = None
+        if bytecode.co_flags & CO_VARARGS:
+            self.varargs_index = extra
+            extra += 1
+        self.varkw_index = None
+        if bytecode.co_flags & CO_VARKEYWORDS:
+            self.varkw_index = extra
+            extra += 1
+        # вызов, который раскладывается простым копированием args
+        self.simple = (self.varargs_index is None and
+                       self.varkw_index is None and not self.kwonly_range)
+        # слоты остальных локальных переменных для простого вызова
+        self.padding = (UNBOUND,) * (len(bytecode.co_varnames) -
+                                     self.argcount)
+        # аргументы, которые живут в ячейках замыкания:
+        # (индекс ячейки, индекс слота)
+        self.cell_args = [
+            (index, bytecode.co_varnames.index(name))
+            for index, name in enumerate(bytecode.co_cellvars)
+            if name in bytecode.co_varnames[:extra]
+        ]
+
+    def bind(self, function, args, kwargs):
+        """
+        вернуть слоты локальных переменных для вызова
+        function(*args, **kwargs)
+        """
+        if self.simple and not kwargs and len(args) == self.argcount:
+            return [*args, *self.padding]
+        argcount = self.argcount
+        fast_locals = [UNBOUND] * len(self.varnames)
+        given = len(args)
+        fast_locals[:min(given, argcount)] = args[:argcount]
+        if self.varargs_index is not None:
+            fast_locals[self.varargs_index] = tuple(args[argcount:])
+        if self.varkw_index is not None:
+            extra_kwargs = {}
+            fast_locals[self.varkw_index] = extra_kwargs
+        for key, value in kwargs.items():
+            index = self.keyword_index.get(key)
+            if index is not None:
+                if fast_locals[index] is not UNBOUND:
+                    raise TypeError(
+                        "{}() got multiple values for argument '{}'"
+                        .format(self.name, key))
+                fast_locals[index] = value
+            elif self.varkw_index is not None:
+                extra_kwargs[key] = value
+            else:
+                raise TypeError(
+                    "{}() got an unexpected keyword argument '{}'"
+                    .format(self.name, key))
+        if given > argcount and self.varargs_index is None:
+            # как в CPython, после именованных: их число входит в текст
+            self._too_many_positional(function, given, fast_locals)
+        missing = []
+        if given < argcount:
+            defaults = function.__defaults__ or ()
+            first_default = argcount - len(defaults)
+            for index in range(given, argcount):
+                if fast_locals[index] is not UNBOUND:
+                    continue
+                if index >= first_default:
+                    fast_locals[index] = defaults[index - first_default]
+                else:
+                    missing.append(self.varnames[index])
+        if missing:
+            self._missing('positional', missing)
+        for index in self.kwonly_range:
+            if fast_locals[index] is UNBOUND:
+                kwdefaults = function.__kwdefaults__ or {}
+                name = self.varnames[index]
+                if name in kwdefaults:
+                    fast_locals[index] = kwdefaults[name]
+                else:
+                    missing.append(name)
+        if missing:
+            self._missing('keyword-only', missing)
+        return fast_locals
+
+    def _too_many_positional(self, function, given, fast_locals):
+        """
+        TypeError о лишних позиционных аргументах с текстом CPython
+        """
+        argcount = self.argcount
+        defaults = function.__defaults__ or ()
+        if defaults:
+            takes = "from {} to {}".format(argcount - len(defaults),
+                                           argcount)
+        else:
+            takes = str(argcount)
+        kwonly_given = sum(1 for index in self.kwonly_range
+                           if fast_locals[index] is not UNBOUND)
+        given_text = str(given)
+        if kwonly_given:
+            given_text += (
+                " positional argument{} (and {} keyword-only argument{})"
+                .format("s" if given != 1 else "", kwonly_given,
+                        "s" if kwonly_given != 1 else ""))
+        raise TypeError(
+            "{}() takes {} positional argument{} but {} {} given".format(
+                self.name, takes,
+                "s" if defaults or argcount != 1 else "", given_text,
+                "was" if given == 1 and not kwonly_given else "were"))
+
+    def _missing(self, kind, names):
+        """
+        TypeError о недостающих аргументах вида kind с текстом CPython:
+        'a', 'a' and 'b', 'a', 'b', and 'c'
+        """
+        quoted = [repr(name) for name in names]
+        if len(quoted) == 1:
+            listed = quoted[0]
+        elif len(quoted) == 2:
+            listed = "{} and {}".format(*quoted)
+        else:
+            listed = "{}, and {}".format(", ".join(quoted[:-1]), quoted[-1])
+        raise TypeError("{}() missing {} required {} argument{}: {}".format(
+            self.name, len(names), kind, "s" if len(names) != 1 else "",
+            listed))
+
+    def layout(self, function, positional, kwnames=()):
+        """
+        раскладка вызова function с positional позиционными аргументами
+        и именованными kwnames без bind: кортеж order, такой что слот i
+        получает values[order[i]], где values - значения аргументов в
+        порядке стека, а за ними function.__defaults__; остальные слоты
+        - self.padding. None - так вызов не разложить: у функции
+        *args, **kwargs или аргументы только по имени, или вызов
+        ошибочен, и ошибку скажет bind
+        """
+        argcount = self.argcount
+        if not self.simple or positional > argcount:
+            return None
+        defaults = function.__defaults__ or ()
+        first_default = argcount - len(defaults)
+        given = positional + len(kwnames)
+        order = list(range(positional)) + [None] * (argcount - positional)
+        for offset, name in enumerate(kwnames):
+            index = self.keyword_index.get(name)
+            if index is None or index < positional or \
+                    order[index] is not None:
+                return None
+            order[index] = positional + offset
+        for index in range(positional, argcount):
+            if order[index] is None:
+                if index < first_default:
+                    return None
+                order[index] = given + index - first_default
+        return tuple(order)
+
+
+class Cell(object):
+    """
+    ячейка замыкания: переменная, общая для функции и вложенных в нее
+    """
+    __slots__ = ('contents',)
+
+    def __init__(self, contents=UNBOUND):
+        self.contents = contents
+
+
+# источник версий пространств имен: номер не повторяется, поэтому
+# совпадение версии означает то же пространство имен с тем же набором имен
+namespace_versions = count(1)
+
+
+class NamespaceVersion(object):
+    """
+    версия словаря имен модуля или тела класса: меняется, когда
+    виртуальная машина добавляет в словарь имя или удаляет его (запись
+    значения существующего имени версию не меняет). None - словарь
+    доступен коду вне виртуальной машины, и его изменения не отследить
+    """
+    __slots__ = ('version',)
+
+    def __init__(self):
+        self.version = next(namespace_versions)
+
+    def changed(self):
+        if self.version is not None:
+            self.version = next(namespace_versions)
+
+    def untrack(self):
+        self.version = None
+
+
+class NameCache(object):
+    """
+    встроенный кэш инструкции LOAD_NAME или LOAD_GLOBAL: версии
+    локального и глобального пространств имен, при которых имя было
+    найдено, и словарь, в котором оно нашлось. словарь встроенных имен
+    не версионируется: имя, которое из него удалили, даст промах
+    """
+    __slots__ = ('name', 'locals_version', 'globals_version', 'namespace',
+                 'hits', 'misses', 'invalidations')
+
+    def __init__(self, name):
+        self.name = name
+        # 0 не бывает версией: пустой кэш не совпадет ни с чем
+        self.locals_version = 0
+        self.globals_version = 0
+        self.namespace = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return self.name
+
+
+# сколько раз место вызова может сменить вызываемое, прежде чем
+# навсегда остаться на общем пути
+CALL_CACHE_RETRIES = 4
+
+
+class CallCache(object):
+    """
+    встроенный кэш инструкции CALL_FUNCTION, CALL_FUNCTION_KW или
+    CALL_FUNCTION_EX: вид вызываемого, определенный при первом вызове,
+    и то, что нужно быстрому пути этого вида. kind:
+        'builtin' - не функция машины: проверяется только тип callee,
+            вызов - как в _call_function;
+        'function' - функция виртуальной машины с кодом code: слоты
+            ее фрейма собираются по order (см. ArgumentBinder.layout)
+            прямо со стека, а если раскладки нет - через bind;
+        'method' - метод такой функции, первым аргументом идет
+            __self__;
+        'class' - класс без метакласса, у которого __new__ от object,
+            а __init__ - такая функция;
+        'generic' - вызываемое менялось больше CALL_CACHE_RETRIES
+            раз, место вызова больше не специализируется;
+        None - вызова еще не было.
+    у функции при каждом вызове сверяются __code__ и __defaults__, от
+    которых зависит раскладка, но не она сама: def в цикле каждый раз
+    создает новую функцию с теми же кодом и кортежем умолчаний
+    """
+    __slots__ = ('argc', 'call', 'kind', 'callee_type', 'code',
+                 'defaults', 'code_info', 'order', 'tail', 'names',
+                 'hits', 'misses', 'invalidations')
+
+    def __init__(self, argc, resume):
+        # аргумент инструкции: число аргументов или флаги
+        # CALL_FUNCTION_EX
+        self.argc = argc
+        # аргумент _call_frame, _call_frame_kw или _call_frame_ex для
+        # общего пути
+        self.call = (argc, resume)
+        self.kind = None
+        # тип вызываемого
+        self.callee_type = None
+        self.code = None
+        self.defaults = None
+        self.code_info = None
+        self.order = None
+        # для CALL_FUNCTION, которому хватает среза стека: недостающие
+        # умолчания и остальные слоты
+        self.tail = None
+        # имена именованных аргументов CALL_FUNCTION_KW, для которых
+        # посчитан order
+        self.names = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return str(self.argc)
+
+
+class CodeCache(object):
+    """
+    кэш CodeInfo по объекту кода с вытеснением давно не использованных,
+    чтобы повторные фреймы одной функции не разбирали байткод заново.
+    superinstructions - таблица слияния инструкций для CodeInfo,
+    None - VirtualMachine.superinstructions, пустая таблица отключает
+    слияние. name_caches - связывать LOAD_NAME и LOAD_GLOBAL со
+    встроенными кэшами имен (см. VirtualMachine.name_cache_functions),
+    call_caches - вызовы с кэшами вызовов (см.
+    VirtualMachine.call_cache_functions).
+    optimizations - имена проходов Optimizer в порядке выполнения,
+    None - все Optimizer.passes_by_name, пустой кортеж отключает
+    оптимизацию
+    """
+    def __init__(self, max_size=512, superinstructions=None,
+                 name_caches=False, optimizations=None, call_caches=False):
+        self.max_size = max_size
+        self.superinstructions = superinstructions
+        self.optimizations = optimizations
+        self.name_caches = name_caches
+        self.call_caches = call_caches
+        # id(bytecode) -> (bytecode, CodeInfo); ссылка на bytecode
+        # не дает переиспользовать id, пока запись в кэше
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, bytecode):
+        """
+        вернуть CodeInfo для bytecode, разобрав его при промахе
+        """
+        key = id(bytecode)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        return self.put(bytecode, self.build(bytecode))
+
+    def optimization_passes(self):
+        if self.optimizations is None:
+            return tuple(Optimizer.passes_by_name)
+        return tuple(self.optimizations)
+
+    def build(self, bytecode, prepared=None):
+        """
+        CodeInfo для bytecode с настройками этого кэша
+        """
+        superinstructions = self.superinstructions
+        if superinstructions is None:
+            superinstructions = VirtualMachine.superinstructions
+        return CodeInfo(bytecode, superinstructions, self.name_caches,
+                        self.optimization_passes(), prepared,
+                        self.call_caches)
+
+    def put(self, bytecode, code_info):
+        self.entries[id(bytecode)] = (bytecode, code_info)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return code_info
+
+    def name_cache_stats(self):
+        """
+        сумма счетчиков встроенных кэшей имен закэшированного кода
+        """
+        return self._inline_cache_stats(NameCache)
+
+    def call_cache_stats(self):
+        """
+        сумма счетчиков встроенных кэшей вызовов закэшированного кода
+        """
+        return self._inline_cache_stats(CallCache)
+
+    def removed_instructions(self):
+        """
+        объект кода -> сколько инструкций из него удалил оптимизатор,
+        для закэшированного кода, где удалено хоть что-то
+        """
+        return {bytecode: code_info.removed
+                for bytecode, code_info in self.entries.values()
+                if code_info.removed}
+
+    def _inline_cache_stats(self, cache_type):
+        """
+        счетчики кэшей cache_type по аргументам всех инструкций. у
+        суперинструкции берется аргумент первой слитой инструкции из
+        code_info.unfused: аргументы остальных лежат на их местах в ops
+        """
+        stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        for _, code_info in self.entries.values():
+            for index, op in enumerate(code_info.ops):
+                _, arg = code_info.unfused.get(index, op)
+                if isinstance(arg, cache_type):
+                    stats['hits'] += arg.hits
+                    stats['misses'] += arg.misses
+                    stats['invalidations'] += arg.invalidations
+        return stats
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def code_objects(bytecode):
+    """
+    bytecode и все вложенные в его константы объекты кода, в глубину
+    """
+    yield bytecode
+    for const in bytecode.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from code_objects(const)
+
+
+class DiskCodeCache(object):
+    """
+    каталог с уже скомпилированными исходниками: в файле лежат
+    объект кода модуля и prepared() всех его объектов кода, так что
+    при повторном запуске остаются только чтение и связывание.
+    ключ файла - хэш исходника, имени файла, версии интерпретатора,
+    текста vm.py и проходов оптимизатора; он же записан в заголовке,
+    по которому файл проверяется до разбора. файл читается через mmap
+    """
+    MAGIC = b'VMC3'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        with open(__file__, 'rb') as vm_source:
+            self.vm_digest = hashlib.sha1(vm_source.read()).hexdigest()
+        # ключ -> объект кода, уже загруженный в этом процессе
+        self.loaded = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, filename, code_cache):
+        parts = (source, filename, sys.version, self.vm_digest,
+                 repr(code_cache.optimization_passes()))
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def compile(self, source, filename, code_cache):
+        """
+        объект кода для source; его CodeInfo и CodeInfo вложенного кода
+        кладутся в code_cache
+        """
+        key = self.key(source, filename, code_cache)
+        bytecode = self.loaded.get(key)
+        if bytecode is not None:
+            return bytecode
+        path = os.path.join(self.directory, key + '.vmc')
+        header = self.MAGIC + key.encode('ascii')
+        stored = self._read(path, header)
+        if stored is None:
+            self.misses += 1
+            bytecode = compile(source, filename, 'exec')
+            tables = [code_cache.get(code).prepared()
+                      for code in code_objects(bytecode)]
+            self._write(path, header, (bytecode, tables))
+        else:
+            self.hits += 1
+            bytecode, tables = stored
+            for code, prepared in zip(code_objects(bytecode), tables):
+                code_cache.put(code, code_cache.build(code, prepared))
+        self.loaded[key] = bytecode
+        return bytecode
+
+    @staticmethod
+    def _read(path, header):
+        try:
+            with open(path, 'rb') as stored, mmap.mmap(
+                    stored.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(header)] != header:
+                    return None
+                with memoryview(data) as view, \
+                        view[len(header):] as body:
+                    return marshal.loads(body)
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+
+    @staticmethod
+    def _write(path, header, stored):
+        # запись через временный файл: читатель не увидит половину файла
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as output:
+            output.write(header)
+            marshal.dump(stored, output)
+        os.replace(temporary, path)
+
+
+# общий для всего процесса кэш разобранного кода
+code_cache = CodeCache()
+
+
+class CodeProfile(object):
+    """
+    счетчики профилировщика для одного объекта кода: по индексу
+    связанной инструкции число выполнений и время с вложенными вызовами,
+    переходы назад (индекс перехода, цель) -> число, и итоги вызовов
+    """
+    __slots__ = ('code_info', 'counts', 'times', 'back_edges', 'calls',
+                 'primitive_calls', 'own_time', 'total_time', 'callers')
+
+    def __init__(self, code_info):
+        self.code_info = code_info
+        self.counts = [0] * len(code_info.ops)
+        self.times = [0.0] * len(code_info.ops)
+        self.back_edges = {}
+        self.calls = 0
+        # вызовы не из самого себя: время вложенных рекурсивных
+        # вызовов уже входит во время внешнего
+        self.primitive_calls = 0
+        self.own_time = 0.0
+        self.total_time = 0.0
+        # CodeProfile вызывающего -> [calls, primitive_calls,
+        # own_time, total_time] вызовов из него, порядок как у pstats
+        self.callers = {}
+
+    def key(self):
+        """
+        ключ функции в формате pstats
+        """
+        bytecode = self.code_info.bytecode
+        return (bytecode.co_filename, bytecode.co_firstlineno,
+                bytecode.co_name)
+
+    def labels(self):
+        """
+        имя опкода каждой связанной инструкции; у суперинструкции -
+        имена слитых через '+'
+        """
+        opnames = self.code_info.commands.opnames()
+        spans = self.code_info.fused_spans
+        return ['+'.join(opnames[index:spans[index]])
+                if index in spans else opname
+                for index, opname in enumerate(opnames)]
+
+    def lines(self):
+        return self.code_info.instruction_lines()
+
+
+class Profiler(object):
+    """
+    профилировщик выполнения для VirtualMachine(profiler=...): число
+    выполнений и время каждого опкода, итоги по объектам кода и строкам
+    исходника, горячие переходы назад. время инструкции включает
+    вызовы, которые она сделала; собственное время объекта кода - без
+    вложенных фреймов. выгружается в JSON (dump_json) и в формат
+    pstats (dump_stats, или pstats.Stats(profiler))
+    """
+    def __init__(self, timer=perf_counter):
+        self.timer = timer
+        # CodeInfo -> CodeProfile
+        self.profiles = {}
+        # выполняемые фреймы: [CodeProfile, время входа, время вложенных]
+        self.running = []
+        self.stats = {}
+
+    def enter(self, code_info):
+        profile = self.profiles.get(code_info)
+        if profile is None:
+            profile = self.profiles[code_info] = CodeProfile(code_info)
+        self.running.append([profile, self.timer(), 0.0])
+        return profile
+
+    def exit(self):
+        profile, start, nested = self.running.pop()
+        total = self.timer() - start
+        primitive = all(entry[0] is not profile for entry in self.running)
+        profile.calls += 1
+        profile.own_time += total - nested
+        if primitive:
+            profile.primitive_calls += 1
+            profile.total_time += total
+        if self.running:
+            caller = self.running[-1]
+            caller[2] += total
+            stats = profile.callers.get(caller[0])
+            if stats is None:
+                stats = profile.callers[caller[0]] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += primitive
+            stats[2] += total - nested
+            if primitive:
+                stats[3] += total
+
+    def opcode_stats(self):
+        """
+        имя опкода -> {'count': выполнений, 'time': секунд}
+        """
+        stats = {}
+        for profile in self.profiles.values():
+            for label, executed, elapsed in zip(
+                    profile.labels(), profile.counts, profile.times):
+                if executed:
+                    entry = stats.setdefault(label, {'count': 0, 'time': 0.0})
+                    entry['count'] += executed
+                    entry['time'] += elapsed
+        return stats
+
+    def line_stats(self):
+        """
+        (файл, строка) -> {'count': инструкций, 'time': секунд}
+        """
+        stats = {}
+        for profile in self.profiles.values():
+            filename = profile.code_info.bytecode.co_filename
+            for line, executed, elapsed in zip(
+                    profile.lines(), profile.counts, profile.times):
+                if executed:
+                    entry = stats.setdefault((filename, line),
+                                             {'count': 0, 'time': 0.0})
+                    entry['count'] += executed
+                    entry['time'] += elapsed
+        return stats
+
+    def hot_back_edges(self, limit=None):
+        """
+        переходы назад от самых частых:
+        (ключ кода, строка перехода, строка цели, число)
+        """
+        edges = []
+        for profile in self.profiles.values():
+            lines = profile.lines()
+            for (source, target), taken in profile.back_edges.items():
+                edges.append((profile.key(), lines[source], lines[target],
+                              taken))
+        edges.sort(key=lambda edge: edge[3], reverse=True)
+        return edges[:limit]
+
+    def as_dict(self):
+        """
+        все счетчики в виде, пригодном для json
+        """
+        def name(key):
+            return "{}:{}({})".format(*key)
+        return {
+            'opcodes': self.opcode_stats(),
+            'code': {
+                name(profile.key()): {
+                    'calls': profile.calls,
+                    'instructions': sum(profile.counts),
+                    'own_time': profile.own_time,
+                    'total_time': profile.total_time,
+                }
+                for profile in self.profiles.values()
+            },
+            'lines': {
+                "{}:{}".format(*key): entry
+                for key, entry in self.line_stats().items()
+            },
+            'back_edges': [
+                {'code': name(key), 'line': line, 'target_line': target,
+                 'count': taken}
+                for key, line, target, taken in self.hot_back_edges()
+            ],
+        }
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as output:
+            json.dump(self.as_dict(), output, indent=2, sort_keys=True)
+
+    def create_stats(self):
+        """
+        заполнить self.stats так же, как cProfile.Profile, - этого ждет
+        pstats.Stats(profiler)
+        """
+        self.stats = {}
+        for profile in self.profiles.values():
+            callers = {caller.key(): tuple(stats)
+                       for caller, stats in profile.callers.items()}
+            self.stats[profile.key()] = (
+                profile.primitive_calls, profile.calls, profile.own_time,
+                profile.total_time, callers)
+
+    def dump_stats(self, filename):
+        """
+        записать статистику в файл, который читает pstats.Stats(filename)
+        """
+        self.create_stats()
+        with open(filename, 'wb') as output:
+            marshal.dump(self.stats, output)
+
+
+class SamplingProfiler(object):
+    """
+    выборочный профилировщик: фоновый поток раз в interval секунд
+    снимает стек фреймов виртуальной машины в потоке, который вызвал
+    start, и считает одинаковые стеки. стек восстанавливается по
+    фреймам CPython, выполняющим цикл машины: в них видны Frame и индекс
+    инструкции, так что сама машина для выборки ничего не делает.
+    результат - свернутые стеки (collapsed stacks) для flamegraph.pl,
+    speedscope и подобных. поток выборки ждет GIL, поэтому выборок
+    не больше, чем позволяет sys.getswitchinterval()
+
+        with SamplingProfiler() as sampler:
+            vm.run_code(code)
+        sampler.dump_collapsed('vm.folded')
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # стек - кортеж "имя (файл:строка)" от внешнего фрейма -> выборок
+        self.samples = {}
+        # CodeInfo -> строки его инструкций
+        self.lines = {}
+        self.run_loops = frozenset([
+            VirtualMachine._run_frame.__code__,
+            VirtualMachine._run_frame_profiled.__code__,
+            VirtualMachine._run_frame_compiled.__code__,
+            VirtualMachine._run_slice.__code__,
+        ])
+        self.target = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        снять один стек потока self.target
+        """
+        python_frame = sys._current_frames().get(self.target)
+        stack = []
+        while python_frame is not None:
+            if python_frame.f_code in self.run_loops:
+                variables = python_frame.f_locals
+                frame = variables['frame']
+                stack.append(self._location(frame,
+                                            variables.get('index', 0)))
+                # вызвавшие фреймы, которые выполняет этот же цикл:
+                # у _run_slice - task.frames, у _run_frame - от entry.
+                # у _run_frame список общий, и выше frame лежат фреймы
+                # вложенных циклов: их снимут сами эти циклы
+                frames = variables.get('frames', [])
+                entry = variables.get('entry', 0)
+                try:
+                    end = frames.index(frame, entry)
+                except ValueError:
+                    # frame уже снят со стека при возврате
+                    end = entry
+                for caller in reversed(frames[entry:end]):
+                    stack.append(self._location(caller,
+                                                caller.command_id))
+            python_frame = python_frame.f_back
+        if stack:
+            stack = tuple(reversed(stack))
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def _location(self, frame, index):
+        code_info = frame.code_info
+        lines = self.lines.get(code_info)
+        if lines is None:
+            lines = self.lines[code_info] = code_info.instruction_lines()
+        # цикл уже увеличил index: выполняется предыдущая инструкция
+        line = lines[min(max(index - 1, 0), len(lines) - 1)]
+        bytecode = code_info.bytecode
+        return "{} ({}:{})".format(bytecode.co_name, bytecode.co_filename,
+                                   line)
+
+    def collapsed(self):
+        """
+        строки "внешний;...;внутренний число_выборок"
+        """
+        return ["{} {}".format(";".join(stack), samples)
+                for stack, samples in sorted(self.samples.items())]
+
+    def dump_collapsed(self, filename):
+        with open(filename, 'w') as output:
+            for line in self.collapsed():
+                output.write(line + "\n")
 
 
 class Frame(object):
+    __slots__ = ('bytecode', 'back_frame', 'global_names', 'local_names',
+                 'globals_version', 'locals_version', 'fast_locals', 'cells',
+                 'builtins_names', 'command_id', 'code_info', 'ops', 'stack',
+                 'yield_index', 'back_exception')
+
     def __init__(self, bytecode, back_frame=None, global_names=None,
-                 local_names=None):
+                 local_names=None, code_info=None, fast_locals=None,
+                 globals_version=None):
         self.bytecode = bytecode
         self.back_frame = back_frame
         self.global_names = global_names if global_names is not None else {}
-        self.global_names.update({'__builtins__': __builtins__})
-        self.local_names = local_names if local_names is not None else {}
-        self.local_names.update({'__builtins__': __builtins__})
+        if globals_version is None:
+            globals_version = NamespaceVersion()
+        self.globals_version = globals_version
+        # словарь локальных имен есть у модуля и тела класса,
+        # локальные переменные функции лежат в слотах fast_locals
+        locals_version = None
+        if local_names is self.global_names:
+            # модуль: STORE_NAME меняет тот же словарь, что видит
+            # LOAD_GLOBAL функций, и версия у них должна быть общей
+            locals_version = globals_version
+        elif local_names is not None:
+            locals_version = NamespaceVersion()
+        elif not bytecode.co_flags & CO_OPTIMIZED:
+            local_names = self.global_names
+            locals_version = globals_version
+        self.local_names = local_names
+        self.locals_version = locals_version
+        self.fast_locals = fast_locals if fast_locals is not None else []
+        # ячейки co_cellvars, затем co_freevars
+        self.cells = ()
+        # у каждого фрейма свой стек значений; стека блоков нет, блоки
+        # разобраны заранее (см. BlockResolver)
+        self.stack = []
+        # индекс инструкции, с которой продолжить выполнение, и, пока
+        # фрейм генератора приостановлен, индекс возобновления после yield
         self.command_id = 0
-        self.commands = list(dis.get_instructions(bytecode))
+        self.yield_index = None
+        # исключение, которое обрабатывал вызвавший: фрейм, вызванный
+        # в цикле выполнения, восстанавливает его при выходе
+        self.back_exception = None
+        if code_info is None:
+            code_info = code_cache.get(bytecode)
+        self.code_info = code_info
+        self.ops = code_info.ops
         if back_frame:
             self.builtins_names = back_frame.builtins_names
         else:
-            self.builtins_names = __builtins__.__dict__
+            self.builtins_names = builtins.__dict__
+
+    def locals(self):
+        """
+        словарь локальных имен; у функции собирается из слотов и ячеек
+        """
+        if self.local_names is not None:
+            return self.local_names
+        local_names = {}
+        for name, value in zip(self.bytecode.co_varnames, self.fast_locals):
+            if value is not UNBOUND:
+                local_names[name] = value
+        cell_names = self.bytecode.co_cellvars + self.bytecode.co_freevars
+        for name, cell in zip(cell_names, self.cells):
+            if cell.contents is not UNBOUND:
+                local_names[name] = cell.contents
+        return local_names
+
+
+class ClosureCompiler(object):
+    """
+    компиляция связанного кода CodeInfo в замыкания для
+    VirtualMachine(closures=True). код делится на линейные участки:
+    участок начинается с цели перехода, обработчика исключения, границы
+    защищенного диапазона или инструкции после перехода, вызова, yield
+    и return и ими же кончается. замыкание участка выполняет его
+    целиком и возвращает индекс следующего участка.
+    стек значений участка разбирается при компиляции: LOAD_FAST,
+    LOAD_CONST, загрузки имен, операторы, сравнения и атрибуты
+    собираются в дерево замыканий с заранее связанными операндами, и
+    промежуточные значения не проходят через стек. остальные
+    инструкции выполняются своими обработчиками; значения, которые они
+    берут со стека, перед ними кладутся туда в порядке вычисления
+    """
+    # инструкции, обработчик которых может вернуть индекс перехода или
+    # сменить выполняемый фрейм
+    BLOCK_ENDS = frozenset([
+        'BREAK_LOOP', 'CALL_FUNCTION', 'CALL_FUNCTION_EX',
+        'CALL_FUNCTION_KW', 'CONTINUE_LOOP', 'END_FINALLY', 'FOR_ITER',
+        'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'JUMP_IF_FALSE_OR_POP',
+        'JUMP_IF_TRUE_OR_POP', 'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE',
+        'RETURN_VALUE', 'YIELD_FROM', 'YIELD_VALUE',
+    ])
+    # загрузки, которые становятся узлами дерева через свой обработчик
+    PRODUCERS = frozenset(['LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_DEREF',
+                           'LOAD_CLASSDEREF'])
+    # операторы - узлы дерева: аргумент обработчика - функция оператора,
+    # значение - число ее операндов
+    OPERATORS = dict(
+        [(name, 2) for name in BINARY_OPNAMES] + [('COMPARE_OP', 2)] +
+        [(name, 1) for name in ('UNARY_POSITIVE', 'UNARY_NEGATIVE',
+                                'UNARY_NOT', 'UNARY_INVERT')])
+
+    def __init__(self, code_info):
+        self.code_info = code_info
+        self.opnames = code_info.commands.opnames()
+        # суперинструкции участку не нужны: он разбирает инструкции сам
+        self.ops = list(code_info.ops)
+        for index, op in code_info.unfused.items():
+            self.ops[index] = op
+        # значения участка, еще не положенные на стек: ('const',
+        # значение), ('fast', индекс), ('expr', замыкание) или ('pop',
+        # None) - операнд, который лежит на стеке
+        self.values = []
+        # операторы участка - пары (функция, аргумент), как в ops
+        self.statements = []
+        # узел уже взял операнд со стека: следующий возьмет не тот
+        self.popped = False
+
+    def leaders(self):
+        """
+        индексы, с которых начинаются участки: сюда может прийти
+        выполнение не с предыдущей инструкции
+        """
+        code_info = self.code_info
+        leaders = {0}
+        leaders.update(target for target in code_info.jump_targets
+                       if target is not None)
+        for start, end, target, level, kind in code_info.handlers:
+            leaders.update((start, end, target))
+        for index, exit in code_info.exits.items():
+            opname = self.opnames[index]
+            if exit is None:
+                continue
+            if opname == 'RETURN_VALUE':
+                leaders.add(exit[0])
+            elif opname == 'BREAK_LOOP':
+                leaders.add(exit[1])
+            elif opname == 'CONTINUE_LOOP':
+                loop, start, depth = exit
+                leaders.update((loop[1], start))
+            else:
+                returns, loop = exit
+                if returns is not None:
+                    leaders.add(returns[0])
+                if loop is not None:
+                    leaders.add(loop[1])
+        for index, opname in enumerate(self.opnames):
+            if opname in self.BLOCK_ENDS:
+                leaders.add(index + 1)
+            if opname == 'YIELD_FROM':
+                # продолжение генератора выполняет его снова
+                leaders.add(index)
+        return leaders
+
+    def compile(self):
+        """
+        список замыканий по индексам инструкций: у начала участка -
+        замыкание участка, у остальных - одной инструкции
+        """
+        count = len(self.ops)
+        closures = [self._step(handler, arg, index + 1)
+                    for index, (handler, arg) in enumerate(self.ops)]
+        starts = sorted(index for index in self.leaders() if index < count)
+        for start, end in zip(starts, starts[1:] + [count]):
+            closures[start] = self._block(start, end)
+        return closures
+
+    @staticmethod
+    def _step(handler, arg, following):
+        def step(vm):
+            jump = handler(vm, arg)
+            return following if jump is None else jump
+        return step
+
+    def _block(self, start, end):
+        self.values = []
+        self.statements = []
+        self.popped = False
+        for index in range(start, end - 1):
+            self._translate(index)
+        last = end - 1
+        if self.opnames[last] in self.BLOCK_ENDS:
+            terminator = self._terminator(last)
+        else:
+            self._translate(last)
+            terminator = None
+        self._flush()
+        if terminator is None:
+            return self._assemble(self.statements, end)
+        return self._assemble_jump(self.statements, terminator, end)
+
+    def _translate(self, index):
+        handler, arg = self.ops[index]
+        opname = self.opnames[index]
+        values = self.values
+        if opname == 'LOAD_FAST':
+            values.append(('fast', arg))
+            return
+        if opname == 'LOAD_CONST':
+            values.append(('const', arg))
+            return
+        if opname in self.PRODUCERS:
+            values.append(('expr', self._produce(handler, arg)))
+            return
+        arity = self.OPERATORS.get(opname)
+        if opname == 'LOAD_ATTR':
+            arity = 1
+        operands = self._take(arity) if arity else None
+        if operands is not None:
+            if opname == 'LOAD_ATTR':
+                node = self._attribute(arg, operands[0])
+            elif arity == 1:
+                node = self._unary(arg, operands[0])
+            else:
+                node = self._binary(arg, *operands)
+            values.append(('expr', node))
+            return
+        if values and handler is VirtualMachine._store_fast:
+            value = values.pop()
+            self._flush()
+            self.statements.append((self._store(arg, value), None))
+            return
+        if values and handler is VirtualMachine._pop_top:
+            value = values.pop()
+            self._flush()
+            if value[0] != 'const':
+                # значение не нужно, но вычислить его надо
+                evaluate = self._expression(value)
+                self.statements.append(
+                    (lambda vm, arg: evaluate(vm), None))
+            return
+        self._flush()
+        self.statements.append((handler, arg))
+
+    def _terminator(self, index):
+        """
+        последняя инструкция участка как пара (функция, аргумент):
+        функция, как обработчик, возвращает индекс перехода или None.
+        безусловный переход - индекс вместо пары
+        """
+        handler, arg = self.ops[index]
+        values = self.values
+        if handler is VirtualMachine._jump_absolute:
+            return arg
+        if values and handler in (VirtualMachine._pop_jump_if_false,
+                                  VirtualMachine._pop_jump_if_true):
+            condition = self._expression(values.pop())
+            if handler is VirtualMachine._pop_jump_if_false:
+                def jump(vm, target):
+                    if not condition(vm):
+                        return target
+            else:
+                def jump(vm, target):
+                    if condition(vm):
+                        return target
+            self._flush()
+            return jump, arg
+        if values and handler is VirtualMachine._return_value:
+            result = self._expression(values.pop())
+
+            def return_value(vm, arg):
+                vm.return_value = result(vm)
+                return RETURN_INDEX
+            self._flush()
+            return return_value, None
+        self._flush()
+        return handler, arg
+
+    def _take(self, count):
+        """
+        count операндов узла с вершины стека участка или None, если их
+        там нет. недостающий нижний операнд берется со стека фрейма,
+        если он там один и ниже него никто не брал
+        """
+        values = self.values
+        if len(values) >= count:
+            operands = values[len(values) - count:]
+            del values[len(values) - count:]
+            return operands
+        if len(values) + 1 < count or self.popped:
+            return None
+        self.popped = True
+        operands = [('pop', None)] + values
+        del values[:]
+        return operands
+
+    def _flush(self):
+        """
+        положить значения участка на стек фрейма
+        """
+        if self.values:
+            loads = [self._expression(value) for value in self.values]
+            if len(loads) == 1:
+                load = loads[0]
+
+                def push(vm, arg):
+                    vm.stack.append(load(vm))
+            else:
+                def push(vm, arg):
+                    append = vm.stack.append
+                    for load in loads:
+                        append(load(vm))
+            self.statements.append((push, None))
+            del self.values[:]
+        self.popped = False
+
+    @staticmethod
+    def _expression(value):
+        """
+        замыкание, вычисляющее значение участка
+        """
+        kind, payload = value
+        if kind == 'expr':
+            return payload
+        if kind == 'const':
+            def const(vm):
+                return payload
+            return const
+        if kind == 'pop':
+            def pop(vm):
+                return vm.stack.pop()
+            return pop
+        unbound = UNBOUND
+
+        def load_fast(vm):
+            value = vm.fast_locals[payload]
+            if value is unbound:
+                vm._unbound_local(payload)
+            return value
+        return load_fast
+
+    @staticmethod
+    def _produce(handler, arg):
+        def produce(vm):
+            handler(vm, arg)
+            return vm.stack.pop()
+        return produce
+
+    def _attribute(self, name, operand):
+        owner = self._expression(operand)
+
+        def attribute(vm):
+            return getattr(owner(vm), name)
+        return attribute
+
+    def _unary(self, function, operand):
+        kind, index = operand
+        if kind == 'fast':
+            unbound = UNBOUND
+
+            def unary(vm):
+                value = vm.fast_locals[index]
+                if value is unbound:
+                    vm._unbound_local(index)
+                return function(value)
+        else:
+            load = self._expression(operand)
+
+            def unary(vm):
+                return function(load(vm))
+        return unary
+
+    def _binary(self, function, left, right):
+        left_kind, left_index = left
+        right_kind, right_value = right
+        unbound = UNBOUND
+        if left_kind == 'fast' and right_kind == 'const':
+            def binary(vm):
+                value = vm.fast_locals[left_index]
+                if value is unbound:
+                    vm._unbound_local(left_index)
+                return function(value, right_value)
+        elif left_kind == 'fast' and right_kind == 'fast':
+            def binary(vm):
+                fast_locals = vm.fast_locals
+                value = fast_locals[left_index]
+                if value is unbound:
+                    vm._unbound_local(left_index)
+                other = fast_locals[right_value]
+                if other is unbound:
+                    vm._unbound_local(right_value)
+                return function(value, other)
+        elif right_kind == 'const':
+            load = self._expression(left)
+
+            def binary(vm):
+                return function(load(vm), right_value)
+        else:
+            load = self._expression(left)
+            load_right = self._expression(right)
+
+            def binary(vm):
+                return function(load(vm), load_right(vm))
+        return binary
+
+    def _store(self, index, value):
+        kind, payload = value
+        if kind == 'const':
+            def store(vm, arg):
+                vm.fast_locals[index] = payload
+        else:
+            load = self._expression(value)
+
+            def store(vm, arg):
+                vm.fast_locals[index] = load(vm)
+        return store
+
+    @staticmethod
+    def _assemble(statements, following):
+        """
+        замыкание участка, за которым выполнение идет к following
+        """
+        if not statements:
+            def block(vm):
+                return following
+        elif len(statements) == 1:
+            (function, arg), = statements
+
+            def block(vm):
+                function(vm, arg)
+                return following
+        else:
+            def block(vm):
+                for function, arg in statements:
+                    function(vm, arg)
+                return following
+        return block
+
+    @staticmethod
+    def _assemble_jump(statements, terminator, following):
+        """
+        замыкание участка, который кончается переходом terminator
+        """
+        if type(terminator) is int:
+            return ClosureCompiler._assemble(statements, terminator)
+        last, last_arg = terminator
+        if not statements:
+            def block(vm):
+                jump = last(vm, last_arg)
+                return following if jump is None else jump
+        elif len(statements) == 1:
+            (function, arg), = statements
+
+            def block(vm):
+                function(vm, arg)
+                jump = last(vm, last_arg)
+                return following if jump is None else jump
+        else:
+            def block(vm):
+                for function, arg in statements:
+                    function(vm, arg)
+                jump = last(vm, last_arg)
+                return following if jump is None else jump
+        return block
 
 
 # вызов функции тестирующего фреймворка
 class VirtualMachine(object):
-    def __init__(self):
+    def __init__(self, code_cache=code_cache, profiler=None,
+                 disk_cache=None, recursion_limit=1000, closures=False):
+        # счетчики попаданий: code_cache.hits, code_cache.misses
+        self.code_cache = code_cache
+        # DiskCodeCache для исходников, которые run_code получает строкой
+        self.disk_cache = disk_cache
+        # с профилировщиком фреймы выполняет _run_frame_profiled,
+        # без него цикл выполнения ничего не проверяет
+        self.profiler = profiler
+        if profiler is not None:
+            self._run_frame = self._run_frame_profiled
+        elif closures:
+            # код выполняется участками, скомпилированными в замыкания
+            # (см. ClosureCompiler); профилировщику нужны отдельные
+            # инструкции, поэтому с ним остается обычный цикл
+            self._run_frame = self._run_frame_compiled
         self.frames = []
-        self.running_frame_id = -1
-        self.functions = {
-            "LOAD_NAME": self._load_name,
-            "DELETE_NAME": self._delete_name,
-            "LOAD_CONST": self._load_const,
-            "CALL_FUNCTION": self._call_function,
-            "CALL_FUNCTION_EX": self._call_function_ex,
-            "CALL_FUNCTION_KW": self._call_function_kw,
-            "POP_TOP": self._pop_top,
-            "RETURN_VALUE": self._return_value,
-            "STORE_NAME": self._store_name,
-            "LOAD_ATTR": self._load_attr,
-            "STORE_ATTR": self._store_attr,
-            "DELETE_ATTR": self._delete_attr,
-
-            "STORE_SUBSCR": self._store_subscr,
-            "DELETE_SUBSCR": self._delete_subscr,
-            # TODO тест на это
-            "PRINT_EXPR": self._print_expr,
-            "UNPACK_SEQUENCE": self._unpack_sequence,
-            "UNPACK_EX": self._unpack_ex,
-
-            # бинарные операции
-            "BINARY_ADD": partial(self._bin_op, operator=operator.add),
-            "BINARY_POWER": partial(self._bin_op, operator=operator.pow),
-            "BINARY_MULTIPLY": partial(self._bin_op, operator=operator.mul),
-            "BINARY_MATRIX_MULTIPLY":
-                partial(self._bin_op, operator=operator.matmul),
-            "BINARY_FLOOR_DIVIDE":
-                partial(self._bin_op, operator=operator.floordiv),
-            "BINARY_TRUE_DIVIDE":
-                partial(self._bin_op, operator=operator.truediv),
-            "BINARY_MODULO": partial(self._bin_op, operator=operator.mod),
-            "BINARY_SUBTRACT": partial(self._bin_op, operator=operator.sub),
-            "BINARY_SUBSCR": partial(self._bin_op, operator=operator.getitem),
-            "BINARY_LSHIFT": partial(self._bin_op, operator=operator.lshift),
-            "BINARY_RSHIFT": partial(self._bin_op, operator=operator.rshift),
-            "BINARY_AND": partial(self._bin_op, operator=operator.and_),
-            "BINARY_XOR": partial(self._bin_op, operator=operator.xor),
-            "BINARY_OR": partial(self._bin_op, operator=operator.or_),
-
-            # inplace бинарные
-            "INPLACE_ADD": partial(self._bin_op, operator=operator.iadd),
-            "INPLACE_POWER": partial(self._bin_op, operator=operator.ipow),
-            "INPLACE_MULTIPLY": partial(self._bin_op, operator=operator.imul),
-            "INPLACE_MATRIX_MULTIPLY":
-                partial(self._bin_op, operator=operator.imatmul),
-            "INPLACE_FLOOR_DIVIDE":
-                partial(self._bin_op, operator=operator.ifloordiv),
-            "INPLACE_TRUE_DIVIDE":
-                partial(self._bin_op, operator=operator.itruediv),
-            "INPLACE_MODULO": partial(self._bin_op, operator=operator.imod),
-            "INPLACE_SUBTRACT": partial(self._bin_op, operator=operator.isub),
-            "INPLACE_LSHIFT": partial(self._bin_op, operator=operator.ilshift),
-            "INPLACE_RSHIFT": partial(self._bin_op, operator=operator.irshift),
-            "INPLACE_AND": partial(self._bin_op, operator=operator.iand),
-            "INPLACE_XOR": partial(self._bin_op, operator=operator.ixor),
-            "INPLACE_OR": partial(self._bin_op, operator=operator.ior),
-
-            # унарные операции
-            "UNARY_POSITIVE": partial(self._unary_op, operator=operator.pos),
-            "UNARY_NEGATIVE": partial(self._unary_op, operator=operator.neg),
-            "UNARY_NOT": partial(self._unary_op, operator=operator.not_),
-            "UNARY_CONVERT": partial(self._unary_op, operator=repr),
-            "UNARY_INVERT": partial(self._unary_op, operator=operator.invert),
-
-            'COMPARE_OP': self._compare_op,
-
-            'POP_JUMP_IF_FALSE': self._pop_jump_if_false,
-            'POP_JUMP_IF_TRUE': self._pop_jump_if_true,
-            'JUMP_ABSOLUTE': self._jump_absolute,
-            'JUMP_FORWARD': self._jump_forward,
-            'JUMP_IF_FALSE_OR_POP': self._jump_if_false_or_pop,
-            'JUMP_IF_TRUE_OR_POP': self._jump_if_true_or_pop,
-            'SETUP_LOOP': self._setup_loop,
-            'BREAK_LOOP': self._break_loop,
-            'CONTINUE_LOOP': self._continue_loop,
-            'GET_ITER': self._get_iter,
-            'FOR_ITER': self._for_iter,
-            'POP_BLOCK': self._pop_block,
-            'BUILD_LIST': self._build_list,
-            # TODO тест на это
-            'LIST_APPEND': self._list_append,
-            'BUILD_SET': self._build_set,
-            # TODO тест на это
-            'SET_ADD': self._set_add,
-            # TODO тест на это
-            'BUILD_TUPLE': self._build_tuple,
-            'BUILD_CONST_KEY_MAP': self._built_const_key_map,
-            'BUILD_MAP': self._build_map,
-            # TODO тест на это
-            'MAP_ADD': self._map_add,
-            # TODO тест на это
-            'BUILD_STRING': self._build_string,
-            'BUILD_SLICE': self._build_slice,
-
-            'ROT_TWO': self._rot_two,
-            'ROT_THREE': self._rot_three,
-            'DUP_TOP': self._dup_top,
-            'DUP_TOP_TWO': self._dup_top_two,
-
-            'MAKE_FUNCTION': self._make_function,
-            'LOAD_FAST': self._load_fast,
-            'STORE_FAST': self._store_fast,
-            'DELETE_FAST': self._delete_fast,
-            # TODO понять в чем разница между LOAD_GLOBAL и LOAD_NAME
-            'LOAD_GLOBAL': self._load_name,
-            'NOP': self._nop,
-
-            'LOAD_BUILD_CLASS': self._load_build_class,
-            'SETUP_EXCEPT': self._setup_exept,
-            'RAISE_VARARGS': self._raise_varargs,
-
-        }
-        self.stack = []
-        self.block_stack = []
+        # наибольшее число фреймов в self.frames. вызовы функций
+        # виртуальной машины не расходуют стек CPython, так что предел
+        # не зависит от sys.getrecursionlimit()
+        self.recursion_limit = recursion_limit
+        # выполняемый сейчас фрейм и, для быстрого доступа, его слоты
+        # локальных переменных
+        self.frame = None
+        self.fast_locals = None
+        # стек значений выполняемого фрейма
+        self.stack = None
         self.return_value = None
+        # исключение, которое сейчас обрабатывает except: его бросает
+        # raise без аргументов, и оно становится __context__ нового
+        self.exception = None
 
-    def _make_frame(self, code, args={}, global_names=None,
+    def _make_frame(self, function, code_info, fast_locals=None,
                     local_names=None):
-        if global_names is not None:
-            if local_names is None:
-                local_names = global_names
-        local_names.update(args)
-        global_names = self.frames[-1].global_names
-        return Frame(code, self.frames[-1], global_names, local_names)
+        """
+        фрейм для вызова функции виртуальной машины
+        """
+        code = function.__code__
+        frame = Frame(code, self.frame, function.global_names, local_names,
+                      code_info, fast_locals, function.globals_version)
+        if code.co_cellvars or code.co_freevars:
+            cells = [Cell() for _ in code.co_cellvars]
+            for cell_index, index in code_info.binder.cell_args:
+                cells[cell_index].contents = fast_locals[index]
+            if function.__closure__:
+                cells.extend(function.__closure__)
+            frame.cells = cells
+        return frame
+
+    def run_code(self, bytecode):
+        """
+            :type: code_obj
+        вернуть значение, с которым закончился код: для модуля None,
+        для кода compile(..., 'eval') - значение выражения
+        """
+        self.return_value = None
+        return self._run_frame(self._module_frame(bytecode))
+
+    def _module_frame(self, bytecode):
+        """
+        фрейм модуля для исходника или объекта кода
+        """
+        if type(bytecode) is str:
+            if self.disk_cache is not None:
+                bytecode = self.disk_cache.compile(bytecode, '<test>',
+                                                   self.code_cache)
+            else:
+                bytecode = compile(''.join(bytecode), '<test>', 'exec')
+        # как у exec: модуль хранит имена в своих глобальных
+        global_names = {'__builtins__': builtins}
+        return Frame(bytecode, None, global_names, global_names,
+                     self.code_cache.get(bytecode))
+
+    async def run_code_async(self, bytecode, slice_size=1000):
+        """
+        run_code для asyncio: выполнять код кусками по slice_size
+        инструкций, между ними отдавая управление циклу событий
+        """
+        task = Task(self, bytecode)
+        while not task.done:
+            self._run_slice(task, slice_size)
+            if not task.done:
+                await asyncio.sleep(0)
+        return task.result
+
+    def _run_slice(self, task, budget):
+        """
+        выполнить около budget инструкций задачи task и вернуть, сколько
+        выполнено. кусок кончается на первом переходе, вызове функции
+        виртуальной машины или возврате после того, как budget исчерпан,
+        так что линейный участок кода между ними не разрывается. вызов
+        функции виртуальной машины (см. _call_frame) не уходит в
+        рекурсию, а кладет ее фрейм в task.frames, поэтому кусок может
+        закончиться на любой глубине; код, который CPython вызывает сам
+        (например, __init__ из type.__call__), выполняется внутри куска
+        до конца
+        """
+        frames = task.frames
+        running = len(self.frames)
+        self.frames.extend(frames)
+        back_frame = self.frame
+        back_fast_locals = self.fast_locals
+        back_stack = self.stack
+        back_exception = self.exception
+        self.exception = task.exception
+        frame = frames[-1]
+        self.frame = frame
+        self.fast_locals = frame.fast_locals
+        self.stack = frame.stack
+        ops = frame.ops
+        count = len(ops)
+        index = frame.command_id
+        # инструкции считаются на переходах, вызовах и возвратах: между
+        # ними выполнение линейно и их число - разность индексов
+        segment = index
+        executed = 0
+        try:
+            while True:
+                try:
+                    while True:
+                        if index >= count:
+                            # фрейм вернул значение: продолжить вызвавший
+                            frames.pop()
+                            self.frames.pop()
+                            if not frames:
+                                task.finish(self.return_value)
+                                break
+                            self.exception = frame.back_exception
+                            frame = frames[-1]
+                            self.frame = frame
+                            self.fast_locals = frame.fast_locals
+                            self.stack = frame.stack
+                            self.stack.append(self.return_value)
+                            ops = frame.ops
+                            count = len(ops)
+                            index = segment = frame.command_id
+                            continue
+                        handler, arg = ops[index]
+                        index += 1
+                        jump = handler(self, arg)
+                        if jump is not None:
+                            executed += index - segment
+                            if self.frame is not frame:
+                                # вызов функции виртуальной машины
+                                frame = self.frame
+                                frames.append(frame)
+                                ops = frame.ops
+                                count = len(ops)
+                                index = segment = frame.command_id
+                                if executed >= budget:
+                                    break
+                                continue
+                            index = segment = jump
+                            # возврат доводится до вызвавшего в этом же
+                            # куске: return_value общий для всех задач
+                            if executed >= budget and index < count:
+                                break
+                    break
+                except BaseException as exc:
+                    # обработчик ищется от выполняемого фрейма задачи к
+                    # вызвавшим: вызов CALL_FUNCTION - индекс перед
+                    # command_id
+                    target = self._unwind(frame, index - 1, exc)
+                    while target is None and len(frames) > 1:
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        self.frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        self.stack = frame.stack
+                        target = self._unwind(frame, frame.command_id - 1,
+                                              exc)
+                    if target is None:
+                        task.fail(exc)
+                        raise
+                    ops = frame.ops
+                    count = len(ops)
+                    index = segment = target
+        finally:
+            frame.command_id = index
+            del self.frames[running:]
+            self.frame = back_frame
+            self.fast_locals = back_fast_locals
+            self.stack = back_stack
+            task.exception = self.exception
+            self.exception = back_exception
+        task.instructions += executed
+        return executed
+
+    def _call_frame(self, call):
+        """
+        CALL_FUNCTION: функцию виртуальной машины или ее метод не
+        вызывать рекурсивно, а сделать фрейм вызова выполняемым и
+        вернуть RETURN_INDEX. цикл выполнения продолжит этот фрейм,
+        а когда тот вернет значение - вызвавший с индекса resume.
+        остальное вызывается как обычно, и обработчик возвращает None
+        """
+        argc, resume = call
+        stack = self.stack
+        base = len(stack) - argc - 1
+        callee = stack[base]
+        callee_type = type(callee)
+        if callee_type is Function:
+            function = callee
+            args = stack[base + 1:]
+        elif callee_type is MethodType and \
+                type(callee.__func__) is Function:
+            function = callee.__func__
+            args = [callee.__self__]
+            args.extend(stack[base + 1:])
+        else:
+            # как _call_function, без лишнего вызова метода на каждый
+            # вызов встроенной функции
+            params = stack[base + 1:]
+            del stack[base:]
+            if not params:
+                frame_builtin = self.frame_builtins.get(id(callee))
+                if frame_builtin is not None:
+                    stack.append(frame_builtin(self))
+                    return None
+            stack.append(callee(*params))
+            return None
+        if len(self.frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        code = function.__code__
+        code_info = function.code_info
+        if code_info is None or code_info.bytecode is not code:
+            code_info = function.get_code_info()
+        fast_locals = code_info.binder.bind(function, args, {})
+        if code.co_cellvars or code.co_freevars:
+            frame = self._make_frame(function, code_info, fast_locals)
+        else:
+            frame = Frame(code, self.frame, function.global_names, None,
+                          code_info, fast_locals, function.globals_version)
+        del stack[base:]
+        frame.back_exception = self.exception
+        self.frame.command_id = resume
+        self.frames.append(frame)
+        self.frame = frame
+        self.fast_locals = frame.fast_locals
+        self.stack = frame.stack
+        return RETURN_INDEX
+
+    def _call_frame_kw(self, call):
+        """
+        CALL_FUNCTION_KW: функция виртуальной машины, как в _call_frame,
+        выполняется в этом же цикле; аргументы по именам раскладывает
+        ArgumentBinder.bind
+        """
+        argc, resume = call
+        stack = self.stack
+        names = stack[-1]
+        base = len(stack) - argc - 2
+        function, args = self._frame_callee(stack[base],
+                                            stack[base + 1:-1])
+        if function is None:
+            self._call_function(argc, stack.pop())
+            return None
+        split = len(args) - len(names)
+        kwargs = dict(zip(names, args[split:]))
+        del args[split:]
+        del stack[base:]
+        return self._bind_frame(function, args, kwargs, resume)
+
+    def _call_frame_ex(self, call):
+        """
+        CALL_FUNCTION_EX: как _call_frame_kw, но аргументы - кортеж
+        (или список) и словарь на стеке
+        """
+        flags, resume = call
+        stack = self.stack
+        kwargs = stack.pop() if flags & 0x01 else {}
+        args = stack.pop()
+        callee = stack.pop()
+        function = None
+        # остальное, вместе с ошибками распаковки, - обычным вызовом
+        if type(args) in (tuple, list) and type(kwargs) is dict:
+            function, args = self._frame_callee(callee, args)
+        if function is None:
+            stack.append(callee(*args, **kwargs))
+            return None
+        return self._bind_frame(function, args, kwargs, resume)
+
+    @staticmethod
+    def _frame_callee(callee, args):
+        """
+        функция виртуальной машины за callee и список ее аргументов
+        (у метода первым идет __self__) или (None, args), если callee
+        вызывается обычно
+        """
+        callee_type = type(callee)
+        if callee_type is Function:
+            return callee, list(args)
+        if callee_type is MethodType and type(callee.__func__) is Function:
+            return callee.__func__, [callee.__self__, *args]
+        return None, args
+
+    def _bind_frame(self, function, args, kwargs, resume):
+        """
+        разложить аргументы вызова function и сделать выполняемым его
+        фрейм (см. _push_frame)
+        """
+        code_info = function.code_info
+        if code_info is None or code_info.bytecode is not function.__code__:
+            code_info = function.get_code_info()
+        return self._push_frame(function, code_info,
+                                code_info.binder.bind(function, args, kwargs),
+                                resume)
+
+    def _run(self):
+        """
+        зупустить верхний фрейм
+        вернуть его результат
+        """
+        return self._run_frame(self.frames[0])
+
+    def _run_frame(self, frame):
+        """
+        выполнить связанный код фрейма: обработчик получает
+        декодированный аргумент и возвращает индекс следующей инструкции,
+        если нужно перейти не к следующей по порядку. функции
+        виртуальной машины, которые вызывает CALL_FUNCTION, выполняются
+        в этом же цикле (см. _call_frame): в рекурсию уходит только код,
+        который вызывает сам CPython, например __init__ из type.__call__
+        """
+        frames = self.frames
+        if len(frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        # фреймы от entry и выше выполняет этот цикл
+        entry = len(frames)
+        entry_frame = frame
+        frames.append(frame)
+        back_frame = self.frame
+        back_fast_locals = self.fast_locals
+        back_stack = self.stack
+        back_exception = self.exception
+        self.frame = frame
+        self.fast_locals = frame.fast_locals
+        self.stack = frame.stack
+        ops = frame.ops
+        count = len(ops)
+        index = frame.command_id
+        try:
+            while True:
+                # try стоит один раз на вход в цикл, а не на инструкцию
+                try:
+                    while index < count:
+                        handler, arg = ops[index]
+                        index += 1
+                        jump = handler(self, arg)
+                        if jump is not None:
+                            index = jump
+                    if self.frame is not frame:
+                        # CALL_FUNCTION сделал выполняемым фрейм вызова
+                        frame = self.frame
+                    elif frame is entry_frame:
+                        break
+                    else:
+                        # фрейм вернул значение: продолжить вызвавший
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        stack = frame.stack
+                        self.stack = stack
+                        stack.append(self.return_value)
+                    ops = frame.ops
+                    count = len(ops)
+                    index = frame.command_id
+                except BaseException as exc:
+                    # обработчик ищется от выполняемого фрейма к
+                    # вызвавшим: вызов - инструкция перед command_id
+                    target = self._unwind(frame, index - 1, exc)
+                    while target is None and frame is not entry_frame:
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        self.stack = frame.stack
+                        target = self._unwind(frame, frame.command_id - 1,
+                                              exc)
+                    if target is None:
+                        raise
+                    ops = frame.ops
+                    count = len(ops)
+                    index = target
+        finally:
+            frame.command_id = index
+            del frames[entry:]
+            self.frame = back_frame
+            self.fast_locals = back_fast_locals
+            self.stack = back_stack
+            # except внутри фрейма не меняет исключение снаружи
+            self.exception = back_exception
+        return self.return_value
+
+    def _run_frame_compiled(self, frame):
+        """
+        _run_frame для VirtualMachine(closures=True): код выполняется не
+        по инструкции, а по участкам, скомпилированным в замыкания (см.
+        ClosureCompiler). замыкание участка возвращает индекс
+        следующего; исключение ищет обработчик по индексу начала
+        участка: участок не пересекает границ защищенных диапазонов
+        """
+        frames = self.frames
+        if len(frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        entry = len(frames)
+        entry_frame = frame
+        frames.append(frame)
+        back_frame = self.frame
+        back_fast_locals = self.fast_locals
+        back_stack = self.stack
+        back_exception = self.exception
+        self.frame = frame
+        self.fast_locals = frame.fast_locals
+        self.stack = frame.stack
+        blocks = frame.code_info.compiled()
+        count = len(blocks)
+        index = frame.command_id
+        try:
+            while True:
+                try:
+                    while index < count:
+                        index = blocks[index](self)
+                    if self.frame is not frame:
+                        frame = self.frame
+                    elif frame is entry_frame:
+                        break
+                    else:
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        stack = frame.stack
+                        self.stack = stack
+                        stack.append(self.return_value)
+                    blocks = frame.code_info.compiled()
+                    count = len(blocks)
+                    index = frame.command_id
+                except BaseException as exc:
+                    target = self._unwind(frame, index, exc)
+                    while target is None and frame is not entry_frame:
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        self.stack = frame.stack
+                        target = self._unwind(frame, frame.command_id - 1,
+                                              exc)
+                    if target is None:
+                        raise
+                    blocks = frame.code_info.compiled()
+                    count = len(blocks)
+                    index = target
+        finally:
+            frame.command_id = index
+            del frames[entry:]
+            self.frame = back_frame
+            self.fast_locals = back_fast_locals
+            self.stack = back_stack
+            self.exception = back_exception
+        return self.return_value
+
+    def _run_frame_profiled(self, frame):
+        """
+        _run_frame, который замеряет каждую инструкцию для self.profiler
+        """
+        frames = self.frames
+        if len(frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        entry = len(frames)
+        entry_frame = frame
+        frames.append(frame)
+        back_frame = self.frame
+        back_fast_locals = self.fast_locals
+        back_stack = self.stack
+        back_exception = self.exception
+        self.frame = frame
+        self.fast_locals = frame.fast_locals
+        self.stack = frame.stack
+        ops = frame.ops
+        count = len(ops)
+        index = frame.command_id
+        profiler = self.profiler
+        timer = profiler.timer
+        profile = profiler.enter(frame.code_info)
+        counts = profile.counts
+        times = profile.times
+        back_edges = profile.back_edges
+        try:
+            while True:
+                try:
+                    while index < count:
+                        handler, arg = ops[index]
+                        current = index
+                        index += 1
+                        start = timer()
+                        jump = handler(self, arg)
+                        times[current] += timer() - start
+                        counts[current] += 1
+                        if jump is not None:
+                            if jump <= current:
+                                edge = (current, jump)
+                                back_edges[edge] = \
+                                    back_edges.get(edge, 0) + 1
+                            index = jump
+                    if self.frame is not frame:
+                        frame = self.frame
+                        profile = profiler.enter(frame.code_info)
+                    elif frame is entry_frame:
+                        break
+                    else:
+                        profiler.exit()
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        stack = frame.stack
+                        self.stack = stack
+                        stack.append(self.return_value)
+                        profile = profiler.running[-1][0]
+                    counts = profile.counts
+                    times = profile.times
+                    back_edges = profile.back_edges
+                    ops = frame.ops
+                    count = len(ops)
+                    index = frame.command_id
+                except BaseException as exc:
+                    counts[index - 1] += 1
+                    target = self._unwind(frame, index - 1, exc)
+                    while target is None and frame is not entry_frame:
+                        profiler.exit()
+                        self.exception = frame.back_exception
+                        frames.pop()
+                        frame = frames[-1]
+                        self.frame = frame
+                        self.fast_locals = frame.fast_locals
+                        self.stack = frame.stack
+                        target = self._unwind(frame, frame.command_id - 1,
+                                              exc)
+                    if target is None:
+                        raise
+                    profile = profiler.running[-1][0]
+                    counts = profile.counts
+                    times = profile.times
+                    back_edges = profile.back_edges
+                    ops = frame.ops
+                    count = len(ops)
+                    index = target
+        finally:
+            for _ in frames[entry:]:
+                profiler.exit()
+            frame.command_id = index
+            del frames[entry:]
+            self.frame = back_frame
+            self.fast_locals = back_fast_locals
+            self.stack = back_stack
+            self.exception = back_exception
+        return self.return_value
+
+    def _unsupported(self, opname):
+        raise KeyError(opname)
 
-    def run_code(self, bytecode):
+    def _load_name(self, name):
         """
-            :type: code_obj
+        положить на вершину стека значение имени name
         """
+        working_frame = self.frame
+        local_names = working_frame.local_names
+        global_names = working_frame.global_names
+        if name in local_names:
+            self.stack.append(local_names[name])
+        # у модуля локальные имена и есть глобальные
+        elif local_names is not global_names and name in global_names:
+            self.stack.append(global_names[name])
+        elif name in working_frame.builtins_names:
+            self.stack.append(working_frame.builtins_names[name])
+        else:
+            raise NameError("not found {}".format(name))
 
-        if type(bytecode) is str:
-            bytecode = compile(''.join(bytecode), '<test>', 'exec')
-        self.running_frame_id = 0
-        self.return_value = None
-        self._run_frame(Frame(bytecode))
+    def _delete_name(self, name):
+        working_frame = self.frame
+        if name in working_frame.local_names:
+            del working_frame.local_names[name]
+            working_frame.locals_version.changed()
+        elif name in working_frame.global_names:
+            del working_frame.global_names[name]
+            working_frame.globals_version.changed()
+        elif name in working_frame.builtins_names:
+            del working_frame.builtins_names[name]
+        else:
+            raise NameError("not found {}".format(name))
 
-    def _run(self):
+    def _load_global(self, name):
         """
-        зупустить верхний фрейм
-        вернуть его результат
+        глобальное имя ищется мимо локальных
         """
-        return self._run_frame(self.frames[0])
+        working_frame = self.frame
+        if name in working_frame.global_names:
+            self.stack.append(working_frame.global_names[name])
+        elif name in working_frame.builtins_names:
+            self.stack.append(working_frame.builtins_names[name])
+        else:
+            raise NameError("not found {}".format(name))
 
-    def _run_frame(self, frame):
-        self.frames.append(frame)
-        self.running_frame_id = len(self.frames) - 1
-        self.frames[-1].command_id = 0
-        while self.frames[-1].command_id < len(self.frames[-1].commands):
-            command = self.frames[-1].commands[self.frames[-1].command_id]
-            self.frames[-1].command_id += 1
-            self.functions[command.opname](command)
-        self.frames.pop()
-        self.running_frame_id -= 1
-        return self.return_value
+    def _store_global(self, name):
+        self.frame.global_names[name] = self.stack.pop()
+
+    def _delete_global(self, name):
+        working_frame = self.frame
+        del working_frame.global_names[name]
+        working_frame.globals_version.changed()
+
+    # встроенные кэши имен. запись нового имени меняет версию словаря,
+    # поэтому с кэшами LOAD_NAME и LOAD_GLOBAL связываются и версии
+    # STORE_NAME и STORE_GLOBAL, которые это отслеживают
 
-    def _load_name(self, command):
+    def _lookup_name(self, cache, local_names):
         """
-        положить на вершину стека функцию описанную в command
+        найти имя из cache в local_names (None - мимо локальных),
+        глобальных и встроенных именах и запомнить в cache, где оно
+        нашлось
         """
-        function_name = command.argval
-        working_frame = self.frames[self.running_frame_id]
-        if function_name in working_frame.local_names:
-            self.stack.append(working_frame.local_names[function_name])
-        elif function_name in working_frame.global_names:
-            self.stack.append(working_frame.global_names[function_name])
-        elif function_name in working_frame.builtins_names:
-            self.stack.append(working_frame.builtins_names[function_name])
+        name = cache.name
+        working_frame = self.frame
+        if cache.namespace is None:
+            cache.misses += 1
         else:
-            raise NameError("not found {}".format(function_name))
-
-    def _delete_name(self, command):
-        function_name = command.argval
-        working_frame = self.frames[self.running_frame_id]
-        if function_name in working_frame.local_names:
-            del working_frame.local_names[command.argval]
-        elif function_name in working_frame.global_names:
-            del working_frame.global_names[command.argval]
-        elif function_name in working_frame.builtins_names:
-            del working_frame.builtins_names[command.argval]
+            cache.invalidations += 1
+        if local_names is not None and name in local_names:
+            namespace = local_names
+        elif name in working_frame.global_names:
+            namespace = working_frame.global_names
+        elif name in working_frame.builtins_names:
+            namespace = working_frame.builtins_names
         else:
-            raise NameError("not found {}".format(function_name))
+            raise NameError("not found {}".format(name))
+        locals_version = 0
+        if local_names is not None:
+            locals_version = working_frame.locals_version.version
+        globals_version = working_frame.globals_version.version
+        if locals_version is None or globals_version is None:
+            # словарь не отслеживается: кэш не совпадет ни с чем
+            locals_version = globals_version = 0
+        cache.locals_version = locals_version
+        cache.globals_version = globals_version
+        cache.namespace = namespace
+        return namespace[name]
 
-    def _load_const(self, command):
+    def _load_name_cached(self, cache):
+        working_frame = self.frame
+        if (cache.locals_version == working_frame.locals_version.version and
+                cache.globals_version ==
+                working_frame.globals_version.version):
+            try:
+                self.stack.append(cache.namespace[cache.name])
+                cache.hits += 1
+                return
+            except KeyError:
+                # имя удалили из встроенных
+                pass
+        self.stack.append(
+            self._lookup_name(cache, working_frame.local_names))
+
+    def _load_global_cached(self, cache):
+        if cache.globals_version == self.frame.globals_version.version:
+            try:
+                self.stack.append(cache.namespace[cache.name])
+                cache.hits += 1
+                return
+            except KeyError:
+                pass
+        self.stack.append(self._lookup_name(cache, None))
+
+    def _store_name_tracked(self, name):
+        working_frame = self.frame
+        local_names = working_frame.local_names
+        if name not in local_names:
+            working_frame.locals_version.changed()
+        local_names[name] = self.stack.pop()
+
+    def _store_global_tracked(self, name):
+        working_frame = self.frame
+        if name not in working_frame.global_names:
+            working_frame.globals_version.changed()
+        working_frame.global_names[name] = self.stack.pop()
+
+    def _load_const(self, value):
         """
-        положить на вершину стека константу описанную в command
+        положить на вершину стека константу
         """
-        self.stack.append(command.argval)
+        self.stack.append(value)
 
-    def _call_function(self, command, args=[]):
+    def _call_function(self, argc, kwnames=()):
         """
-        снять со стека аргументы функции и функцию,
+        снять со стека аргументы функции и функцию одним срезом,
         запустить функцию с аргументами,
         положить результат выполнения обратно на стек
         """
-        # получим количество именнованных и неименованных аргументов
-        named_len, pos_len = divmod(command.argval, 256)
-        # print(command)
-        self._build_map(command, named_len)
-        named_params = self.stack.pop()
-        self._build_list(command, pos_len)
-        params = self.stack.pop()
-        params.extend(args)
-        func_name = self.stack.pop()
-        # print(func_name)
-        # print(params)
-        if func_name == __build_class__:
-            self.stack.append(__build_class__(*params, **named_params))
+        stack = self.stack
+        base = len(stack) - argc - 1
+        func_name = stack[base]
+        params = stack[base + 1:]
+        del stack[base:]
+        if kwnames:
+            named_params = dict(zip(kwnames, params[-len(kwnames):]))
+            del params[-len(kwnames):]
+            stack.append(func_name(*params, **named_params))
+            return
+        if not params:
+            frame_builtin = self.frame_builtins.get(id(func_name))
+            if frame_builtin is not None:
+                stack.append(frame_builtin(self))
+                return
+        stack.append(func_name(*params))
+
+    # встроенные кэши вызовов (см. CallCache). функции виртуальной
+    # машины, как и в _call_frame, выполняются в цикле, который вызвал
+    # обработчик, а не рекурсивно
+
+    def _call_cached(self, cache):
+        stack = self.stack
+        base = len(stack) - cache.argc - 1
+        callee = stack[base]
+        kind = cache.kind
+        fast_locals = None
+        if kind == 'builtin':
+            if type(callee) is cache.callee_type:
+                cache.hits += 1
+                params = stack[base + 1:]
+                del stack[base:]
+                if not params:
+                    frame_builtin = self.frame_builtins.get(id(callee))
+                    if frame_builtin is not None:
+                        stack.append(frame_builtin(self))
+                        return None
+                stack.append(callee(*params))
+                return None
+        elif kind == 'function':
+            if type(callee) is Function and \
+                    callee.__code__ is cache.code and \
+                    callee.__defaults__ is cache.defaults:
+                function = callee
+                if cache.tail is not None:
+                    fast_locals = stack[base + 1:]
+                    fast_locals.extend(cache.tail)
+                else:
+                    fast_locals = cache.code_info.binder.bind(
+                        callee, stack[base + 1:], {})
+        elif kind == 'method':
+            if type(callee) is MethodType:
+                function = callee.__func__
+                if type(function) is Function and \
+                        function.__code__ is cache.code and \
+                        function.__defaults__ is cache.defaults:
+                    fast_locals = [callee.__self__]
+                    fast_locals.extend(stack[base + 1:])
+                    if cache.tail is not None:
+                        fast_locals.extend(cache.tail)
+                    else:
+                        fast_locals = cache.code_info.binder.bind(
+                            function, fast_locals, {})
+        elif kind == 'class':
+            if type(callee) is type and callee.__new__ is object.__new__:
+                function = callee.__init__
+                if type(function) is Function and \
+                        function.__code__ is cache.code and \
+                        function.__defaults__ is cache.defaults:
+                    cache.hits += 1
+                    instance = object.__new__(callee)
+                    args = [instance]
+                    args.extend(stack[base + 1:])
+                    if cache.tail is not None:
+                        args.extend(cache.tail)
+                    else:
+                        args = cache.code_info.binder.bind(function, args,
+                                                           {})
+                    del stack[base:]
+                    # __init__ вызывается рекурсивно: вместо его
+                    # результата на стек ляжет экземпляр
+                    result = self._run_frame(
+                        self._make_frame(function, cache.code_info, args))
+                    if result is not None:
+                        raise TypeError(
+                            "__init__() should return None, not '{}'"
+                            .format(type(result).__name__))
+                    stack.append(instance)
+                    return None
+        if fast_locals is None:
+            cache.misses += 1
+            if kind != 'generic':
+                self._specialize_call(cache, callee, cache.argc,
+                                      classes=True)
+            return self._call_frame(cache.call)
+        # дальше - как в _call_frame
+        cache.hits += 1
+        if len(self.frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        code = cache.code
+        if code.co_cellvars or code.co_freevars:
+            frame = self._make_frame(function, cache.code_info, fast_locals)
+        else:
+            frame = Frame(code, self.frame, function.global_names, None,
+                          cache.code_info, fast_locals,
+                          function.globals_version)
+        del stack[base:]
+        frame.back_exception = self.exception
+        self.frame.command_id = cache.call[1]
+        self.frames.append(frame)
+        self.frame = frame
+        self.fast_locals = fast_locals
+        self.stack = frame.stack
+        return RETURN_INDEX
+
+    def _call_kw_cached(self, cache):
+        stack = self.stack
+        names = stack[-1]
+        base = len(stack) - cache.argc - 2
+        callee = stack[base]
+        kind = cache.kind
+        if kind == 'function' or kind == 'method':
+            function = callee
+            values = []
+            if kind == 'method':
+                # раскладка метода ждет __self__ первым
+                function = None
+                if type(callee) is MethodType:
+                    function = callee.__func__
+                    values.append(callee.__self__)
+            if type(function) is Function and names is cache.names and \
+                    function.__code__ is cache.code and \
+                    function.__defaults__ is cache.defaults:
+                cache.hits += 1
+                values.extend(stack[base + 1:-1])
+                del stack[base:]
+                binder = cache.code_info.binder
+                if cache.order is None:
+                    split = len(values) - len(names)
+                    fast_locals = binder.bind(
+                        function, values[:split],
+                        dict(zip(names, values[split:])))
+                else:
+                    if cache.defaults:
+                        values.extend(cache.defaults)
+                    fast_locals = [values[index] for index in cache.order]
+                    fast_locals.extend(binder.padding)
+                return self._push_frame(function, cache.code_info,
+                                        fast_locals, cache.call[1])
+        elif kind == 'builtin':
+            if type(callee) is cache.callee_type:
+                cache.hits += 1
+                self._call_function(cache.argc, stack.pop())
+                return None
+        cache.misses += 1
+        if kind != 'generic':
+            self._specialize_call(cache, callee, cache.argc - len(names),
+                                  names)
+        return self._call_frame_kw(cache.call)
+
+    def _call_ex_cached(self, cache):
+        stack = self.stack
+        kwargs = stack.pop() if cache.argc & 0x01 else {}
+        args = stack.pop()
+        callee = stack.pop()
+        kind = cache.kind
+        if (kind == 'function' or kind == 'method') and \
+                type(args) in (tuple, list) and type(kwargs) is dict:
+            function = callee
+            if kind == 'method' and type(callee) is MethodType:
+                function = callee.__func__
+            if type(function) is Function and \
+                    function.__code__ is cache.code:
+                cache.hits += 1
+                if function is not callee:
+                    args = [callee.__self__, *args]
+                return self._push_frame(
+                    function, cache.code_info,
+                    cache.code_info.binder.bind(function, args, kwargs),
+                    cache.call[1])
+        elif kind == 'builtin':
+            if type(callee) is cache.callee_type:
+                cache.hits += 1
+                stack.append(callee(*args, **kwargs))
+                return None
+        cache.misses += 1
+        if kind != 'generic':
+            self._specialize_call(cache, callee, None)
+        stack.extend((callee, args, kwargs) if cache.argc & 0x01 else
+                     (callee, args))
+        return self._call_frame_ex(cache.call)
+
+    def _push_frame(self, function, code_info, fast_locals, resume):
+        """
+        сделать выполняемым фрейм вызова function, как _call_frame
+        """
+        if len(self.frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
+        code = code_info.bytecode
+        if code.co_cellvars or code.co_freevars:
+            frame = self._make_frame(function, code_info, fast_locals)
         else:
-            self.stack.append(func_name(*params, **named_params))
+            frame = Frame(code, self.frame, function.global_names, None,
+                          code_info, fast_locals, function.globals_version)
+        frame.back_exception = self.exception
+        self.frame.command_id = resume
+        self.frames.append(frame)
+        self.frame = frame
+        self.fast_locals = fast_locals
+        self.stack = frame.stack
+        return RETURN_INDEX
+
+    def _specialize_call(self, cache, callee, positional, kwnames=(),
+                         classes=False):
+        """
+        запомнить в cache вид callee (см. CallCache). positional - число
+        позиционных аргументов, None - оно становится известно только
+        при вызове (CALL_FUNCTION_EX); kwnames - имена именованных.
+        classes - различать классы, которые создаются без type.__call__
+        """
+        if cache.kind is not None:
+            cache.invalidations += 1
+            if cache.invalidations > CALL_CACHE_RETRIES:
+                cache.kind = 'generic'
+                return
+        callee_type = type(callee)
+        kind = 'builtin'
+        function = None
+        if callee_type is Function:
+            kind = 'function'
+            function = callee
+        elif callee_type is MethodType and \
+                type(callee.__func__) is Function:
+            kind = 'method'
+            function = callee.__func__
+        elif classes and callee_type is type and \
+                callee.__new__ is object.__new__ and \
+                type(callee.__init__) is Function:
+            kind = 'class'
+            function = callee.__init__
+        cache.kind = kind
+        cache.callee_type = callee_type
+        cache.order = None
+        cache.tail = None
+        cache.names = kwnames
+        if function is None:
+            return
+        code_info = function.get_code_info()
+        cache.code = function.__code__
+        cache.defaults = function.__defaults__
+        cache.code_info = code_info
+        if positional is None:
+            return
+        if kind != 'function':
+            positional += 1
+        order = code_info.binder.layout(function, positional, kwnames)
+        cache.order = order
+        if order is not None and not kwnames:
+            defaults = function.__defaults__ or ()
+            cache.tail = tuple(defaults[index - positional]
+                               for index in order[positional:]) + \
+                code_info.binder.padding
 
-    def _call_function_ex(self, command):
+    def _super(self):
         """
-        взять имя функции с вершины стека,
-        дальше взять позиционные аргементы и именнованные аргументы
+        super() без аргументов: CPython ищет __class__ и self в своем
+        фрейме, а они лежат во фрейме виртуальной машины
         """
-        kwargs = None
-        if command.argval != 0:
-            kwargs = self.stack.pop()
-        args = self.stack.pop()
-        func_name = self.stack.pop()
-        if kwargs is not None:
-            self.stack.append(func_name(*args, **kwargs))
+        code = self.frame.bytecode
+        if '__class__' not in code.co_freevars or not code.co_argcount:
+            raise RuntimeError("super(): no arguments")
+        cell_index = len(code.co_cellvars) + \
+            code.co_freevars.index('__class__')
+        first_name = code.co_varnames[0]
+        if first_name in code.co_cellvars:
+            first = self.frame.cells[
+                code.co_cellvars.index(first_name)].contents
         else:
-            self.stack.append(func_name(*args))
+            first = self.frame.fast_locals[0]
+        return super(self.frame.cells[cell_index].contents, first)
+
+    # словари, которые отдаются коду, больше не отслеживаются
+    # встроенными кэшами имен: их могут изменить мимо виртуальной машины
+
+    def _locals(self):
+        if self.frame.locals_version is not None:
+            self.frame.locals_version.untrack()
+        return self.frame.locals()
+
+    def _globals(self):
+        self.frame.globals_version.untrack()
+        return self.frame.global_names
 
-    def _call_function_kw(self, command):
-        self._call_function(command, self.stack.pop())
+    # встроенные функции, которые без аргументов смотрят в фрейм
+    # вызвавшего: в CPython это был бы фрейм виртуальной машины
+    frame_builtins = {
+        id(super): _super,
+        id(locals): _locals,
+        id(vars): _locals,
+        id(globals): _globals,
+    }
 
-    def _pop_top(self, command):
+    def _pop_top(self, arg):
         """
         снять со стека верхний элемент
         """
         self.stack.pop()
 
-    def _return_value(self, command):
+    def _return_value(self, arg):
         """
         вернет вершину стека в качестве возвращаемого значения,
-        уберет элемент в вершины стека
+        уберет элемент в вершины стека и закончит выполнение фрейма
         """
         self.return_value = self.stack.pop()
-        return self.return_value
+        return RETURN_INDEX
 
-    def _store_name(self, command):
+    def _store_name(self, name):
         """
-        проассоциирует локально имя из command со значением на вершине стека
+        проассоциирует локально имя name со значением на вершине стека
         """
-        self.frames[self.running_frame_id].local_names[command.argval] = (
-            self.stack.pop()
-        )
+        self.frame.local_names[name] = self.stack.pop()
 
-    def _load_attr(self, command):
+    def _load_attr(self, name):
         """
         заменит элемент на вершине стека его аттрибутом
         """
-        top_of_stack = self.stack.pop()
-        self.stack.append(getattr(top_of_stack, command.argval))
+        stack = self.stack
+        stack[-1] = getattr(stack[-1], name)
 
-    def _store_attr(self, command):
+    def _store_attr(self, name):
         first = self.stack.pop()
         second = self.stack.pop()
-        setattr(first, command.argval, second)
-        self.stack.append(first)
+        setattr(first, name, second)
 
-    def _delete_attr(self, command):
+    def _delete_attr(self, name):
         first = self.stack.pop()
-        delattr(first, command.argval)
-        self.stack.append(first)
+        delattr(first, name)
 
-    def _store_subscr(self, command):
+    def _store_subscr(self, arg):
         first = self.stack.pop()
         second = self.stack.pop()
         third = self.stack.pop()
         second[first] = third
-        self.stack.append(second)
 
-    def _delete_subscr(self, command):
+    def _delete_subscr(self, arg):
         first = self.stack.pop()
         second = self.stack.pop()
         del second[first]
-        self.stack.append(second)
 
-    def _print_expr(self, command):
+    def _print_expr(self, arg):
         print(self.stack.pop())
 
-    def _unpack_sequence(self, command):
+    def _unpack_sequence(self, count):
         """
-        разложить верхний элемент стека
+        разложить верхний элемент стека: первый элемент окажется сверху
         """
-        sequence = list(self.stack.pop())
-        sequence.reverse()
-        for x in sequence:
-            self.stack.append(x)
+        items = tuple(self.stack.pop())
+        if len(items) > count:
+            raise ValueError(
+                "too many values to unpack (expected {})".format(count))
+        if len(items) < count:
+            raise ValueError(
+                "not enough values to unpack (expected {}, got {})".format(
+                    count, len(items)))
+        self.stack.extend(items[::-1])
 
-    def _unpack_ex(self, command):
-        # узнаем есть ли такое в тестах
-        # sleep(100000)
-        assert False
+    def _unpack_ex(self, arg):
+        """
+        распаковка со звездочкой: arg кодирует, сколько имен до
+        и после нее, в середину попадает список остальных элементов
+        """
+        before, after = arg & 0xFF, arg >> 8
+        items = list(self.stack.pop())
+        if len(items) < before + after:
+            raise ValueError(
+                "not enough values to unpack (expected at least {}, got {})"
+                .format(before + after, len(items)))
+        rest_end = len(items) - after
+        self.stack.extend(reversed(items[rest_end:]))
+        self.stack.append(items[before:rest_end])
+        self.stack.extend(reversed(items[:before]))
 
-    def _bin_op(self, command, operator=None):
+    def _bin_op(self, operator):
         """
         реализация всех бинарных операторов
         взять со стека два аргумента и пременить к ним оператор,
         результат положить на стек
         """
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(operator(left, right))
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = operator(stack[-1], right)
 
-    def _unary_op(self, command, operator=None):
+    def _unary_op(self, operator):
         """
         реализация всех унарных операторов
         взять со стека элемент применить к нему operand
         положить результат на стек
         """
-        value = self.stack.pop()
-        self.stack.append(operator(value))
+        stack = self.stack
+        stack[-1] = operator(stack[-1])
+
+    # частые операторы записаны в самих обработчиках: это дешевле вызова
+    # функции из operator. обработчик выбирается статически при
+    # связывании и верен для любых операндов, поэтому без защит типа
+    # и деоптимизации: защита type(a) is int дороже самого оператора.
+    # аргумент по-прежнему функция оператора, ее берут суперинструкции
+
+    def _binary_add(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] + right
+
+    def _binary_subtract(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] - right
+
+    def _binary_multiply(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] * right
+
+    def _binary_true_divide(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] / right
+
+    def _binary_floor_divide(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] // right
+
+    def _binary_modulo(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] % right
+
+    def _binary_subscr(self, operator):
+        stack = self.stack
+        index = stack.pop()
+        stack[-1] = stack[-1][index]
+
+    def _inplace_add(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        left = stack[-1]
+        left += right
+        stack[-1] = left
+
+    def _inplace_subtract(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        left = stack[-1]
+        left -= right
+        stack[-1] = left
+
+    def _inplace_multiply(self, operator):
+        stack = self.stack
+        right = stack.pop()
+        left = stack[-1]
+        left *= right
+        stack[-1] = left
+
+    def _compare_lt(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] < right
+
+    def _compare_le(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] <= right
+
+    def _compare_gt(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] > right
+
+    def _compare_ge(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] >= right
+
+    def _compare_eq(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] == right
+
+    def _compare_ne(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] != right
+
+    def _compare_in(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] in right
+
+    def _compare_not_in(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] not in right
+
+    def _compare_is(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] is right
+
+    def _compare_is_not(self, compare):
+        stack = self.stack
+        right = stack.pop()
+        stack[-1] = stack[-1] is not right
 
     compare_functions = {
         "<": operator.lt,
@@ -358,85 +3323,91 @@ class VirtualMachine(object):
         ">=": operator.ge,
         "==": operator.eq,
         "!=": operator.ne,
-        "is": lambda a, b: a is b,
-        "is not": lambda a, b: a is not b,
+        "in": lambda a, b: a in b,
+        "not in": lambda a, b: a not in b,
+        "is": operator.is_,
+        "is not": operator.is_not,
+        "exception match": lambda a, b: issubclass(a, b),
         # "is instance": lambda a, b: a isinstance(b),
     }
 
-    def _compare_op(self, command):
-        """
-        реализация всех возможных операций сравнения и принадлежности
-        берет два аргумента со стека, положит на стек возвращаемое значение
-        """
-        self._bin_op(command, self.compare_functions[command.argval])
+    # оператор сравнения -> обработчик COMPARE_OP (см. CodeInfo._link)
+    compare_handlers = {
+        "<": _compare_lt,
+        "<=": _compare_le,
+        ">": _compare_gt,
+        ">=": _compare_ge,
+        "==": _compare_eq,
+        "!=": _compare_ne,
+        "in": _compare_in,
+        "not in": _compare_not_in,
+        "is": _compare_is,
+        "is not": _compare_is_not,
+    }
 
-    def _pop_jump_if_false(self, command):
+    def _pop_jump_if_false(self, target):
         """
         jump вперед если не выполнено условие на вершине стека
         """
-        tos_value = self.stack.pop()
-        if not tos_value:
-            self._jump_absolute(command)
+        if not self.stack.pop():
+            return target
 
-    def _pop_jump_if_true(self, command):
+    def _pop_jump_if_true(self, target):
         """
         jump вперед если выполнено условие на вершине стека
         """
-        tos_value = self.stack.pop()
-        if tos_value:
-            self._jump_absolute(command)
-
-    def _jump_forward(self, command):
-        """
-        безусловный Jump вперед
-        """
-        while self.frames[-1].commands[self.frames[-1].command_id].offset < \
-                command.argval:
-            self.frames[-1].command_id += 1
+        if self.stack.pop():
+            return target
 
-    def _jump_if_true_or_pop(self, command):
+    def _jump_if_true_or_pop(self, target):
         """
         jump если на вершине стека true, иначе убрать значение с вершины стека
         """
-        tos_value = self.stack[-1]
-        if tos_value:
-            self._jump_forward(command)
-        else:
-            self.stack.pop()
+        if self.stack[-1]:
+            return target
+        self.stack.pop()
 
-    def _jump_if_false_or_pop(self, command):
+    def _jump_if_false_or_pop(self, target):
         """
         jump если на вершине стека false, иначе убрать значение с вершины стека
         """
-        tos_value = self.stack[-1]
-        if not tos_value:
-            self._jump_forward(command)
-        else:
-            self.stack.pop()
+        if not self.stack[-1]:
+            return target
+        self.stack.pop()
 
-    def _setup_loop(self, command):
+    def _break_loop(self, exit):
         """
-        положить на вершину стека блоков новый цикл
+        выйти из цикла: убрать все, что цикл положил на стек (например,
+        итератор for), или сначала выполнить finally внутри цикла.
+        exit - (вид, цель, высота стека) из BlockResolver
         """
-        self.block_stack.append(Block("loop", command.argval))
-
-    def _break_loop(self, command):
-        if self.block_stack[-1].type != "loop":
-            # способ увидеть ошибку на сервере
-            assert False
-            sleep(1000000)
-        self._jump_absolute(command, self.block_stack[-1].offset)
+        kind, target, level = exit
+        del self.stack[level:]
+        if kind == 'finally':
+            self.stack.append(Unwind('break', None))
+        return target
 
-    def _continue_loop(self, command):
-        self._jump_absolute(command)
+    def _continue_loop(self, args):
+        """
+        continue внутри try: перейти к началу цикла с его высотой стека
+        или сначала выполнить finally
+        """
+        exit, start, depth = args
+        kind, target, level = exit
+        if kind == 'finally':
+            del self.stack[level:]
+            self.stack.append(Unwind('continue', (start, depth)))
+            return target
+        del self.stack[depth:]
+        return start
 
-    def _get_iter(self, command):
+    def _get_iter(self, arg):
         """
         применить iter к верхушке стека
         """
         self.stack[-1] = iter(self.stack[-1])
 
-    def _for_iter(self, command):
+    def _for_iter(self, target):
         """
         попробовать применить next к макушке стека, если не получится,
         то прыгнуть на delta вперед
@@ -445,244 +3416,1164 @@ class VirtualMachine(object):
             self.stack.append(next(self.stack[-1]))
         except StopIteration:
             self.stack.pop()
-            self._jump_forward(command)
+            return target
 
-    def _jump_absolute(self, command, needTo=None):
+    def _jump_absolute(self, target):
         """
-        продвинутся по командам до указанной позиции
+        перейти к цели jump-а, индекс которой посчитан заранее
         """
-        if needTo is None:
-            needTo = command.argval
-        while self.frames[-1].commands[self.frames[-1].command_id].offset \
-                > needTo:
-            self.frames[-1].command_id -= 1
-        while self.frames[-1].commands[self.frames[-1].command_id].offset \
-                < needTo:
-            self.frames[-1].command_id += 1
+        return target
 
-    def _pop_block(self, command):
+    def _pop_many(self, count):
         """
-        убрать верхний элемент с блокового стека
+        снять со стека count верхних элементов одним срезом
         """
-        self.block_stack.pop()
+        if not count:
+            return []
+        stack = self.stack
+        items = stack[-count:]
+        del stack[-count:]
+        return items
 
-    def _build_list(self, command, argval=None):
+    def _build_list(self, count):
         """
-        убрать с вершины стека command.argval элементов,
+        убрать с вершины стека count элементов,
         сделать из них лист и положить обратно
         """
-        len_of_list = command.argval
-        if argval is not None:
-            len_of_list = argval
-        result_list = []
-        for i in range(len_of_list):
-            result_list.append(self.stack[-1])
-            self.stack.pop()
-        result_list.reverse()
-        self.stack.append(result_list)
+        self.stack.append(self._pop_many(count))
 
-    def _list_append(self, command):
-        first = self.stack.pop()
-        second = self.stack.pop()
-        list.append(second[-command.argval], first)
-        self.stack.append(second)
+    def _list_append(self, arg):
+        """
+        добавить вершину стека в список, лежащий на глубине arg
+        """
+        value = self.stack.pop()
+        self.stack[-arg].append(value)
 
-    def _build_set(self, command):
+    def _build_set(self, count):
         """
         собрать сет по элементам с вершины стека
         """
-        self._build_list(command)
-        built_set = set(self.stack.pop())
-        self.stack.append(built_set)
+        self.stack.append(set(self._pop_many(count)))
 
-    def _set_add(self, command):
-        first = self.stack.pop()
-        second = self.stack.pop()
-        set.add(second[-command.argval], first)
-        self.stack.append(second)
+    def _set_add(self, arg):
+        value = self.stack.pop()
+        self.stack[-arg].add(value)
 
-    def _build_tuple(self, command):
+    def _build_tuple(self, count):
         """
         собрать tuple по элементам с вершины стека
         """
-        self._build_list(command)
-        built_set = tuple(self.stack.pop())
-        self.stack.append(built_set)
+        self.stack.append(tuple(self._pop_many(count)))
 
-    def _built_const_key_map(self, command):
+    def _built_const_key_map(self, count):
         """
         собрать мап из элементов. ключи лежат в tuple сверху стека
         дальше в стеке по одному лежат значения по ключу
         """
+        keys = self.stack.pop()
+        self.stack.append(dict(zip(keys, self._pop_many(count))))
+
+    def _build_map(self, count):
+        """
+        собрать мап из элементов. в стеке поочереди лежат ключи и значения
+        """
+        items = self._pop_many(2 * count)
+        self.stack.append(dict(zip(items[::2], items[1::2])))
+
+    def _build_list_unpack(self, count):
+        """
+        [*a, *b]: склеить count итерируемых с вершины стека
+        """
+        self.stack.append(list(chain.from_iterable(self._pop_many(count))))
+
+    def _build_tuple_unpack(self, count):
+        self.stack.append(tuple(chain.from_iterable(self._pop_many(count))))
+
+    def _build_set_unpack(self, count):
+        self.stack.append(set(chain.from_iterable(self._pop_many(count))))
+
+    def _build_map_unpack(self, count):
+        """
+        {**a, **b}: объединить count мапов с вершины стека
+        """
         built_dict = {}
-        keys = list(self.stack.pop())
-        self._build_list(command)
-        values = self.stack.pop()
-        for i in range(command.argval):
-            key = keys[i]
-            value = values[i]
-            built_dict[key] = value
+        for mapping in self._pop_many(count):
+            built_dict.update(mapping)
         self.stack.append(built_dict)
 
-    def _build_map(self, command, argval=None):
+    def _build_map_unpack_with_call(self, count):
         """
-        собрать мап из элементов. в стеке поочереди лежат ключи и значения
+        f(**a, **b): как BUILD_MAP_UNPACK, но ключи не должны повторяться
         """
         built_dict = {}
-        keys = []
-        values = []
-        len_of_dict = command.argval
-        if argval is not None:
-            len_of_dict = argval
-        for i in range(len_of_dict):
-            values.append(self.stack.pop())
-            keys.append(self.stack.pop())
-
-        keys.reverse()
-        values.reverse()
-        for i in range(len_of_dict):
-            key = keys[i]
-            value = values[i]
-            built_dict[key] = value
+        for mapping in self._pop_many(count):
+            for key in mapping:
+                if key in built_dict:
+                    raise TypeError(
+                        "got multiple values for keyword argument '{}'"
+                        .format(key))
+            built_dict.update(mapping)
         self.stack.append(built_dict)
 
-    def _map_add(self, command):
-        first = self.stack.pop()
-        second = self.stack.pop()
-        dict.setitem(second[-command.argval], first, second)
-        self.stack.append(second)
+    def _map_add(self, arg):
+        """
+        на вершине стека ключ, под ним значение
+        """
+        key = self.stack.pop()
+        value = self.stack.pop()
+        self.stack[-arg][key] = value
 
-    def _build_string(self, command):
+    def _build_string(self, count):
         """
         собрать строку с макушки стека
         """
-        self._build_list(command)
-        string_value = ''.join(self.stack.pop())
-        self.stack.append(string_value)
+        self.stack.append(''.join(self._pop_many(count)))
+
+    # преобразования FORMAT_VALUE по младшим битам флагов
+    format_conversions = {0: None, 1: str, 2: repr, 3: ascii}
+
+    def _format_value(self, flags):
+        """
+        форматирование значения в f-строке, спецификация формата
+        (если есть) лежит на вершине стека
+        """
+        spec = self.stack.pop() if flags & 0x04 else ''
+        value = self.stack.pop()
+        conversion = self.format_conversions[flags & 0x03]
+        if conversion is not None:
+            value = conversion(value)
+        self.stack.append(format(value, spec))
 
-    def _build_slice(self, command):
-        args = [self.stack.pop(), self.stack.pop()]
-        if command.argval == 3:
-            args.append(self.stack.pop())
-        args.reverse()
-        self.stack.append(slice(*args))
+    def _build_slice(self, count):
+        self.stack.append(slice(*self._pop_many(count)))
 
-    def _rot_two(self, command):
+    def _rot_two(self, arg):
         """
         похоже поменять местами два верхних элемента стека
         """
-        left = self.stack.pop()
-        right = self.stack.pop()
-        self.stack.append(left)
-        self.stack.append(right)
+        stack = self.stack
+        stack[-1], stack[-2] = stack[-2], stack[-1]
 
-    def _rot_three(self, command):
+    def _rot_three(self, arg):
         """
         опустить вехний элемент стека на две позиции
         """
-        first = self.stack.pop()
-        second = self.stack.pop()
-        third = self.stack.pop()
-        self.stack.append(first)
-        self.stack.append(third)
-        self.stack.append(second)
+        stack = self.stack
+        stack[-3:] = [stack[-1], stack[-3], stack[-2]]
 
-    def _dup_top(self, command):
+    def _dup_top(self, arg):
         self.stack.append(self.stack[-1])
 
-    def _dup_top_two(self, command):
-        # TODO прочекать что это работает верно
-        self.stack.append(self.stack[-2])
-        self.stack.append(self.stack[-2])
+    def _dup_top_two(self, arg):
+        self.stack.extend(self.stack[-2:])
 
-    def _make_function(self, command):
-        func_name = self.stack.pop()
+    def _make_function(self, flags):
+        """
+        собрать функцию; со стека снимаются qualname, код и,
+        в зависимости от flags, замыкание, аннотации и значения
+        по умолчанию
+        """
+        qualname = self.stack.pop()
         code_object = self.stack.pop()
-        default_args = ()
-        if command.argval > 0:
-            default_args = self.stack.pop()
-        # new_func = Function(func_name, code_object, default_args,
-        #                     self.frames[self.running_frame_id].global_names,
-        #                     self)
-        new_func = \
-            types.FunctionType(code_object,
-                               self.frames[
-                                   self.running_frame_id].global_names,
-                               func_name,
-                               default_args,
-                               None
-                               )
+        closure = annotations = kwdefaults = defaults = None
+        if flags & 0x08:
+            closure = self.stack.pop()
+        if flags & 0x04:
+            annotations = self.stack.pop()
+        if flags & 0x02:
+            kwdefaults = self.stack.pop()
+        if flags & 0x01:
+            defaults = self.stack.pop()
+        if code_object.co_flags & CO_COROUTINES:
+            # корутину выполняет CPython, ей нужны настоящие ячейки.
+            # глобальные имена она меняет мимо виртуальной машины
+            self.frame.globals_version.untrack()
+            new_func = types.FunctionType(code_object,
+                                          self.frame.global_names,
+                                          qualname, defaults)
+            new_func.__kwdefaults__ = kwdefaults
+        elif code_object.co_flags & CO_GENERATOR:
+            new_func = GeneratorFunction(qualname, code_object,
+                                         self.frame.global_names, defaults,
+                                         kwdefaults, closure, self,
+                                         self.frame.globals_version)
+        else:
+            new_func = Function(qualname, code_object,
+                                self.frame.global_names, defaults,
+                                kwdefaults, closure, self,
+                                self.frame.globals_version)
+        if annotations is not None:
+            new_func.__annotations__ = annotations
         self.stack.append(new_func)
 
-    def _load_fast(self, command):
-        if command.argval in self.frames[-1].local_names:
-            self.stack.append(self.frames[-1].local_names[command.argval])
+    def _unbound_local(self, index):
+        raise UnboundLocalError(
+            "local variable '{}' referenced before assignment"
+            .format(self.frame.bytecode.co_varnames[index]))
+
+    def _load_fast(self, index):
+        value = self.fast_locals[index]
+        if value is UNBOUND:
+            self._unbound_local(index)
+        self.stack.append(value)
+
+    def _store_fast(self, index):
+        self.fast_locals[index] = self.stack.pop()
+
+    def _delete_fast(self, index):
+        fast_locals = self.fast_locals
+        if fast_locals[index] is UNBOUND:
+            self._unbound_local(index)
+        fast_locals[index] = UNBOUND
+
+    def _load_closure(self, index):
+        """
+        положить на стек саму ячейку, чтобы собрать из нее замыкание
+        """
+        self.stack.append(self.frame.cells[index])
 
-    def _store_fast(self, command):
-        self.frames[-1].local_names[command.argval] = self.stack.pop()
+    def _load_deref(self, index):
+        contents = self.frame.cells[index].contents
+        if contents is UNBOUND:
+            raise NameError("free variable referenced before assignment")
+        self.stack.append(contents)
+
+    def _load_classderef(self, index):
+        """
+        в теле класса имя сначала ищется в его пространстве имен
+        """
+        code = self.frame.bytecode
+        name = (code.co_cellvars + code.co_freevars)[index]
+        if name in self.frame.local_names:
+            self.stack.append(self.frame.local_names[name])
+        else:
+            self._load_deref(index)
 
-    def _delete_fast(self, command):
-        del self.frames[-1].local_names[command.argval]
+    def _store_deref(self, index):
+        self.frame.cells[index].contents = self.stack.pop()
 
-    # def _load_global(self, command):
-    #     frame = self.frames[-1]
-    #     name = command.argval
-    #     value = None
-    #     if name in frame.global_names:
-    #         self.stack.append(frame.global_names[name])
-    #     elif name in frame.local_names:
-    #         self.stack.append(frame.local_names[name])
-    #     else:
-    #         assert False
+    def _delete_deref(self, index):
+        self.frame.cells[index].contents = UNBOUND
 
-    def _nop(self, command):
+    def _nop(self, arg):
         return
 
-    def _load_build_class(self, command):
-        self.stack.append(__build_class__)
+    def _load_build_class(self, arg):
+        self.stack.append(self._build_class)
+
+    def _build_class(self, func, name, *bases, **kwds):
+        """
+        аналог __build_class__ для тела класса, которое выполняет
+        виртуальная машина
+        """
+        metaclass = kwds.pop('metaclass', None)
+        if metaclass is None:
+            metaclass = type(bases[0]) if bases else type
+        if isinstance(metaclass, type):
+            for base in bases:
+                base_meta = type(base)
+                if issubclass(base_meta, metaclass):
+                    metaclass = base_meta
+        prepare = getattr(metaclass, '__prepare__', None)
+        namespace = prepare(name, bases, **kwds) if prepare else {}
+        self._run_frame(self._make_frame(
+            func, self.code_cache.get(func.__code__), local_names=namespace))
+        # ячейку __class__ заполним сами: type ждет ячейку CPython
+        class_cell = namespace.pop('__classcell__', None)
+        cls = metaclass(name, bases, namespace, **kwds)
+        if class_cell is not None:
+            class_cell.contents = cls
+        return cls
+
+    def _yield_value(self, resume_index):
+        """
+        приостановить фрейм генератора: вершина стека - значение yield,
+        выполнение продолжится со следующей инструкции
+        """
+        self.return_value = self.stack.pop()
+        self.frame.yield_index = resume_index
+        return RETURN_INDEX
+
+    def _yield_from(self, own_index):
+        """
+        передать отправленное значение (вершину стека) итератору под
+        ним; пока итератор не кончился, приостановиться с его значением
+        и потом выполнить эту же инструкцию снова. значение
+        StopIteration заменяет итератор на стеке
+        """
+        stack = self.stack
+        value = stack.pop()
+        receiver = stack[-1]
+        try:
+            if value is None:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as stop:
+            stack[-1] = stop.value
+            return None
+        self.return_value = result
+        self.frame.yield_index = own_index
+        return RETURN_INDEX
+
+    def _get_yield_from_iter(self, arg):
+        self.stack[-1] = iter(self.stack[-1])
 
-    def _setup_exept(self, command):
-        self.block_stack.append(Block("exeption", command.argval))
+    def _raise_varargs(self, argc):
+        stack = self.stack
+        if argc == 0:
+            if self.exception is None:
+                raise RuntimeError("No active exception to reraise")
+            raise self.exception
+        if argc == 2:
+            cause = stack.pop()
+            raise stack.pop() from cause
+        raise stack.pop()
 
-    # TODO доделать обработку исключений
-    def _raise_varargs(self, command):
-        # print(command)
-        # print(self.stack)
-        cause = exc = None
-        if command.argval == 2:
-            cause = self.stack.pop()
-            exc = self.stack.pop()
-            raise exc
-            # six.reraise(type(exc), exc, cause)
-        elif command.argval == 1:
-            exc = self.stack.pop()
+    def _unwind(self, frame, index, exc):
+        """
+        найти в таблице обработчик исключения exc, которое бросила
+        инструкция index фрейма frame, и подготовить к нему стек:
+        except получает прежнее и новое исключение, finally - Unwind.
+        вернуть индекс обработчика или None, если фрейм исключение не
+        ловит
+        """
+        handled = self.exception
+        if handled is not None and exc is not handled and \
+                exc.__context__ is None:
+            exc.__context__ = handled
+        for start, end, target, level, kind in frame.code_info.handlers:
+            if start <= index < end:
+                stack = frame.stack
+                del stack[level:]
+                if kind == 'except':
+                    # как в CPython: traceback, значение и тип, прежнее
+                    # исключение нужно только POP_EXCEPT
+                    stack.extend((None, handled, None,
+                                  exc.__traceback__, exc, type(exc)))
+                    self.exception = exc
+                else:
+                    stack.append(Unwind('exception', exc))
+                return target
+        return None
+
+    def _pop_except(self, arg):
+        """
+        конец except: вернуть прежнее обрабатываемое исключение
+        """
+        stack = self.stack
+        self.exception = stack[-2]
+        del stack[-3:]
+
+    def _return_finally(self, exit):
+        """
+        return внутри try с finally: сначала выполнить finally
+        """
+        target, level = exit
+        stack = self.stack
+        value = stack.pop()
+        del stack[level:]
+        stack.append(Unwind('return', value))
+        return target
+
+    def _end_finally(self, exits):
+        """
+        конец finally или цепочки except. None на вершине - обычный
+        выход, Unwind - продолжить то, из-за чего выполнялся finally:
+        бросить исключение дальше или выйти к следующему finally,
+        циклу или из фрейма (exits - куда, из BlockResolver). иначе на
+        вершине тип исключения, которое не подошло ни одному except
+        """
+        stack = self.stack
+        top = stack.pop()
+        if top is None:
+            return None
+        if type(top) is not Unwind:
+            exc = stack.pop()
+            stack.pop()
+            self.exception = stack[-2]
             raise exc
-            # six.reraise(type(exc), exc)
+        reason = top.reason
+        if reason == 'exception':
+            raise top.value
+        returns, loop = exits
+        if reason == 'return':
+            if returns is None:
+                self.return_value = top.value
+                return RETURN_INDEX
+            target, level = returns
+        else:
+            kind, target, level = loop
+            if kind == 'loop':
+                if reason == 'continue':
+                    target, level = top.value
+                del stack[level:]
+                return target
+        del stack[level:]
+        stack.append(top)
+        return target
+
+    def _setup_with(self, arg):
+        """
+        вызвать __enter__ менеджера контекста; под его результатом
+        остается __exit__ для WITH_CLEANUP_START
+        """
+        stack = self.stack
+        manager = stack.pop()
+        manager_type = type(manager)
+        stack.append(MethodType(manager_type.__exit__, manager))
+        stack.append(manager_type.__enter__(manager))
+
+    def _with_cleanup_start(self, arg):
+        """
+        вызвать __exit__; на стеке остаются None или Unwind и его
+        результат
+        """
+        stack = self.stack
+        unwind = stack.pop()
+        exit = stack.pop()
+        if unwind is not None and unwind.reason == 'exception':
+            exc = unwind.value
+            result = exit(type(exc), exc, exc.__traceback__)
+        else:
+            result = exit(None, None, None)
+        stack.append(unwind)
+        stack.append(result)
+
+    def _with_cleanup_finish(self, arg):
+        """
+        истинный результат __exit__ подавляет исключение
+        """
+        stack = self.stack
+        unwind = stack[-2]
+        if stack.pop() and unwind is not None and \
+                unwind.reason == 'exception':
+            stack[-1] = None
+
+    # суперинструкции: аргумент - кортеж аргументов слитых инструкций
+    # и индекс инструкции, следующей за ними
+
+    def _load_fast_load_fast(self, args):
+        first, second, next_index = args
+        fast_locals = self.fast_locals
+        first_value = fast_locals[first]
+        second_value = fast_locals[second]
+        if first_value is UNBOUND:
+            self._unbound_local(first)
+        if second_value is UNBOUND:
+            self._unbound_local(second)
+        stack = self.stack
+        stack.append(first_value)
+        stack.append(second_value)
+        return next_index
+
+    def _load_fast_load_const(self, args):
+        index, value, next_index = args
+        local_value = self.fast_locals[index]
+        if local_value is UNBOUND:
+            self._unbound_local(index)
+        stack = self.stack
+        stack.append(local_value)
+        stack.append(value)
+        return next_index
+
+    def _store_fast_load_fast(self, args):
+        store_index, load_index, next_index = args
+        fast_locals = self.fast_locals
+        fast_locals[store_index] = self.stack.pop()
+        value = fast_locals[load_index]
+        if value is UNBOUND:
+            self._unbound_local(load_index)
+        self.stack.append(value)
+        return next_index
+
+    def _load_const_bin_op(self, args):
+        value, operator, next_index = args
+        stack = self.stack
+        stack[-1] = operator(stack[-1], value)
+        return next_index
+
+    def _load_fast_bin_op(self, args):
+        index, operator, next_index = args
+        value = self.fast_locals[index]
+        if value is UNBOUND:
+            self._unbound_local(index)
+        stack = self.stack
+        stack[-1] = operator(stack[-1], value)
+        return next_index
+
+    def _load_fast_load_fast_bin_op(self, args):
+        first, second, operator, next_index = args
+        fast_locals = self.fast_locals
+        first_value = fast_locals[first]
+        second_value = fast_locals[second]
+        if first_value is UNBOUND:
+            self._unbound_local(first)
+        if second_value is UNBOUND:
+            self._unbound_local(second)
+        self.stack.append(operator(first_value, second_value))
+        return next_index
+
+    def _compare_pop_jump_if_false(self, args):
+        compare, target, next_index = args
+        stack = self.stack
+        right = stack.pop()
+        if compare(stack.pop(), right):
+            return next_index
+        return target
+
+    def _compare_pop_jump_if_true(self, args):
+        compare, target, next_index = args
+        stack = self.stack
+        right = stack.pop()
+        if compare(stack.pop(), right):
+            return target
+        return next_index
+
+    # опкод -> (обработчик, декодер аргумента), по этой таблице CodeInfo
+    # один раз связывает инструкции с обработчиками
+    functions = {
+        "LOAD_NAME": (_load_name, argval),
+        "DELETE_NAME": (_delete_name, argval),
+        "LOAD_CONST": (_load_const, argval),
+        "CALL_FUNCTION": (_call_frame, call_site),
+        "CALL_FUNCTION_EX": (_call_frame_ex, call_site),
+        "CALL_FUNCTION_KW": (_call_frame_kw, call_site),
+        "POP_TOP": (_pop_top, argval),
+        "RETURN_VALUE": (_return_value, argval),
+        "STORE_NAME": (_store_name, argval),
+        "LOAD_ATTR": (_load_attr, argval),
+        "STORE_ATTR": (_store_attr, argval),
+        "DELETE_ATTR": (_delete_attr, argval),
+
+        "STORE_SUBSCR": (_store_subscr, argval),
+        "DELETE_SUBSCR": (_delete_subscr, argval),
+        # TODO тест на это
+        "PRINT_EXPR": (_print_expr, argval),
+        "UNPACK_SEQUENCE": (_unpack_sequence, argval),
+        "UNPACK_EX": (_unpack_ex, argval),
+
+        # бинарные операции
+        "BINARY_ADD": (_binary_add, constant(operator.add)),
+        "BINARY_POWER": (_bin_op, constant(operator.pow)),
+        "BINARY_MULTIPLY": (_binary_multiply, constant(operator.mul)),
+        "BINARY_MATRIX_MULTIPLY": (_bin_op, constant(operator.matmul)),
+        "BINARY_FLOOR_DIVIDE": (_binary_floor_divide,
+                                constant(operator.floordiv)),
+        "BINARY_TRUE_DIVIDE": (_binary_true_divide,
+                               constant(operator.truediv)),
+        "BINARY_MODULO": (_binary_modulo, constant(operator.mod)),
+        "BINARY_SUBTRACT": (_binary_subtract, constant(operator.sub)),
+        "BINARY_SUBSCR": (_binary_subscr, constant(operator.getitem)),
+        "BINARY_LSHIFT": (_bin_op, constant(operator.lshift)),
+        "BINARY_RSHIFT": (_bin_op, constant(operator.rshift)),
+        "BINARY_AND": (_bin_op, constant(operator.and_)),
+        "BINARY_XOR": (_bin_op, constant(operator.xor)),
+        "BINARY_OR": (_bin_op, constant(operator.or_)),
+
+        # inplace бинарные
+        "INPLACE_ADD": (_inplace_add, constant(operator.iadd)),
+        "INPLACE_POWER": (_bin_op, constant(operator.ipow)),
+        "INPLACE_MULTIPLY": (_inplace_multiply, constant(operator.imul)),
+        "INPLACE_MATRIX_MULTIPLY": (_bin_op, constant(operator.imatmul)),
+        "INPLACE_FLOOR_DIVIDE": (_bin_op, constant(operator.ifloordiv)),
+        "INPLACE_TRUE_DIVIDE": (_bin_op, constant(operator.itruediv)),
+        "INPLACE_MODULO": (_bin_op, constant(operator.imod)),
+        "INPLACE_SUBTRACT": (_inplace_subtract, constant(operator.isub)),
+        "INPLACE_LSHIFT": (_bin_op, constant(operator.ilshift)),
+        "INPLACE_RSHIFT": (_bin_op, constant(operator.irshift)),
+        "INPLACE_AND": (_bin_op, constant(operator.iand)),
+        "INPLACE_XOR": (_bin_op, constant(operator.ixor)),
+        "INPLACE_OR": (_bin_op, constant(operator.ior)),
+
+        # унарные операции
+        "UNARY_POSITIVE": (_unary_op, constant(operator.pos)),
+        "UNARY_NEGATIVE": (_unary_op, constant(operator.neg)),
+        "UNARY_NOT": (_unary_op, constant(operator.not_)),
+        "UNARY_CONVERT": (_unary_op, constant(repr)),
+        "UNARY_INVERT": (_unary_op, constant(operator.invert)),
+
+        'COMPARE_OP': (_bin_op, compare_function),
+
+        'POP_JUMP_IF_FALSE': (_pop_jump_if_false, jump_target),
+        'POP_JUMP_IF_TRUE': (_pop_jump_if_true, jump_target),
+        'JUMP_ABSOLUTE': (_jump_absolute, jump_target),
+        'JUMP_FORWARD': (_jump_absolute, jump_target),
+        'JUMP_IF_FALSE_OR_POP': (_jump_if_false_or_pop, jump_target),
+        'JUMP_IF_TRUE_OR_POP': (_jump_if_true_or_pop, jump_target),
+        'BREAK_LOOP': (_break_loop, block_exit),
+        'CONTINUE_LOOP': (_continue_loop, block_exit),
+        'GET_ITER': (_get_iter, argval),
+        'FOR_ITER': (_for_iter, jump_target),
+        'BUILD_LIST': (_build_list, argval),
+        # TODO тест на это
+        'LIST_APPEND': (_list_append, argval),
+        'BUILD_SET': (_build_set, argval),
+        # TODO тест на это
+        'SET_ADD': (_set_add, argval),
+        # TODO тест на это
+        'BUILD_TUPLE': (_build_tuple, argval),
+        'BUILD_CONST_KEY_MAP': (_built_const_key_map, argval),
+        'BUILD_MAP': (_build_map, argval),
+        # TODO тест на это
+        'MAP_ADD': (_map_add, argval),
+        # TODO тест на это
+        'BUILD_STRING': (_build_string, argval),
+        'BUILD_SLICE': (_build_slice, argval),
+        'BUILD_LIST_UNPACK': (_build_list_unpack, argval),
+        'BUILD_TUPLE_UNPACK': (_build_tuple_unpack, argval),
+        'BUILD_TUPLE_UNPACK_WITH_CALL': (_build_tuple_unpack, argval),
+        'BUILD_SET_UNPACK': (_build_set_unpack, argval),
+        'BUILD_MAP_UNPACK': (_build_map_unpack, argval),
+        'BUILD_MAP_UNPACK_WITH_CALL': (_build_map_unpack_with_call, argval),
+        'FORMAT_VALUE': (_format_value, oparg),
+
+        'ROT_TWO': (_rot_two, argval),
+        'ROT_THREE': (_rot_three, argval),
+        'DUP_TOP': (_dup_top, argval),
+        'DUP_TOP_TWO': (_dup_top_two, argval),
+
+        'MAKE_FUNCTION': (_make_function, argval),
+        'LOAD_FAST': (_load_fast, oparg),
+        'STORE_FAST': (_store_fast, oparg),
+        'DELETE_FAST': (_delete_fast, oparg),
+        'LOAD_CLOSURE': (_load_closure, oparg),
+        'LOAD_DEREF': (_load_deref, oparg),
+        'LOAD_CLASSDEREF': (_load_classderef, oparg),
+        'STORE_DEREF': (_store_deref, oparg),
+        'DELETE_DEREF': (_delete_deref, oparg),
+        'LOAD_GLOBAL': (_load_global, argval),
+        'STORE_GLOBAL': (_store_global, argval),
+        'DELETE_GLOBAL': (_delete_global, argval),
+        'NOP': (_nop, argval),
+
+        'LOAD_BUILD_CLASS': (_load_build_class, argval),
+        'POP_EXCEPT': (_pop_except, argval),
+        'END_FINALLY': (_end_finally, block_exit),
+        'SETUP_WITH': (_setup_with, argval),
+        'WITH_CLEANUP_START': (_with_cleanup_start, argval),
+        'WITH_CLEANUP_FINISH': (_with_cleanup_finish, argval),
+        'YIELD_VALUE': (_yield_value, following_index),
+        'YIELD_FROM': (_yield_from, own_index),
+        'GET_YIELD_FROM_ITER': (_get_yield_from_iter, argval),
+        'RAISE_VARARGS': (_raise_varargs, argval),
+    }
+
+    # RETURN_VALUE внутри try с finally (см. CodeInfo._link)
+    finally_return = (_return_finally, block_exit)
+
+    # замены в functions для CodeCache(name_caches=True)
+    name_cache_functions = {
+        'LOAD_NAME': (_load_name_cached, name_cache),
+        'LOAD_GLOBAL': (_load_global_cached, name_cache),
+        'STORE_NAME': (_store_name_tracked, argval),
+        'STORE_GLOBAL': (_store_global_tracked, argval),
+    }
+
+    # замены в functions для CodeCache(call_caches=True)
+    call_cache_functions = {
+        'CALL_FUNCTION': (_call_cached, call_cache),
+        'CALL_FUNCTION_KW': (_call_kw_cached, call_cache),
+        'CALL_FUNCTION_EX': (_call_ex_cached, call_cache),
+    }
+
+    # последовательность опкодов -> суперинструкция, которой CodeInfo
+    # заменяет эту последовательность (см. CodeInfo._fuse)
+    superinstructions = {
+        ('LOAD_FAST', 'LOAD_FAST'): _load_fast_load_fast,
+        ('LOAD_FAST', 'LOAD_CONST'): _load_fast_load_const,
+        ('STORE_FAST', 'LOAD_FAST'): _store_fast_load_fast,
+        ('COMPARE_OP', 'POP_JUMP_IF_FALSE'): _compare_pop_jump_if_false,
+        ('COMPARE_OP', 'POP_JUMP_IF_TRUE'): _compare_pop_jump_if_true,
+    }
+    superinstructions.update(dict.fromkeys(
+        (('LOAD_CONST', name) for name in BINARY_OPNAMES),
+        _load_const_bin_op))
+    superinstructions.update(dict.fromkeys(
+        (('LOAD_FAST', name) for name in BINARY_OPNAMES),
+        _load_fast_bin_op))
+    superinstructions.update(dict.fromkeys(
+        (('LOAD_FAST', 'LOAD_FAST', name) for name in BINARY_OPNAMES),
+        _load_fast_load_fast_bin_op))
 
 
 class Function(object):
-    def __init__(self, name, code, default_args, names_global, vm):
-        self.name = name
-        self.code = code
-        self.names_global = names_global
+    """
+    функция, тело которой выполняет виртуальная машина
+    """
+    def __init__(self, qualname, code, global_names, defaults, kwdefaults,
+                 closure, vm, globals_version=None):
+        self.__code__ = code
+        self.__name__ = code.co_name
+        self.__qualname__ = qualname
+        self.global_names = global_names
+        # версия global_names, общая с фреймом, где функция создана
+        if globals_version is None:
+            globals_version = NamespaceVersion()
+        self.globals_version = globals_version
+        self.__defaults__ = defaults
+        self.__kwdefaults__ = kwdefaults
+        self.__closure__ = closure
+        self.__module__ = global_names.get('__name__')
+        self.__doc__ = code.co_consts[0] if code.co_consts and \
+            isinstance(code.co_consts[0], str) else None
         self.vm = vm
-        self.default_args = tuple(default_args)
-        kw = {'argdefs': self.default_args}
-        self.func = types.FunctionType(code, names_global, **kw)
+        # CodeInfo тела: кэш кода машины спрашивается при первом вызове
+        # и после замены __code__, а не на каждый вызов
+        self.code_info = None
+
+    def __repr__(self):
+        return '<function {} at {:#x}>'.format(self.__qualname__, id(self))
+
+    @property
+    def __globals__(self):
+        # словарь могут изменить мимо виртуальной машины
+        self.globals_version.untrack()
+        return self.global_names
 
+    def __get__(self, instance, owner):
+        """
+        функция в классе ведет себя как метод
+        """
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+    def get_code_info(self):
+        code_info = self.code_info
+        if code_info is None or code_info.bytecode is not self.__code__:
+            code_info = self.vm.code_cache.get(self.__code__)
+            self.code_info = code_info
+        return code_info
+
+    def __call__(self, *args, **kwargs):
+        vm = self.vm
+        code_info = self.get_code_info()
+        fast_locals = code_info.binder.bind(self, args, kwargs)
+        return vm._run_frame(vm._make_frame(self, code_info, fast_locals))
+
+
+class Task(object):
+    """
+    программа, которую VirtualMachine._run_slice выполняет кусками:
+    стек ее фреймов от модуля до выполняемого, результат и число
+    выполненных инструкций. priority, quota и time_limit - для
+    Scheduler, spawned, started и finished - моменты perf_counter
+    создания, первого куска и завершения
+    """
+    def __init__(self, vm, bytecode, priority=1, quota=None,
+                 time_limit=None):
+        vm.return_value = None
+        self.frames = [vm._module_frame(bytecode)]
+        self.done = False
+        self.result = None
+        self.error = None
+        self.instructions = 0
+        # обрабатываемое исключение задачи между кусками
+        self.exception = None
+        self.priority = priority
+        self.quota = quota
+        self.time_limit = time_limit
+        self.spawned = perf_counter()
+        self.started = None
+        self.finished = None
+
+    def finish(self, result):
+        self.done = True
+        self.result = result
+        self.finished = perf_counter()
+
+    def fail(self, error):
+        self.done = True
+        self.error = error
+        self.frames = []
+        self.finished = perf_counter()
+
+
+class GeneratorFunction(Function):
+    """
+    функция с yield: вызов не выполняет тело, а возвращает Generator
+    с готовым фреймом
+    """
     def __call__(self, *args, **kwargs):
-        # сопоставить имена аргументов в словарь
-        callargs = inspect.getcallargs(self.func, *args, **kwargs)
-        # print(callargs)
-        frame = self.vm._make_frame(self.code, callargs, self.names_global, {})
-        return self.vm._run_frame(frame)
+        vm = self.vm
+        code_info = self.get_code_info()
+        fast_locals = code_info.binder.bind(self, args, kwargs)
+        return Generator(self, vm._make_frame(self, code_info, fast_locals),
+                         vm)
+
+
+class Generator(object):
+    """
+    генератор виртуальной машины: фрейм со своим стеком значений,
+    который next и send продолжают с места последнего yield, пока он
+    не вернет значение
+    """
+    def __init__(self, function, frame, vm):
+        self.__name__ = function.__name__
+        self.__qualname__ = function.__qualname__
+        self.gi_code = function.__code__
+        # None, когда генератор закончился
+        self.gi_frame = frame
+        self.gi_running = False
+        self.vm = vm
+
+    def __repr__(self):
+        return '<generator object {} at {:#x}>'.format(self.__qualname__,
+                                                       id(self))
+
+    def __iter__(self):
+        return self
+
+    def send(self, value=None):
+        """
+        продолжить выполнение; value станет значением yield
+        """
+        frame = self.gi_frame
+        if frame is None:
+            raise StopIteration
+        if self.gi_running:
+            raise ValueError("generator already executing")
+        if frame.yield_index is None:
+            if value is not None:
+                raise TypeError("can't send non-None value to a "
+                                "just-started generator")
+        else:
+            frame.command_id = frame.yield_index
+            frame.yield_index = None
+            frame.stack.append(value)
+        return self._resume(frame)
+
+    # next(generator) - это send(None) без лишнего вызова
+    __next__ = send
+
+    def _resume(self, frame):
+        vm = self.vm
+        frame.back_frame = vm.frame
+        self.gi_running = True
+        try:
+            result = vm._run_frame(frame)
+        except BaseException:
+            self.gi_frame = None
+            raise
+        finally:
+            self.gi_running = False
+            # как f_back в CPython: иначе вызывающий фрейм, который
+            # держит генератор, и фрейм генератора образуют цикл, и
+            # брошенный генератор закроет только сборщик мусора
+            frame.back_frame = None
+        if frame.yield_index is None:
+            self.gi_frame = None
+            raise StopIteration(result)
+        return result
+
+    def throw(self, exc_type, value=None, traceback=None):
+        """
+        бросить исключение в точке yield: его ловят обработчики фрейма
+        генератора, как будто его бросил сам yield. yield from сначала
+        передает его throw итератора, которому делегирует
+        """
+        if self.gi_running:
+            raise ValueError("generator already executing")
+        if value is None:
+            value = exc_type() if isinstance(exc_type, type) else exc_type
+        elif not isinstance(value, BaseException):
+            value = exc_type(value)
+        if traceback is not None:
+            value = value.with_traceback(traceback)
+        frame = self.gi_frame
+        if frame is None or frame.yield_index is None:
+            # не начатый генератор заканчивается, не выполнив ничего
+            self.gi_frame = None
+            raise value
+        index = frame.yield_index
+        frame.yield_index = None
+        # у YIELD_VALUE индекс возобновления - следующий, у YIELD_FROM
+        # - свой (см. их обработчики)
+        raising = index - 1
+        if frame.ops[index][0] is VirtualMachine._yield_from:
+            raising = index
+            receiver = frame.stack[-1]
+            try:
+                if isinstance(value, GeneratorExit):
+                    close = getattr(receiver, 'close', None)
+                    if close is not None:
+                        close()
+                else:
+                    throw = getattr(receiver, 'throw', None)
+                    if throw is not None:
+                        result = throw(value)
+                        frame.yield_index = index
+                        return result
+            except StopIteration as stop:
+                frame.stack[-1] = stop.value
+                frame.command_id = index + 1
+                return self._resume(frame)
+            except BaseException as exc:
+                value = exc
+        vm = self.vm
+        handled = vm.exception
+        try:
+            target = vm._unwind(frame, raising, value)
+            if target is None:
+                self.gi_frame = None
+                raise value
+            frame.command_id = target
+            return self._resume(frame)
+        finally:
+            vm.exception = handled
+
+    def close(self):
+        """
+        бросить GeneratorExit в точке yield, чтобы выполнились finally
+        """
+        if self.gi_running:
+            raise ValueError("generator already executing")
+        try:
+            self.throw(GeneratorExit)
+        except (GeneratorExit, StopIteration) as exc:
+            # его traceback держит фреймы throw, а они - само исключение:
+            # без разрыва цикла фреймы вызвавшего, вплоть до цикла
+            # выполнения, освободит только сборщик мусора
+            exc.__traceback__ = None
+            return
+        raise RuntimeError("generator ignored GeneratorExit")
+
+    def __del__(self):
+        # брошенный на yield генератор закрывается, как в CPython:
+        # иначе его finally и __exit__ не выполнятся никогда
+        frame = self.gi_frame
+        if frame is None or frame.yield_index is None or self.gi_running:
+            return
+        try:
+            self.close()
+        except BaseException as exc:
+            sys.stderr.write('Exception ignored in: {!r}\n{}: {}\n'.format(
+                self, type(exc).__name__, exc))
+
+
+class Unwind(object):
+    """
+    почему выполняется finally или __exit__: reason - 'exception',
+    'return', 'break' или 'continue', value - исключение,
+    возвращаемое значение или (индекс, высота стека) начала цикла для
+    continue. при входе в обработчик лежит на вершине стека, при
+    обычном входе там None
+    """
+    __slots__ = ('reason', 'value')
+
+    def __init__(self, reason, value):
+        self.reason = reason
+        self.value = value
+
+
+class ProgramResult(object):
+    """
+    результат одной программы run_many: index - ее номер во входной
+    последовательности, value - значение run_code, error - "Тип:
+    сообщение" исключения или None, elapsed - секунды выполнения
+    """
+    __slots__ = ('index', 'stdout', 'stderr', 'value', 'error', 'elapsed')
+
+    def __init__(self, index, stdout, stderr, value, error, elapsed):
+        self.index = index
+        self.stdout = stdout
+        self.stderr = stderr
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<ProgramResult {} error={!r}>'.format(self.index, self.error)
+
+
+# машина процесса пула run_many: одна на все программы процесса, так что
+# разобранный код и импорты остаются теплыми
+worker_vm = None
+
+
+def _start_worker():
+    global worker_vm
+    worker_vm = VirtualMachine()
+
+
+def _run_program(index, program):
+    """
+    выполнить программу в процессе пула; объект кода приходит
+    marshal-ом, pickle его не умеет
+    """
+    if isinstance(program, bytes):
+        program = marshal.loads(program)
+    stdout = StringIO()
+    stderr = StringIO()
+    value = error = None
+    start = perf_counter()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            value = worker_vm.run_code(program)
+        except (Exception, SystemExit) as exc:
+            # SystemExit из программы не должен завершать процесс пула:
+            # тогда ее результат не придет и run_many будет ждать вечно
+            error = '{}: {}'.format(type(exc).__name__, exc)
+    elapsed = perf_counter() - start
+    try:
+        pickle.dumps(value)
+    except Exception:
+        value = repr(value)
+    return ProgramResult(index, stdout.getvalue(), stderr.getvalue(), value,
+                         error, elapsed)
+
+
+def run_many(programs, workers=None, ordered=True, max_pending=None):
+    """
+    выполнить программы (исходники или объекты кода) в пуле из workers
+    процессов с теплыми машинами, у каждой программы свои глобальные
+    имена. генератор ProgramResult: в порядке programs, если ordered,
+    иначе по мере готовности. из programs берется не больше
+    max_pending (по умолчанию 2 * workers) программ сверх отданных
+    результатов, так что programs может быть бесконечным итератором
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    finished = queue.Queue()
+    # готовые результаты, которые ждут более ранних (для ordered)
+    ready = {}
+    submitted = yielded = 0
+    programs = iter(programs)
+    exhausted = False
+    with Pool(workers, initializer=_start_worker) as pool:
+        while True:
+            while not exhausted and submitted - yielded < max_pending:
+                try:
+                    program = next(programs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if isinstance(program, types.CodeType):
+                    program = marshal.dumps(program)
+                pool.apply_async(_run_program, (submitted, program),
+                                 callback=finished.put,
+                                 error_callback=finished.put)
+                submitted += 1
+            if yielded == submitted:
+                return
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            if not ordered:
+                yielded += 1
+                yield result
+                continue
+            ready[result.index] = result
+            while yielded in ready:
+                result = ready.pop(yielded)
+                yielded += 1
+                yield result
+
+
+class Scheduler(object):
+    """
+    зеленые потоки: задачи Task на одной машине по кругу, каждой за ход
+    около slice_size * priority инструкций. у каждой задачи свои
+    глобальные имена и стек фреймов. задача с quota падает с
+    RuntimeError, выполнив больше quota инструкций, с time_limit - с
+    TimeoutError, если прошло больше time_limit секунд от ее первого
+    хода. ограничения проверяются между ходами, так что код, который
+    CPython выполняет внутри одного хода, их не замечает
+    """
+    def __init__(self, vm=None, slice_size=1000):
+        self.vm = vm or VirtualMachine()
+        self.slice_size = slice_size
+        self.ready = deque()
+        self.completed = []
+        self.instructions = 0
+        self.elapsed = 0.0
+
+    def spawn(self, bytecode, priority=1, quota=None, time_limit=None):
+        """
+        поставить в очередь программу (исходник или объект кода)
+        """
+        task = Task(self.vm, bytecode, priority, quota, time_limit)
+        self.ready.append(task)
+        return task
+
+    def run(self):
+        """
+        выполнять задачи, пока очередь не опустеет; ошибка программы
+        остается в ее task.error и не мешает остальным
+        """
+        ready = self.ready
+        run_slice = self.vm._run_slice
+        start = perf_counter()
+        while ready:
+            task = ready.popleft()
+            now = perf_counter()
+            if task.started is None:
+                task.started = now
+            if (task.time_limit is not None and
+                    now - task.started > task.time_limit):
+                task.fail(TimeoutError(
+                    "time limit {} s exceeded".format(task.time_limit)))
+                self.completed.append(task)
+                continue
+            budget = max(1, int(self.slice_size * task.priority))
+            if task.quota is not None:
+                left = task.quota - task.instructions
+                if left <= 0:
+                    task.fail(RuntimeError(
+                        "instruction quota {} exceeded".format(task.quota)))
+                    self.completed.append(task)
+                    continue
+                budget = min(budget, left)
+            try:
+                self.instructions += run_slice(task, budget)
+            except (Exception, SystemExit):
+                pass
+            if task.done:
+                self.completed.append(task)
+            else:
+                ready.append(task)
+        self.elapsed += perf_counter() - start
+
+    def stats(self):
+        """
+        пропускная способность и задержки завершенных задач: задержка -
+        от spawn до завершения, в секундах
+        """
+        latencies = sorted(task.finished - task.spawned
+                           for task in self.completed)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1,
+                                 int(fraction * len(latencies)))]
+        elapsed = self.elapsed or float('inf')
+        return {
+            'tasks': len(self.completed),
+            'failed': sum(task.error is not None for task in self.completed),
+            'pending': len(self.ready),
+            'instructions': self.instructions,
+            'elapsed': self.elapsed,
+            'tasks_per_second': len(self.completed) / elapsed,
+            'instructions_per_second': self.instructions / elapsed,
+            'latency_p50': percentile(0.5),
+            'latency_p90': percentile(0.9),
+            'latency_p99': percentile(0.99),
+            'latency_max': percentile(1.0),
+        }
+
 
+def cached_machine():
+    """
+    машина со всеми встроенными кэшами: тесты прогоняются и через нее,
+    чтобы кэши не разошлись с обычным выполнением
+    """
+    return VirtualMachine(code_cache=CodeCache(
+        name_caches=True, call_caches=True))
 
-class Block(object):
-    def __init__(self, type, offset):
-        self.type = type
-        self.offset = offset
 
 if __name__ == "__main__":
-    vm = VirtualMachine()
-    run_vm(vm)
+    failures = run_tests(discover_tests())
+    failures += run_tests(discover_tests(), vm_factory=cached_machine)
+    sys.exit(1 if failures else 0)